@@ -0,0 +1,280 @@
+import argparse
+import csv
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from collections import deque
+from geofence import METRES_PER_DEGREE
+from pdu import PDU
+from persistence import KIND_TELEMETRY, segment_header_size, telemetry_record_size
+from storage import read_segment_header, telemetry_record_format, telemetry_segments
+
+# Offline per-device analytics over stored telemetry: trips, distance,
+# battery drain rate and diag flag histograms.
+#
+# Sources are data directories (raw telemetry segments, worker-N
+# subdirectories included) and telemetry CSV dumps. They are cut into chunks
+# of about chunk_bytes: segments on record boundaries, CSV files on line
+# boundaries, so a chunk is parsed without looking at its neighbours. A
+# process pool maps every chunk to {session_id: SessionSummary} and the
+# parent merges them in source order, so memory is bounded by the number of
+# sessions and the chunks in flight (at most twice the pool size), never by
+# the size of the history.
+#
+# Samples of a session are expected in time order (segments are written in
+# arrival order). A trip ends when a session is silent for more than
+# trip_gap seconds; distance uses the same equirectangular approximation as
+# geofence.py. Battery drain only counts the intervals in which the battery
+# level fell, so charging does not cancel it out. A sample older than the
+# session's previous one is counted as out of order and left out of trips
+# and drain.
+
+DEFAULT_CHUNK_BYTES = 16 * 1024 * 1024
+DEFAULT_TRIP_GAP = 300.0
+FLAG_BITS = 8
+
+summary_fields = ("session_id", "samples", "first", "last", "trips", "distance_m", "moving_s",
+                  "drain_pct_per_h", "battery_min", "battery_max", "activity_mean", "out_of_order") + \
+                 tuple(f"flag_bit{i}" for i in range(FLAG_BITS))
+
+
+class SessionSummary:
+    """ mergeable aggregates of one session's samples (timestamps in epoch seconds)."""
+    __slots__ = ("count", "first", "last", "last_lat", "last_lon", "last_battery", "first_lat", "first_lon",
+                 "first_battery", "trips", "distance", "moving", "drain", "drain_time", "battery_min",
+                 "battery_max", "activity_sum", "out_of_order", "flags")
+
+    def __init__(self):
+        self.count = 0
+        self.trips = 0
+        self.distance = 0.0
+        self.moving = self.drain_time = 0.0
+        self.drain = 0
+        self.activity_sum = 0
+        self.out_of_order = 0
+        self.flags = {}  # diag_flags value -> samples
+
+    def _link(self, t, lat, lon, battery, gap):
+        """ account for the step from the last sample to one at t; False if t is out of order."""
+        dt = t - self.last
+        if dt < 0:
+            self.out_of_order += 1
+            return False
+        if dt <= gap:
+            self.distance += distance_m(self.last_lat, self.last_lon, lat, lon)
+            self.moving += dt
+        else:
+            self.trips += 1
+        if battery < self.last_battery:
+            self.drain += self.last_battery - battery
+            self.drain_time += dt
+        return True
+
+    def add(self, t, lat, lon, activity, battery, flags, gap):
+        if not self.count:
+            self.first = self.last = t
+            self.first_lat = self.last_lat = lat
+            self.first_lon = self.last_lon = lon
+            self.first_battery = self.last_battery = self.battery_min = self.battery_max = battery
+            self.trips = 1
+        elif self._link(t, lat, lon, battery, gap):
+            self.last, self.last_lat, self.last_lon, self.last_battery = t, lat, lon, battery
+        if battery < self.battery_min:
+            self.battery_min = battery
+        elif battery > self.battery_max:
+            self.battery_max = battery
+        self.count += 1
+        self.activity_sum += activity
+        self.flags[flags] = self.flags.get(flags, 0) + 1
+
+    def merge(self, later: "SessionSummary", gap: float):
+        """ fold in the summary of the samples that follow these ones."""
+        if not later.count:
+            return
+        if not self.count:
+            for name in SessionSummary.__slots__:
+                setattr(self, name, getattr(later, name))
+            self.flags = dict(later.flags)
+            return
+        trips = self.trips
+        if self._link(later.first, later.first_lat, later.first_lon, later.first_battery, gap):
+            self.trips += later.trips - 1
+            self.last, self.last_lat, self.last_lon = later.last, later.last_lat, later.last_lon
+            self.last_battery = later.last_battery
+        else:
+            self.trips = trips + later.trips
+        self.count += later.count
+        self.distance += later.distance
+        self.moving += later.moving
+        self.drain += later.drain
+        self.drain_time += later.drain_time
+        self.battery_min = min(self.battery_min, later.battery_min)
+        self.battery_max = max(self.battery_max, later.battery_max)
+        self.activity_sum += later.activity_sum
+        self.out_of_order += later.out_of_order
+        for value, n in later.flags.items():
+            self.flags[value] = self.flags.get(value, 0) + n
+
+    def flag_bits(self) -> list:
+        """ samples with each diag_flags bit set."""
+        bits = [0] * FLAG_BITS
+        for value, n in self.flags.items():
+            for i in range(FLAG_BITS):
+                if value >> i & 1:
+                    bits[i] += n
+        return bits
+
+    def as_row(self, session_id: int) -> list:
+        drain_rate = self.drain / (self.drain_time / 3600) if self.drain_time else 0.0
+        return [session_id, self.count, int(self.first), int(self.last), self.trips, round(self.distance, 1),
+                round(self.moving, 1), round(drain_rate, 3), self.battery_min, self.battery_max,
+                round(self.activity_sum / self.count, 3), self.out_of_order] + self.flag_bits()
+
+
+def distance_m(lat1, lon1, lat2, lon2) -> float:
+    kx = math.cos(math.radians((lat1 + lat2) / 2))
+    return math.hypot(lat2 - lat1, (lon2 - lon1) * kx) * METRES_PER_DEGREE
+
+
+def plan_chunks(sources, chunk_bytes: int = DEFAULT_CHUNK_BYTES):
+    """ yield (kind, path, start, end) byte ranges over the sources, in order; kind is "segment" or "csv"."""
+    for source in sources:
+        if os.path.isdir(source):
+            for path in telemetry_segments(source):
+                _, kind, record_size = read_segment_header(path)
+                if kind != KIND_TELEMETRY or record_size != telemetry_record_size:
+                    raise ValueError(f"{path}: not a telemetry segment")
+                body = os.path.getsize(path) - segment_header_size
+                # a crash can leave a partial record at the end of the last segment
+                end = segment_header_size + body - body % telemetry_record_size
+                step = max(1, chunk_bytes // telemetry_record_size) * telemetry_record_size
+                for start in range(segment_header_size, end, step):
+                    yield "segment", path, start, min(start + step, end)
+        else:
+            size = os.path.getsize(source)
+            with open(source, "rb") as f:
+                f.readline()  # header
+                start = f.tell()
+                while start < size:
+                    f.seek(min(start + chunk_bytes, size))
+                    f.readline()  # finish the line the cut falls in
+                    end = min(f.tell(), size)
+                    yield "csv", source, start, end
+                    start = end
+
+
+def csv_columns(path: str) -> list:
+    with open(path, newline="") as f:
+        return next(csv.reader(f), [])
+
+
+def summarize_chunk(task) -> dict:
+    """ map step: {session_id: SessionSummary} of one chunk."""
+    (kind, path, start, end), gap, default_session = task
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if kind == "segment":
+        rows = struct.iter_unpack(telemetry_record_format, data)
+    else:
+        header = csv_columns(path)
+        index = [header.index(name) for name in PDU.telemetry_fields]
+        sid = header.index("session_id") if "session_id" in header else None
+        rows = _csv_rows(data, index, sid, default_session)
+    summaries = {}
+    for session_id, ts, lat, lon, activity, battery, flags in rows:
+        summary = summaries.get(session_id)
+        if summary is None:
+            summary = summaries[session_id] = SessionSummary()
+        summary.add(ts, lat, lon, activity, battery, flags, gap)
+    return summaries
+
+
+def _csv_rows(data: bytes, index, sid, default_session):
+    ts, lat, lon, activity, battery, flags = index
+    for row in csv.reader(data.decode().splitlines()):
+        if row:
+            yield (default_session if sid is None or not row[sid] else int(row[sid]), int(row[ts]),
+                   float(row[lat]), float(row[lon]), int(row[activity]), int(row[battery]), int(row[flags]))
+
+
+def summarize(sources, processes: int = None, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+              trip_gap: float = DEFAULT_TRIP_GAP, default_session: int = 0) -> dict:
+    """ reduce step: {session_id: SessionSummary} over all sources; processes 1 = no pool."""
+    tasks = ((chunk, trip_gap, default_session) for chunk in plan_chunks(sources, chunk_bytes))
+    totals = {}
+    pool = None
+    if processes != 1:
+        pool = multiprocessing.get_context("fork").Pool(processes)
+        parts = _bounded_map(pool, tasks, 2 * (processes or os.cpu_count()))
+    else:
+        parts = map(summarize_chunk, tasks)
+    try:
+        for part in parts:
+            for session_id, summary in part.items():
+                total = totals.get(session_id)
+                if total is None:
+                    totals[session_id] = summary
+                else:
+                    total.merge(summary, trip_gap)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return totals
+
+
+def _bounded_map(pool, tasks, window: int):
+    """ summarize_chunk over tasks, results in chunk order, at most `window` chunks in flight."""
+    # in order, so merges see sessions in time order; unlike Pool.imap, which reads
+    # every task up front and buffers results, this only runs ahead by `window`
+    pending = deque()
+    for task in tasks:
+        if len(pending) >= window:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(summarize_chunk, (task,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def write_summaries(totals: dict, out):
+    writer = csv.writer(out)
+    writer.writerow(summary_fields)
+    for session_id in sorted(totals):
+        writer.writerow(totals[session_id].as_row(session_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q offline per-device telemetry analytics")
+    parser.add_argument("sources", nargs="+", help="data directories (segments) and/or telemetry CSV files")
+    parser.add_argument("--out", help="write the per-session CSV here (default: stdout)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="worker processes (1 = no pool)")
+    parser.add_argument("--chunk-mb", type=float, default=DEFAULT_CHUNK_BYTES / 2**20,
+                        help="approximate MiB of input per task")
+    parser.add_argument("--trip-gap", type=float, default=DEFAULT_TRIP_GAP,
+                        help="seconds of silence that end a trip")
+    parser.add_argument("--session-id", type=int, default=0, help="session_id for CSV rows without one")
+    args = parser.parse_args()
+
+    wall0 = time.monotonic()
+    totals = summarize(args.sources, args.processes, int(args.chunk_mb * 2**20), args.trip_gap, args.session_id)
+    wall = time.monotonic() - wall0
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            write_summaries(totals, f)
+    else:
+        write_summaries(totals, sys.stdout)
+    samples = sum(s.count for s in totals.values())
+    fleet = SessionSummary()
+    for s in totals.values():
+        for value, n in s.flags.items():
+            fleet.flags[value] = fleet.flags.get(value, 0) + n
+    print(f"{samples} samples, {len(totals)} sessions in {wall:.2f} s ({samples / max(wall, 1e-9):,.0f} samples/s, "
+          f"{args.processes} processes)", file=sys.stderr)
+    print("diag flag bits    " + " ".join(f"{i}:{n}" for i, n in enumerate(fleet.flag_bits())), file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
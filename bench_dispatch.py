@@ -0,0 +1,124 @@
+import argparse
+import timeit
+from pdu import PDU, PDUType
+from server import SERVER_HANDLERS, STREAM_IDS
+from state_machine import (SERVER_TRANSITIONS, ServerState, StateMachine, StateMachineError,
+                           compile_dispatch)
+
+# Per-PDU dispatch microbenchmarks for the server's receive path: state
+# machine transition plus choosing the handler, with handlers that do
+# nothing. "legacy" is the previous implementation (a (state, PDUType) dict
+# lookup with tuple keys on every PDU, then an if/elif chain over stream ID
+# and PDU type) kept here as the baseline for the compiled tables.
+
+class LegacyStateMachine:
+    def __init__(self, initial_state, transitions):
+        self.state = initial_state
+        self._transitions = transitions
+
+    def on_pdu(self, pdu):
+        key = (self.state, pdu.pdu_type)
+        if key in self._transitions:
+            old_state = self.state
+            self.state = self._transitions[key]
+            return old_state, self.state
+        raise StateMachineError(f"Invalid transition from {self.state} with PDU type {pdu.pdu_type}")
+
+
+class Handlers:
+    """ the server's handler names, all doing nothing."""
+    def __init__(self):
+        self.handled = 0
+
+    def handle(self, pdu):
+        self.handled += 1
+
+for _name in SERVER_HANDLERS.values():
+    setattr(Handlers, _name, Handlers.handle)
+
+
+class LegacyDispatch(Handlers):
+    def __init__(self):
+        super().__init__()
+        self.state_machine = LegacyStateMachine(ServerState.OPERATIONAL, SERVER_TRANSITIONS)
+
+    def handle_pdu(self, sid, pdu):
+        if sid == STREAM_IDS['control']:
+            _, new = self.state_machine.on_pdu(pdu)
+            if pdu.pdu_type == PDUType.AUTH_REQUEST:
+                self.on_auth_request(pdu)
+            elif pdu.pdu_type == PDUType.CONTROL:
+                self.on_control(pdu)
+            elif pdu.pdu_type == PDUType.TERMINATE:
+                self.on_terminate(pdu)
+        elif sid == STREAM_IDS['telemetry']:
+            _, new = self.state_machine.on_pdu(pdu)
+            if pdu.pdu_type in (PDUType.TELEMETRY_BATCH, PDUType.TELEMETRY_COMPACT):
+                if pdu.pdu_type == PDUType.TELEMETRY_COMPACT:
+                    self.on_telemetry_compact(pdu)
+                else:
+                    self.on_telemetry_batch(pdu)
+            else:
+                self.on_telemetry(pdu)
+        elif sid == STREAM_IDS['emergency']:
+            _, new = self.state_machine.on_pdu(pdu)
+            self.on_emergency(pdu)
+
+
+class TableDispatch(Handlers):
+    def __init__(self):
+        super().__init__()
+        self.state_machine = StateMachine(ServerState.OPERATIONAL, SERVER_TRANSITIONS)
+        self._dispatch = compile_dispatch(type(self), SERVER_HANDLERS, STREAM_IDS.values())
+
+    def handle_pdu(self, sid, pdu):
+        # as WTCPServerProtocol.handle_pdu
+        handlers = self._dispatch.get(sid)
+        if handlers is None:
+            return
+        pdu_type = pdu.pdu_type
+        self.state_machine.advance(pdu_type)
+        handler = handlers[pdu_type]
+        if handler is not None:
+            handler(self, pdu)
+
+
+def cases(impl):
+    """(name, call) per PDU kind for one implementation, in the OPERATIONAL state."""
+    dispatcher = impl()
+    telemetry = PDU.build_telemetry(7, 1_700_000_000, 37.77, -122.42, 3, 80, 1)
+    batch = PDU.build_telemetry_batch(7, [(1_700_000_000, 37.77, -122.42, 3, 80, 1)] * 20)
+    compact = PDU(PDUType.TELEMETRY_COMPACT, 1, 7, b"")
+    handle = dispatcher.handle_pdu
+    telemetry_sid = STREAM_IDS['telemetry']
+
+    def mixed_100():
+        for _ in range(50):
+            handle(telemetry_sid, telemetry)
+            handle(telemetry_sid, batch)
+
+    return [("telemetry", lambda: handle(telemetry_sid, telemetry)),
+            ("telemetry_batch", lambda: handle(telemetry_sid, batch)),
+            ("telemetry_compact", lambda: handle(telemetry_sid, compact)),
+            ("mixed x100", mixed_100)]
+
+
+def best_ns(fn, number: int, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q server PDU dispatch microbenchmarks")
+    parser.add_argument("--number", type=int, default=100000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs (best is reported)")
+    args = parser.parse_args()
+
+    print(f"{'case':<34}{'legacy ns':>12}{'current ns':>12}{'speedup':>10}")
+    for (name, old), (_, new) in zip(cases(LegacyDispatch), cases(TableDispatch)):
+        number = max(1, args.number // 100) if name.endswith("x100") else args.number
+        t_old = best_ns(old, number, args.repeat)
+        t_new = best_ns(new, number, args.repeat)
+        print(f"{name:<34}{t_old:>12.0f}{t_new:>12.0f}{t_old / t_new:>9.2f}x")
+
+if __name__ == "__main__":
+    main()
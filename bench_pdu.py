@@ -0,0 +1,153 @@
+import argparse
+import struct
+import timeit
+from enum import Enum
+from uuid import UUID
+from pdu import PDU, PDUType
+
+# Encode/decode microbenchmarks per PDU type. "legacy" is the previous
+# implementation (plain Enum types, format strings re-parsed on every call,
+# header + payload concatenation, slicing before unpack) kept here as the
+# baseline to compare the precompiled-Struct fast path against.
+
+LegacyPDUType = Enum("LegacyPDUType", {t.name: t.value for t in PDUType})
+
+class LegacyPDU:
+    header_format = '!H B B I'
+    header_size = struct.calcsize(header_format)
+
+    def __init__(self, pdu_type, version, session_id, payload=b""):
+        self.pdu_type = pdu_type
+        self.version = version
+        self.session_id = session_id
+        self.payload = payload or b""
+
+    def to_bytes(self):
+        length = LegacyPDU.header_size + len(self.payload)
+        header = struct.pack(LegacyPDU.header_format, length, self.pdu_type.value, self.version, self.session_id)
+        return header + self.payload
+
+    @classmethod
+    def from_bytes(cls, data):
+        length, type_val, version, session_id = struct.unpack(cls.header_format, data[:cls.header_size])
+        return cls(LegacyPDUType(type_val), version, session_id, data[cls.header_size:length])
+
+    @staticmethod
+    def build_auth_req(device_uuid, sampling_rate, geofence_radius):
+        payload = device_uuid.bytes
+        payload += struct.pack("!I", sampling_rate)
+        payload += struct.pack("!f", geofence_radius)
+        return LegacyPDU(LegacyPDUType.AUTH_REQUEST, 1, 0, payload)
+
+    @staticmethod
+    def build_telemetry(session_id, timestamp, lat, lon, activity, battery, diag_flags):
+        payload = struct.pack("!Q f f H B B", timestamp, lat, lon, activity, battery, diag_flags)
+        return LegacyPDU(LegacyPDUType.TELEMETRY_REQUEST, 1, session_id, payload)
+
+    @staticmethod
+    def build_control(session_id, new_rate=None, new_radius=None):
+        tlv = b""
+        if new_rate is not None:
+            tlv += struct.pack("!B B I", 0x01, 4, new_rate)
+        if new_radius is not None:
+            tlv += struct.pack("!B B f", 0x02, 4, new_radius)
+        return LegacyPDU(LegacyPDUType.CONTROL, 1, session_id, tlv)
+
+    @staticmethod
+    def build_emergency(session_id, timestamp, alert_code, details=""):
+        detail_bytes = details.encode("utf-8")
+        payload = struct.pack("!Q B B", timestamp, alert_code, len(detail_bytes)) + detail_bytes
+        return LegacyPDU(LegacyPDUType.EMERGENCY, 1, session_id, payload)
+
+    @staticmethod
+    def parse_telemetry(payload):
+        ts, lat, lon, act, bat, flags = struct.unpack("!Q f f H B B", payload)
+        return {"timestamp": ts, "latitude": lat, "longitude": lon,
+                "activity": act, "battery": bat, "diag_flags": flags}
+
+    @staticmethod
+    def parse_control(payload):
+        i = 0; result = {}
+        while i < len(payload):
+            t, l = struct.unpack("!B B", payload[i:i+2]); i += 2
+            v = payload[i:i+l]; i += l
+            if t == 0x01:
+                result["sampling_rate"] = struct.unpack("!I", v)[0]
+            elif t == 0x02:
+                result["geofence_radius"] = struct.unpack("!f", v)[0]
+        return result
+
+    @staticmethod
+    def parse_emergency(payload):
+        ts, code, dlen = struct.unpack("!Q B B", payload[:10])
+        return {"timestamp": ts, "alert_code": code, "details": payload[10:10+dlen].decode("utf-8")}
+
+
+def cases(impl):
+    """(name, encode, decode) per PDU type for one implementation."""
+    uuid = UUID(int=42)
+    telemetry = (7, 1_700_000_000, 37.77, -122.42, 3, 80, 1)
+    wire = {
+        "auth_req": impl.build_auth_req(uuid, 10, 5.5).to_bytes(),
+        "telemetry": impl.build_telemetry(*telemetry).to_bytes(),
+        "control": impl.build_control(7, 20, 15.75).to_bytes(),
+        "emergency": impl.build_emergency(7, 1_700_000_000, 3, "fall detected").to_bytes(),
+    }
+    return [
+        ("auth_req", lambda: impl.build_auth_req(uuid, 10, 5.5).to_bytes(),
+         lambda: impl.from_bytes(wire["auth_req"])),
+        ("telemetry", lambda: impl.build_telemetry(*telemetry).to_bytes(),
+         lambda: impl.parse_telemetry(impl.from_bytes(wire["telemetry"]).payload)),
+        ("control", lambda: impl.build_control(7, 20, 15.75).to_bytes(),
+         lambda: impl.parse_control(impl.from_bytes(wire["control"]).payload)),
+        ("emergency", lambda: impl.build_emergency(7, 1_700_000_000, 3, "fall detected").to_bytes(),
+         lambda: impl.parse_emergency(impl.from_bytes(wire["emergency"]).payload)),
+    ]
+
+
+def fast_path_cases():
+    """cases only the current implementation has: zero-copy decode and encode_into."""
+    telemetry = PDU.build_telemetry(7, 1_700_000_000, 37.77, -122.42, 3, 80, 1)
+    view = memoryview(telemetry.to_bytes() * 100)
+    out = bytearray(telemetry.encoded_size * 100)
+
+    def encode_into_100():
+        offset = 0
+        for _ in range(100):
+            offset = telemetry.encode_into(out, offset)
+
+    def decode_view_100():
+        size = telemetry.encoded_size
+        for offset in range(0, size * 100, size):
+            PDU.parse_telemetry(PDU.from_bytes(view[offset:offset + size]).payload)
+
+    def to_bytes_join_100():
+        b"".join(telemetry.to_bytes() for _ in range(100))
+
+    return [("telemetry x100 encode_into", encode_into_100),
+            ("telemetry x100 to_bytes+join", to_bytes_join_100),
+            ("telemetry x100 memoryview decode", decode_view_100)]
+
+
+def best_ns(fn, number: int, repeat: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q PDU encode/decode microbenchmarks")
+    parser.add_argument("--number", type=int, default=20000, help="calls per timing run")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs (best is reported)")
+    args = parser.parse_args()
+
+    print(f"{'case':<34}{'legacy ns':>12}{'current ns':>12}{'speedup':>10}")
+    for (name, enc_old, dec_old), (_, enc_new, dec_new) in zip(cases(LegacyPDU), cases(PDU)):
+        for op, old, new in (("encode", enc_old, enc_new), ("decode", dec_old, dec_new)):
+            t_old = best_ns(old, args.number, args.repeat)
+            t_new = best_ns(new, args.number, args.repeat)
+            print(f"{name + ' ' + op:<34}{t_old:>12.0f}{t_new:>12.0f}{t_old / t_new:>9.2f}x")
+    for name, fn in fast_path_cases():
+        t = best_ns(fn, max(1, args.number // 100), args.repeat)
+        print(f"{name:<34}{'':>12}{t:>12.0f}")
+
+if __name__ == "__main__":
+    main()
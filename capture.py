@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import mmap
+import os
+import ssl
+import struct
+import tempfile
+import time
+from collections import Counter
+from aioquic.asyncio import connect, QuicConnectionProtocol
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+from aioquic.quic.events import StreamDataReceived, ConnectionTerminated
+from pdu import PDUType
+
+# Raw PDU capture and replay.
+#
+# The server (--capture FILE) appends every framed PDU it receives, exactly as
+# it came off the stream, with its arrival time, stream ID and a per-capture
+# connection number; the end of each connection is recorded too. Replaying a
+# capture opens one connection per recorded connection and sends the same
+# frames on the same streams, either to a live server over QUIC or straight
+# into WTCPServerProtocol.quic_event_received() in this process, at the
+# recorded pace scaled by --speed (0 = as fast as possible).
+#
+#   header: magic, version, capture start (wall clock, ns)
+#   record: arrival (ns after start), connection, stream ID, frame length, frame
+# A record with stream ID CLOSE_STREAM and no frame marks the end of a connection.
+
+CAPTURE_MAGIC = b"WTCC"
+CAPTURE_VERSION = 1
+capture_header_format = '=4s B 3x Q'
+capture_record_format = '=Q I H H'
+CLOSE_STREAM = 0xFFFF
+_HEADER = struct.Struct(capture_header_format)
+_RECORD = struct.Struct(capture_record_format)
+
+
+class CaptureWriter:
+    """
+    Appends received frames to a capture file (truncating any old one).
+
+    Writes go through a large buffer on the event loop thread, so a record
+    costs a struct pack and two buffered writes. Once start()ed, the buffer
+    is flushed every `flush_interval` seconds, so a server that is killed
+    loses at most that much of its capture; close() flushes the rest.
+    """
+
+    def __init__(self, path: str, buffer_size: int = 1 << 20, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = open(path, "wb", buffering=buffer_size)
+        self._file.write(_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, time.time_ns()))
+        self._start = time.monotonic_ns()
+        self._connections = 0
+        self._task = None
+        self.records = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def open_connection(self) -> int:
+        self._connections += 1
+        return self._connections
+
+    def record(self, connection: int, stream_id: int, frame):
+        self._file.write(_RECORD.pack(time.monotonic_ns() - self._start, connection, stream_id, len(frame)))
+        self._file.write(frame)
+        self.records += 1
+
+    def close_connection(self, connection: int):
+        self._file.write(_RECORD.pack(time.monotonic_ns() - self._start, connection, CLOSE_STREAM, 0))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._file.close()
+
+
+def read_capture(path: str):
+    """ yield (arrival_ns, connection, stream_id, frame) per record; frame is None for a close."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size < _HEADER.size:
+            raise ValueError(f"{path}: not a WTCP capture")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, _ = _HEADER.unpack_from(mm)
+            if magic != CAPTURE_MAGIC or version != CAPTURE_VERSION:
+                raise ValueError(f"{path}: not a WTCP capture")
+            offset, end = _HEADER.size, len(mm)
+            while offset + _RECORD.size <= end:
+                arrival, connection, stream_id, length = _RECORD.unpack_from(mm, offset)
+                offset += _RECORD.size
+                if offset + length > end:
+                    break  # the capture was cut off mid-record
+                if stream_id == CLOSE_STREAM:
+                    yield arrival, connection, stream_id, None
+                else:
+                    yield arrival, connection, stream_id, mm[offset:offset + length]
+                offset += length
+
+
+async def paced(records, speed: float):
+    """ yield records no earlier than their arrival time scaled by 1/speed; speed 0 = no pacing."""
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for record in records:
+        if speed > 0:
+            delay = start + record[0] / 1e9 / speed - loop.time()
+            if delay > 0.001:
+                await asyncio.sleep(delay)
+        yield record
+
+
+async def replay_in_process(path: str, speed: float, factory) -> Counter:
+    """ feed a capture into server protocols made by factory(connection), no network involved."""
+    protocols = {}
+    stats = Counter()
+    async for _, connection, stream_id, frame in paced(read_capture(path), speed):
+        protocol = protocols.get(connection)
+        if frame is None:
+            if protocol is not None:
+                protocol.quic_event_received(ConnectionTerminated(error_code=0, frame_type=None, reason_phrase=""))
+                del protocols[connection]
+            continue
+        if protocol is None:
+            protocol = protocols[connection] = factory(connection)
+            stats["connections"] += 1
+        protocol.quic_event_received(StreamDataReceived(data=frame, end_stream=False, stream_id=stream_id))
+        stats["frames"] += 1
+        stats["bytes"] += len(frame)
+    for protocol in protocols.values():
+        protocol.quic_event_received(ConnectionTerminated(error_code=0, frame_type=None, reason_phrase=""))
+    return stats
+
+
+async def replay_quic(path: str, speed: float, host: str, port: int) -> Counter:
+    """ replay a capture against a live server, one QUIC connection per recorded connection."""
+    config = QuicConfiguration(is_client=True)
+    config.verify_mode = ssl.CERT_NONE
+    queues = {}
+    tasks = []
+    stats = Counter()
+
+    async def run_connection(queue):
+        try:
+            async with connect(host, port, configuration=config, create_protocol=QuicConnectionProtocol) as client:
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    stream_id, frame = item
+                    client._quic.send_stream_data(stream_id, frame, end_stream=False)
+                    client.transmit()
+                # closing drops unacknowledged data, so wait (a while) for the acks
+                deadline = time.monotonic() + 5.0
+                while (any(len(s.sender._buffer) for s in client._quic._streams.values())
+                       and time.monotonic() < deadline):
+                    await asyncio.sleep(0.01)
+                if time.monotonic() >= deadline:
+                    stats["unacknowledged connections"] += 1
+        except ConnectionError:
+            stats["failed connections"] += 1
+
+    async for _, connection, stream_id, frame in paced(read_capture(path), speed):
+        queue = queues.get(connection)
+        if queue is None:
+            if frame is None:
+                continue
+            queue = queues[connection] = asyncio.Queue()
+            tasks.append(asyncio.create_task(run_connection(queue)))
+            stats["connections"] += 1
+        if frame is None:
+            queue.put_nowait(None)
+            del queues[connection]
+        else:
+            queue.put_nowait((stream_id, bytes(frame)))
+            stats["frames"] += 1
+            stats["bytes"] += len(frame)
+    for queue in queues.values():
+        queue.put_nowait(None)
+    await asyncio.gather(*tasks)
+    return stats
+
+
+def summarize(path: str):
+    types = Counter()
+    connections = set()
+    first = last = None
+    size = 0
+    for arrival, connection, stream_id, frame in read_capture(path):
+        first = arrival if first is None else first
+        last = arrival
+        connections.add(connection)
+        if frame is not None:
+            try:
+                types[PDUType(frame[2]).name] += 1  # the type byte follows the uint16 length
+            except ValueError:
+                types[f"unknown 0x{frame[2]:02x}"] += 1
+            size += len(frame)
+    duration = 0.0 if first is None else (last - first) / 1e9
+    print(f"{path}: {sum(types.values())} PDUs, {size} bytes, {len(connections)} connections, {duration:.1f} s")
+    for name, count in types.most_common():
+        print(f"  {name:<20} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q capture inspection and replay")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="summarize a capture")
+    info.add_argument("capture")
+    replay = commands.add_parser("replay", help="replay a capture")
+    replay.add_argument("capture")
+    replay.add_argument("--speed", type=float, default=1.0, help="pace multiplier, 0 = as fast as possible")
+    replay.add_argument("--in-process", action="store_true",
+                        help="feed the server protocol directly instead of a live server")
+    replay.add_argument("--host", default="127.0.0.1")
+    replay.add_argument("--port", type=int, default=4433)
+    replay.add_argument("--cert", default="cert.pem")
+    replay.add_argument("--key", default="key.pem")
+    replay.add_argument("--data-dir", help="persist replayed telemetry here (in-process; default: a temp dir)")
+    args = parser.parse_args()
+    if args.command == "info":
+        summarize(args.capture)
+    else:
+        stats, wall, cpu = asyncio.run(run_replay(args))
+        print(f"replayed {stats['frames']} PDUs ({stats['bytes']} bytes) on {stats['connections']} connections "
+              f"in {wall:.2f} s: {stats['frames'] / max(wall, 1e-9):,.0f} PDUs/s, {cpu:.2f} s CPU")
+        if stats["failed connections"]:
+            print(f"{stats['failed connections']} connections failed")
+        if stats["unacknowledged connections"]:
+            print(f"{stats['unacknowledged connections']} connections closed with unacknowledged data")
+
+
+async def run_replay(args):
+    wall0, cpu0 = time.monotonic(), time.process_time()
+    if not args.in_process:
+        stats = await replay_quic(args.capture, args.speed, args.host, args.port)
+        return stats, time.monotonic() - wall0, time.process_time() - cpu0
+
+    # the same components as server.main(), minus the network and the console
+    from emergency import EmergencyPipeline
+    from geofence import GeofenceEngine
+    from persistence import PersistencePipeline
+    from server import WTCPServerProtocol
+    from sessions import SessionAllocator, SessionRegistry
+
+    class ReplayServerProtocol(WTCPServerProtocol):
+        session_resumed = False
+
+        def send_encoded(self, pdu_type, data):
+            pass  # nobody to answer
+
+        def transmit(self):
+            pass
+
+    cfg = QuicConfiguration(is_client=False)
+    cfg.load_cert_chain(args.cert, args.key)
+    with tempfile.TemporaryDirectory(prefix="wtcp-replay-") as tmp:
+        persistence = PersistencePipeline(args.data_dir or tmp)
+        persistence.start()
+        emergency = EmergencyPipeline(persistence, sinks=[])
+        emergency.start()
+        sessions, registry, geofence = SessionAllocator(), SessionRegistry(), GeofenceEngine()
+
+        def factory(connection):
+            quic = QuicConnection(configuration=cfg, original_destination_connection_id=os.urandom(8))
+            return ReplayServerProtocol(quic, persistence=persistence, sessions=sessions, registry=registry,
+                                        emergency=emergency, geofence=geofence)
+        stats = await replay_in_process(args.capture, args.speed, factory)
+        wall, cpu = time.monotonic() - wall0, time.process_time() - cpu0
+        await emergency.close()
+        await persistence.close()
+    return stats, wall, cpu
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import asyncio
 import argparse
+import logging
+import signal
 import time
 import ssl 
 from  uuid import  UUID
 from aioquic.asyncio import connect, QuicConnectionProtocol 
 from aioquic.quic.configuration import QuicConfiguration
-from pdu import PDU, PDUType
+from pdu import PDU, PDUType, PDUFramer, CAP_COMPACT_TELEMETRY, CAP_SEQUENCE
+from codec import build_telemetry_compact
+from spool import SampleSpool
+from sequence import SequenceCounter
+from tickets import TicketCache
+from timerwheel import TimerWheel
 from state_machine import create_client_state_machine, ClientState, StateMachineError
-from aioquic.quic.events import StreamDataReceived
+from aioquic.quic.events import StreamDataReceived, ConnectionTerminated
+from metrics import REGISTRY, StreamMetrics, serve_http
 from enum import Enum, auto
 
 STREAM_IDS = {
@@ -16,51 +24,183 @@ STREAM_IDS = {
     "emergency": 4,
 }
 
+log = logging.getLogger("wtcp.client")
+stream_metrics = StreamMetrics("client", STREAM_IDS)
+_default_timers = TimerWheel()
+
 class Value(Enum):
     lat = auto()
     battery = auto()
     lon = auto()
     activity = auto()
     flag = auto()
+
+def read_sample():
+    """one telemetry sample from the device sensors."""
+    return (int(time.time()), float(Value.lat.value), float(Value.lon.value),
+            Value.activity.value, Value.battery.value, Value.flag.value)
+
+async def spool_telemetry(spool, interval):
+    """sample into the spool every interval() seconds; runs while asleep or disconnected."""
+    while True:
+        spool.append(read_sample())
+        spool.flush()
+        await asyncio.sleep(interval())
+
 class WTCPClientProtocol(QuicConnectionProtocol):
-    def __init__(self, *args, session_id, rate, **kwargs):
+    """
+    WTCP-Q device.
+
+    With batch_size > 1 samples are buffered and sent as one TELEMETRY_BATCH
+    (one QUIC packet, one radio wake-up) once batch_size samples are
+    waiting, once the oldest has waited batch_age seconds, or right before
+    an EMERGENCY. Every sample keeps its own timestamp. The server can
+    change both limits with CONTROL.
+
+    With compact=True the device offers CAP_COMPACT_TELEMETRY at AUTH and,
+    if the server accepts it, sends TELEMETRY_COMPACT (codec.py) instead of
+    the fixed layouts.
+
+    With a spool (spool.SampleSpool) samples taken while SLEEPING, and
+    those still buffered when the connection drops, go to disk. After AUTH
+    the backlog is replayed in batches of replay_batch samples at most
+    replay_rate samples/s. A batch is only queued while less than
+    replay_window bytes are unacknowledged on the telemetry stream, so the
+    replay never fills the QUIC flow-control window ahead of fresh samples.
+
+    With a sequence (sequence.SequenceCounter, shared by the connections of
+    one client run) the device offers CAP_SEQUENCE and, if accepted,
+    numbers its samples so the server drops duplicates and counts gaps.
+
+    device_uuid identifies the device in AUTH_REQUEST; a server that sees it
+    on a resumed TLS session hands back the device's previous session_id.
+
+    After AUTH two timers run on the process timer wheel: the idle timer
+    sends TERMINATE after idle_timeout seconds without a PDU from the server,
+    and the keepalive timer sends a QUIC PING whenever nothing has been sent
+    for `keepalive` seconds (0 disables it), so a sleeping device keeps its
+    connection through the QUIC idle timeout.
+    """
+    idle_timeout = 120.0
+
+    def __init__(self, *args, session_id, rate, batch_size=1, batch_age=5.0, compact=False,
+                 spool=None, replay_rate=50.0, replay_batch=50, replay_window=16 * 1024,
+                 device_uuid=None, keepalive=20.0, timers=None, geofence_radius=0.0, sequence=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.session_id = session_id
+        self.device_uuid = UUID(int=0) if device_uuid is None else device_uuid
+        self.geofence_radius = geofence_radius
         self.rate = rate
+        self.batch_size = min(batch_size, PDU.max_batch_samples)
+        self.batch_age = batch_age
+        self.capabilities = (CAP_COMPACT_TELEMETRY if compact else 0) | (CAP_SEQUENCE if sequence else 0)
+        self.compact = False  # until the server accepts it
+        self.sequence = sequence
+        self.sequenced = False
         self.state_machine = create_client_state_machine()
         self.last_pdu_time = time.time()
+        self.last_send_time = time.monotonic()
+        self.telemetry_task = None
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.replay_batch = min(replay_batch, PDU.max_batch_samples)
+        self.replay_window = replay_window
+        self.replay_task = None
+        self.timers = _default_timers if timers is None else timers
+        self.keepalive = keepalive
+        self._idle_timer = None
+        self._keepalive_timer = None
+        self.authenticated = asyncio.Event()
+        self._framers = {}
+        self._batch = []
+        self._flush_timer = None
         
     def quic_event_received(self, event):
         if isinstance(event, StreamDataReceived):
-            try: 
-                pdu = PDU.from_bytes(event.data)
-                old_state, new_state = self.state_machine.on_pdu(pdu)
-                self.last_pdu_time = time.time()
-                print(f"Transitioned from {old_state} to {new_state} with PDU: {pdu}")
-                if pdu.pdu_type == PDUType.AUTH_RESPONSE:
-                    info = PDU.parse_auth_resp(pdu.payload)
-                    self.session_id = info['session_id']
-                    #start telemetry and idle watchers
-                    asyncio.create_task(self.send_telemetry())
-                    asyncio.create_task(self.idle_watcher())
-                elif pdu.pdu_type == PDUType.CONTROL:
-                    print("Received control PDU, processing...")
-                    self.handle_control(pdu.payload)
-                elif pdu.pdu_type == PDUType.EMERGENCY:
-                    print("Emergency PDU received, transitioning to TERMINATING state.")
-                    asyncio.create_task(self.send_terminate())
-                elif pdu.pdu_type == PDUType.SLEEP: 
-                    print("Received SLEEP PDU, transitioning to SLEEPING state.")
-                    wake = PDU.parse_sleep(pdu.payload)
-                    if wake and self.state_machine.state == ClientState.SLEEPING:
-                        print("Waking up from SLEEP state.")
-                        self.telemetry_task = asyncio.create_task(self.telemetry_loop())
-                    elif not wake and self.telemetry_task:
-                        self.telemetry_task.cancel()
-                elif pdu.pdu_type == PDUType.WAKE: 
-                    pass
-            except Exception as e:
-                print(f"Error processing PDU: {e}")
+            # one event may carry several PDUs, or only part of one
+            framer = self._framers.get(event.stream_id)
+            if framer is None:
+                framer = self._framers[event.stream_id] = PDUFramer()
+            counters = stream_metrics.stream(event.stream_id)
+            counters.rx_bytes.value += len(event.data)
+            try:
+                for frame in framer.feed(event.data):
+                    counters.rx_pdus.value += 1
+                    try:
+                        start = time.perf_counter_ns()
+                        pdu = PDU.from_bytes(frame)
+                        stream_metrics.decode_us.observe((time.perf_counter_ns() - start) / 1000)
+                    except ValueError as e:
+                        stream_metrics.decode_errors.value += 1
+                        log.warning("error decoding PDU: %s", e)
+                        continue
+                    self.handle_pdu(pdu)
+            except ValueError as e:
+                # a corrupt length prefix leaves the rest of the stream unframeable
+                stream_metrics.decode_errors.value += 1
+                log.warning("error framing stream %d: %s", event.stream_id, e)
+
+        elif isinstance(event, ConnectionTerminated):
+            for task in (self.telemetry_task, self.replay_task):
+                if task is not None:
+                    task.cancel()
+            for timer in (self._idle_timer, self._keepalive_timer, self._flush_timer):
+                if timer is not None:
+                    timer.cancel()
+            self._flush_timer = None
+            if self.spool is not None and self._batch:
+                # samples that never left are kept for the next connection
+                for sample in self._batch:
+                    self.spool.append(sample)
+                self.spool.flush()
+            self._batch = []  # without a spool they are lost with the connection
+
+    def handle_pdu(self, pdu):
+        """process one complete PDU received from the server."""
+        try: 
+            old_state, new_state = self.state_machine.on_pdu(pdu)
+            self.last_pdu_time = time.time()
+            log.debug("transitioned from %s to %s with PDU: %s", old_state, new_state, pdu)
+            if pdu.pdu_type == PDUType.AUTH_RESPONSE:
+                info = PDU.parse_auth_resp(pdu.payload)
+                self.session_id = info['session_id']
+                self.compact = bool(info['capabilities'] & self.capabilities & CAP_COMPACT_TELEMETRY)
+                self.sequenced = bool(info['capabilities'] & self.capabilities & CAP_SEQUENCE)
+                #start telemetry, idle and keepalive timers
+                self.telemetry_task = asyncio.create_task(self.send_telemetry())
+                self._idle_timer = self.timers.schedule(self.idle_timeout, self.check_idle)
+                if self.keepalive:
+                    self._keepalive_timer = self.timers.schedule(self.keepalive, self.check_keepalive)
+                self.start_replay()
+                self.authenticated.set()
+            elif pdu.pdu_type == PDUType.CONTROL:
+                log.debug("received CONTROL")
+                self.handle_control(pdu.payload)
+            elif pdu.pdu_type == PDUType.EMERGENCY:
+                log.info("EMERGENCY received, transitioning to TERMINATING state")
+                asyncio.create_task(self.send_terminate())
+            elif pdu.pdu_type == PDUType.SLEEP: 
+                log.info("SLEEP received")
+                wake = PDU.parse_sleep(pdu.payload)
+                if wake and new_state == ClientState.OPERATIONAL:
+                    log.info("waking up from SLEEPING state")
+                    if self.telemetry_task:
+                        self.telemetry_task.cancel()  # the spooling loop
+                    self.telemetry_task = asyncio.create_task(self.send_telemetry())
+                    self.start_replay()
+                elif not wake and self.telemetry_task:
+                    self.telemetry_task.cancel()
+                    self.flush()
+                    if self.spool is not None:
+                        self.telemetry_task = asyncio.create_task(spool_telemetry(self.spool, lambda: self.rate))
+            elif pdu.pdu_type == PDUType.WAKE: 
+                pass
+        except StateMachineError as e:
+            # everything the server sends arrives on the control stream
+            stream_metrics.stream(STREAM_IDS['control']).rejected.value += 1
+            log.warning("error processing PDU: %s", e)
+        except Exception as e:
+            log.warning("error processing PDU: %s", e)
                 
     def stream_for(self, pdu_type):
         """Return the stream ID for the given PDU type."""
@@ -71,7 +211,7 @@ class WTCPClientProtocol(QuicConnectionProtocol):
             PDUType.TERMINATE
         ):
             return STREAM_IDS['control']
-        elif pdu_type == PDUType.TELEMETRY_REQUEST:
+        elif pdu_type in (PDUType.TELEMETRY_REQUEST, PDUType.TELEMETRY_BATCH, PDUType.TELEMETRY_COMPACT):
             return STREAM_IDS['telemetry']
         elif pdu_type == PDUType.EMERGENCY:
             return STREAM_IDS['emergency']
@@ -81,24 +221,108 @@ class WTCPClientProtocol(QuicConnectionProtocol):
         
     async def send_pdu(self, pdu):
         sid = self.stream_for(pdu.pdu_type)
-        self._quic.send_stream_data(sid, pdu.to_bytes(), end_stream=False)
+        data = pdu.to_bytes()
+        counters = stream_metrics.stream(sid)
+        counters.tx_pdus.value += 1
+        counters.tx_bytes.value += len(data)
+        self._quic.send_stream_data(sid, data, end_stream=False)
+        self.last_send_time = time.monotonic()
+        self.transmit()
 
     async def send_auth(self):
-        # replace UUID(int=0) with real device UUID
-        pdu = PDU.build_auth_req(UUID(int=0), sampling_rate=int(self.rate), geofence_radius=0.0)
+        pdu = PDU.build_auth_req(self.device_uuid, sampling_rate=int(self.rate),
+                                 geofence_radius=self.geofence_radius,
+                                 capabilities=self.capabilities)
         await self.send_pdu(pdu)
         self.state_machine.on_pdu(pdu)
 
     async def send_telemetry(self):
         while self.state_machine.state == ClientState.OPERATIONAL:
-            timestamp = int(time.time())
-            pdu = PDU.build_telemetry(self.session_id,timestamp, lat= float(Value.lat.value), lon=float(Value.lon.value),
-                                      activity=(Value.activity.value), battery=Value.battery.value, diag_flags=Value.flag.value)
-            sid = self.stream_for(pdu.pdu_type)
-            print(f"Sending telemetry PDU on stream(ts= {timestamp}) {sid}: {pdu}")
-            await self.send_pdu(pdu)
+            sample = read_sample()
+            timestamp = sample[0]
+            if self.batch_size > 1:
+                self.buffer_sample(sample)
+            else:
+                seq = self.take_seq(1)
+                if self.compact:
+                    pdu = build_telemetry_compact(self.session_id, [sample], seq)
+                else:
+                    pdu = PDU.build_telemetry(self.session_id, *sample, seq=seq)
+                log.debug("sending telemetry PDU (ts=%d): %s", timestamp, pdu)
+                await self.send_pdu(pdu)
             await asyncio.sleep(self.rate)
 
+    def start_replay(self):
+        if self.spool is not None and len(self.spool) and (self.replay_task is None or self.replay_task.done()):
+            log.info("replaying %d spooled samples", len(self.spool))
+            self.replay_task = asyncio.create_task(self.replay_spool())
+
+    def unacked_bytes(self, sid: int) -> int:
+        """bytes queued on stream sid that the server has not acknowledged yet."""
+        stream = self._quic._streams.get(sid)
+        return 0 if stream is None else len(stream.sender._buffer)
+
+    async def replay_spool(self):
+        sid = STREAM_IDS['telemetry']
+        while len(self.spool) and self.state_machine.state == ClientState.OPERATIONAL:
+            if self.unacked_bytes(sid) >= self.replay_window:
+                await asyncio.sleep(0.05)  # wait for acks
+                continue
+            samples = self.spool.peek(self.replay_batch)
+            seq = self.take_seq(len(samples))
+            if self.compact:
+                pdu = build_telemetry_compact(self.session_id, samples, seq)
+            else:
+                pdu = PDU.build_telemetry_batch(self.session_id, samples, seq)
+            await self.send_pdu(pdu)
+            self.spool.consume(len(samples))
+            await asyncio.sleep(len(samples) / self.replay_rate)
+        self.spool.flush()
+        log.info("replay done, %d samples left in the spool", len(self.spool))
+
+    def take_seq(self, n: int):
+        """sequence number of the first of n samples about to be sent, None without CAP_SEQUENCE."""
+        return self.sequence.take(n) if self.sequenced else None
+
+    def buffer_sample(self, sample):
+        """queue one sample for the next TELEMETRY_BATCH, flushing when the batch is full."""
+        self._batch.append(sample)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(self.batch_age, self.flush)
+
+    def flush(self):
+        """send every buffered sample now."""
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        if not self._batch:
+            return
+        samples, self._batch = self._batch, []
+        seq = self.take_seq(len(samples))
+        if self.compact:
+            pdu = build_telemetry_compact(self.session_id, samples, seq)
+        else:
+            pdu = PDU.build_telemetry_batch(self.session_id, samples, seq)
+        log.debug("sending %s of %d samples", pdu.pdu_type.name, len(samples))
+        self._quic.send_stream_data(STREAM_IDS['telemetry'], pdu.to_bytes(), end_stream=False)
+        counters = stream_metrics.stream(STREAM_IDS['telemetry'])
+        counters.tx_pdus.value += 1
+        counters.tx_bytes.value += pdu.encoded_size
+        self.last_send_time = time.monotonic()
+        self.transmit()
+
+    async def send_emergency(self, alert_code: int, details: str = ""):
+        # buffered samples go first so the server sees the lead-up to the alert
+        self.flush()
+        pdu = PDU.build_emergency(self.session_id, int(time.time()), alert_code, details)
+        await self.send_pdu(pdu)
+        try:
+            self.state_machine.on_pdu(pdu)  # OPERATIONAL -> TERMINATING stops the telemetry loop
+        except StateMachineError:
+            pass
+
     async def send_terminate(self):
         pdu = PDU(PDUType.TERMINATE, version=1, session_id=self.session_id)
         await self.send_pdu(pdu)
@@ -109,39 +333,181 @@ class WTCPClientProtocol(QuicConnectionProtocol):
         if 'sampling_rate' in params:
             old = self.rate
             self.rate = params['sampling_rate']
-            print(f"Sampling rate updated: {old} → {self.rate}")
+            log.info("sampling rate updated: %s -> %s", old, self.rate)
         if 'geofence_radius' in params:
-            print(f"Geofence radius updated: {params['geofence_radius']}")
+            self.geofence_radius = params['geofence_radius']
+            log.info("geofence radius updated: %s", self.geofence_radius)
+        if 'batch_age_ms' in params:
+            self.batch_age = params['batch_age_ms'] / 1000
+            log.info("batch age updated: %ss", self.batch_age)
+        if 'batch_size' in params:
+            self.batch_size = max(1, min(params['batch_size'], PDU.max_batch_samples))
+            log.info("batch size updated: %d", self.batch_size)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
 
-    async def idle_watcher(self):
-        while self.state_machine.state == ClientState.OPERATIONAL:
-            await asyncio.sleep(1)
-            if time.time() - self.last_pdu_time > 120:
-                print("Idle timeout — sending TERMINATE")
-                await self.send_terminate()
-                break
+    def check_idle(self):
+        """idle timer: re-armed for the rest of the timeout until it really expires."""
+        state = self.state_machine.state
+        if state not in (ClientState.OPERATIONAL, ClientState.SLEEPING):
+            return
+        idle = time.time() - self.last_pdu_time
+        if idle < self.idle_timeout:
+            self._idle_timer = self.timers.schedule(self.idle_timeout - idle, self.check_idle)
+        elif state == ClientState.SLEEPING:
+            self._idle_timer = self.timers.schedule(self.idle_timeout, self.check_idle)
+        else:
+            log.info("idle timeout, sending TERMINATE")
+            asyncio.create_task(self.send_terminate())
+
+    def check_keepalive(self):
+        state = self.state_machine.state
+        if state not in (ClientState.OPERATIONAL, ClientState.SLEEPING):
+            return
+        quiet = time.monotonic() - self.last_send_time
+        if quiet >= self.keepalive:
+            self._quic.send_ping(0)
+            self.transmit()
+            self.last_send_time = time.monotonic()
+            quiet = 0.0
+        self._keepalive_timer = self.timers.schedule(self.keepalive - quiet, self.check_keepalive)
 
 def main():
     parser = argparse.ArgumentParser(description="WTCP-Q Client")
     parser.add_argument("--host", default="127.0.0.1")
     parser.add_argument("--port", type=int, default=4433)
     parser.add_argument("--session-id", type=int, required=True)
+    parser.add_argument("--device-uuid", type=UUID, help="device UUID sent in AUTH (default: derived from --session-id)")
+    parser.add_argument("--ticket-file", help="keep the TLS session ticket here so a restarted client resumes "
+                                                "with 0-RTT")
     parser.add_argument("--rate", type=float, default=1.0, help="Telemetry interval (s)")
+    parser.add_argument("--geofence", type=float, default=0.0,
+                        help="ask the server to fence the device within this many metres of where it starts")
+    parser.add_argument("--batch", type=int, default=1, help="samples per TELEMETRY_BATCH (1 = send each sample)")
+    parser.add_argument("--compact", action="store_true", help="offer the compact delta telemetry codec")
+    parser.add_argument("--batch-age", type=float, default=5.0, help="max seconds a sample waits in a batch")
+    parser.add_argument("--spool", help="store-and-forward file: keep samples while asleep or disconnected, "
+                                             "reconnect and replay them")
+    parser.add_argument("--spool-capacity", type=int, default=SampleSpool.default_capacity,
+                        help="samples the spool holds before dropping the oldest")
+    parser.add_argument("--keepalive", type=float, default=20.0,
+                        help="PING after this many quiet seconds (0 = off)")
+    parser.add_argument("--connect-timeout", type=float, default=10.0, help="seconds to wait for the handshake")
+    parser.add_argument("--replay-rate", type=float, default=50.0, help="spooled samples replayed per second")
+    parser.add_argument("--metrics-port", type=int, default=0, help="Prometheus /metrics port (0 = off)")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every PDU")
     cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
 
     config = QuicConfiguration(is_client=True)
     config.verify_mode = ssl.CERT_NONE  # Disable cert verification for testing
     asyncio.run(run(cli_args, config))
 
 async def run(cli_args, config):
-    async with connect(
-        cli_args.host,
-        cli_args.port,
-        configuration=config,
-        create_protocol=lambda *p_args, **p_kwargs: WTCPClientProtocol(*p_args, session_id=cli_args.session_id, rate=cli_args.rate, **p_kwargs)
-    ) as client:
-        await client.send_auth()
-        await client.wait_closed()
+    if cli_args.metrics_port:
+        await serve_http(port=cli_args.metrics_port)
+    spool = None
+    if cli_args.spool:
+        spool = SampleSpool(cli_args.spool, cli_args.spool_capacity)
+        REGISTRY.gauge("wtcp_client_spool_backlog", "samples waiting in the spool", function=spool.__len__)
+        REGISTRY.gauge("wtcp_client_spool_dropped", "samples overwritten in a full spool",
+                       function=lambda: spool.dropped)
+        if len(spool):
+            log.info("spool %s holds %d samples", spool.path, len(spool))
+    tickets = TicketCache(cli_args.ticket_file)
+    device_uuid = cli_args.device_uuid or UUID(int=cli_args.session_id)
+    sequence = SequenceCounter()  # numbering goes on across reconnects
+    loop = asyncio.get_running_loop()
+    current = []  # the live connection, if any
+    alarms = []
+    stopping = asyncio.Event()
+
+    async def emergency(client):
+        await client.send_emergency(1, "manual alert")
+        await asyncio.sleep(0.5)  # give the alert time to leave before closing
+        client.close()
+
+    def on_interrupt():
+        # first Ctrl-C raises the alarm, a second one exits
+        if alarms or not current:
+            alarms.append(None)
+            stopping.set()
+            for client in current:
+                client.close()
+        else:
+            alarms.append(asyncio.create_task(emergency(current[0])))
+
+    loop.add_signal_handler(signal.SIGINT, on_interrupt)
+    backoff = 0.0
+    while True:
+        # with a spool, sampling goes on while disconnected and (re)connecting
+        sampler = None
+        if spool is not None:
+            sampler = asyncio.create_task(spool_telemetry(spool, lambda: cli_args.rate))
+        # resume with the last ticket if there is one (0-RTT), else a full handshake
+        config.session_ticket = tickets.get(config.server_name or cli_args.host)
+        try:
+            if backoff:
+                log.info("disconnected, reconnecting in %.0fs (%d samples spooled)", backoff, len(spool))
+                try:
+                    await asyncio.wait_for(stopping.wait(), backoff)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            async with connect(
+                cli_args.host,
+                cli_args.port,
+                configuration=config,
+                create_protocol=lambda *p_args, **p_kwargs: WTCPClientProtocol(*p_args, session_id=cli_args.session_id, rate=cli_args.rate,
+                                                                               batch_size=cli_args.batch, batch_age=cli_args.batch_age,
+                                                                               compact=cli_args.compact, spool=spool,
+                                                                               replay_rate=cli_args.replay_rate,
+                                                                               device_uuid=device_uuid,
+                                                                               keepalive=cli_args.keepalive,
+                                                                               geofence_radius=cli_args.geofence,
+                                                                               sequence=sequence, **p_kwargs),
+                session_ticket_handler=tickets.put,
+                wait_connected=False,
+            ) as client:
+                current.append(client)
+                early = config.session_ticket is not None
+                if early:
+                    # AUTH_REQUEST leaves as early data with the ClientHello; if the server
+                    # rejects the ticket aioquic resends it after the full handshake
+                    await client.send_auth()
+                else:
+                    client.transmit()  # wait_connected=False leaves the Initial packet unsent
+                connected = asyncio.ensure_future(client.wait_connected())
+                if not (await asyncio.wait([connected], timeout=cli_args.connect_timeout))[0]:
+                    client.close()
+                    try:
+                        await connected
+                    except ConnectionError:
+                        pass
+                    raise ConnectionError("handshake timed out")
+                connected.result()
+                if not early:
+                    await client.send_auth()
+                closed = asyncio.create_task(client.wait_closed())
+                authed = asyncio.create_task(client.authenticated.wait())
+                await asyncio.wait([closed, authed], return_when=asyncio.FIRST_COMPLETED)
+                authed.cancel()
+                if sampler is not None:
+                    sampler.cancel()
+                if client.authenticated.is_set():
+                    backoff = 0.0
+                await closed
+        except ConnectionError as e:
+            log.warning("connection failed: %s", e)
+        finally:
+            current.clear()
+            if sampler is not None:
+                sampler.cancel()
+        if spool is None or alarms:
+            break
+        backoff = min(max(backoff * 2, 1.0), 30.0)
+    if spool is not None:
+        spool.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,127 @@
+from pdu import PDU, PDUType
+
+# Compact telemetry (TELEMETRY_COMPACT, negotiated with CAP_COMPACT_TELEMETRY).
+#
+# A payload is a varint sample count followed by the samples. Each sample is
+#   change mask (1 byte): bit 0 activity, bit 1 battery, bit 2 diag_flags follow
+#   timestamp, latitude, longitude: zigzag varint deltas from the previous sample
+#   activity (varint), battery (1 byte), diag_flags (1 byte): only if in the mask
+# Coordinates are quantized to 1e-6 degree, finer than float32 resolution at
+# these magnitudes, so nothing is lost against the TELEMETRY_REQUEST layout.
+# Every payload starts from zero state (first deltas are absolute values and
+# the first mask is full), so PDUs decode independently of each other.
+# Under CAP_SEQUENCE a uint32 sequence number follows the last sample.
+
+COORD_SCALE = 1_000_000
+
+_ACTIVITY = 0x01
+_BATTERY = 0x02
+_DIAG = 0x04
+
+
+def _zigzag(n: int) -> int:
+    return (n << 1) ^ (n >> 63)
+
+
+def _unzigzag(n: int) -> int:
+    return (n >> 1) ^ -(n & 1)
+
+
+def _put_varint(out: bytearray, n: int):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _get_varint(data, i: int):
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = data[i]
+        except IndexError:
+            raise ValueError("compact telemetry truncated") from None
+        i += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, i
+        shift += 7
+        if shift > 63:
+            raise ValueError("compact telemetry varint too long")
+
+
+def encode_samples(samples) -> bytes:
+    """ samples: (timestamp, lat, lon, activity, battery, diag_flags) tuples.
+    """
+    out = bytearray()
+    _put_varint(out, len(samples))
+    ts = lat = lon = 0
+    activity = battery = diag = None
+    for timestamp, latitude, longitude, act, bat, flags in samples:
+        qlat = round(latitude * COORD_SCALE)
+        qlon = round(longitude * COORD_SCALE)
+        mask = ((act != activity) * _ACTIVITY | (bat != battery) * _BATTERY |
+                (flags != diag) * _DIAG)
+        out.append(mask)
+        _put_varint(out, _zigzag(timestamp - ts))
+        _put_varint(out, _zigzag(qlat - lat))
+        _put_varint(out, _zigzag(qlon - lon))
+        if mask & _ACTIVITY:
+            _put_varint(out, act)
+        if mask & _BATTERY:
+            out.append(bat)
+        if mask & _DIAG:
+            out.append(flags)
+        ts, lat, lon, activity, battery, diag = timestamp, qlat, qlon, act, bat, flags
+    return bytes(out)
+
+
+def decode_samples(payload) -> list:
+    """ inverse of encode_samples; raises ValueError on a malformed payload.
+    """
+    count, i = _get_varint(payload, 0)
+    if count > PDU.max_batch_samples:
+        raise ValueError(f"compact telemetry holds {count} samples, max {PDU.max_batch_samples}")
+    samples = []
+    ts = lat = lon = activity = battery = diag = 0
+    n = len(payload)
+    for _ in range(count):
+        if i >= n:
+            raise ValueError("compact telemetry truncated")
+        mask = payload[i]
+        i += 1
+        delta, i = _get_varint(payload, i)
+        ts += _unzigzag(delta)
+        delta, i = _get_varint(payload, i)
+        lat += _unzigzag(delta)
+        delta, i = _get_varint(payload, i)
+        lon += _unzigzag(delta)
+        if mask & _ACTIVITY:
+            activity, i = _get_varint(payload, i)
+            if activity > 0xFFFF:
+                raise ValueError(f"compact telemetry activity {activity} out of range")
+        if mask & (_BATTERY | _DIAG):
+            if i + bool(mask & _BATTERY) + bool(mask & _DIAG) > n:
+                raise ValueError("compact telemetry truncated")
+            if mask & _BATTERY:
+                battery = payload[i]
+                i += 1
+            if mask & _DIAG:
+                diag = payload[i]
+                i += 1
+        if not 0 <= ts < 1 << 64:
+            raise ValueError(f"compact telemetry timestamp {ts} out of range")
+        samples.append((ts, lat / COORD_SCALE, lon / COORD_SCALE, activity, battery, diag))
+    return samples
+
+
+def build_telemetry_compact(session_id: int, samples, seq: int = None) -> PDU:
+    if len(samples) > PDU.max_batch_samples:
+        raise ValueError(f"at most {PDU.max_batch_samples} samples per PDU")
+    payload = encode_samples(samples)
+    if seq is not None:
+        payload += seq.to_bytes(4, "big")
+    if PDU.header_size + len(payload) > 0xFFFF:
+        raise ValueError("compact telemetry does not fit in one PDU")
+    return PDU(PDUType.TELEMETRY_COMPACT, version=1, session_id=session_id, payload=payload)
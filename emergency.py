@@ -0,0 +1,136 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from metrics import MetricsRegistry
+from pdu import PDU
+
+# Emergencies bypass the telemetry path: each one is parsed once, written and
+# fsynced on the emergency writer thread as soon as it arrives, and handed to
+# the alert sinks by a task that does nothing else. Latency is tracked from
+# the device timestamp (epoch seconds, so only to the second; end to end,
+# includes network and clock skew) and from arrival at the server (what the
+# budget applies to).
+
+log = logging.getLogger("wtcp.emergency")
+
+
+def print_alert(alert):
+    """default sink: the server's console."""
+    print(f"***ALERT*** session {alert['session_id']} code {alert['alert_code']}: {alert['details']}")
+
+
+class EmergencyPipeline:
+    """
+    Priority queue + dispatcher for EMERGENCY PDUs.
+
+    submit() is called straight from the receive path. It starts the durable
+    append (if there is a PersistencePipeline) and queues the alert, then
+    returns; a dedicated task pops alerts in priority order, waits for them
+    to be on disk and calls every sink. Sinks are plain callables or
+    coroutine functions taking the alert dict; a failing sink is reported
+    and does not stop the others.
+
+    `priority(alert)` orders the queue, lowest first; by default alerts are
+    handled in arrival order. Alerts that take longer than `budget_ms` from
+    arrival to handled are counted in `over_budget`. The counters and
+    latency histograms are registered in `metrics` (a private registry if
+    none is given).
+    """
+
+    def __init__(self, persistence=None, sinks=None, budget_ms: float = 50.0, priority=None,
+                 metrics: MetricsRegistry = None):
+        self.persistence = persistence
+        self.sinks = [print_alert] if sinks is None else list(sinks)
+        self.budget_ms = budget_ms
+        self.priority = priority
+        metrics = MetricsRegistry() if metrics is None else metrics
+        self.device_latency = metrics.histogram("wtcp_emergency_device_latency_ms",
+                                                "device timestamp to handled, milliseconds")
+        self.handle_latency = metrics.histogram("wtcp_emergency_handle_latency_ms",
+                                                "server arrival to handled, milliseconds")
+        self.handled = metrics.counter("wtcp_emergencies_handled_total", "emergencies handed to the sinks")
+        self.over_budget = metrics.counter("wtcp_emergencies_over_budget_total",
+                                           "emergencies handled later than the budget")
+        metrics.gauge("wtcp_emergency_queue_depth", "emergencies waiting for the dispatcher", function=self.__len__)
+        self._queue = []
+        self._seq = itertools.count()
+        self._ready = None
+        self._task = None
+        self._closing = False
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def start(self):
+        self._ready = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def __len__(self):
+        return len(self._queue)
+
+    def submit(self, session_id: int, payload: bytes):
+        """ queue one EMERGENCY payload; returns the parsed alert.
+        """
+        received = time.time()
+        alert = PDU.parse_emergency(payload)
+        alert["session_id"] = session_id
+        alert["received"] = received
+        durable = None
+        if self.persistence is not None:
+            durable = self.persistence.append_emergency(session_id, payload)
+        rank = 0 if self.priority is None else self.priority(alert)
+        heapq.heappush(self._queue, (rank, next(self._seq), alert, durable))
+        if self._ready is not None:
+            self._ready.set()
+        return alert
+
+    async def _run(self):
+        while self._queue or not self._closing:
+            if not self._queue:
+                await self._ready.wait()
+                self._ready.clear()
+                continue
+            _, _, alert, durable = heapq.heappop(self._queue)
+            await self._handle(alert, durable)
+
+    async def _handle(self, alert, durable):
+        if durable is not None:
+            try:
+                await durable
+            except Exception as e:
+                log.error("emergency from session %d not persisted: %s", alert["session_id"], e)
+            except asyncio.CancelledError:
+                if not durable.cancelled():
+                    raise  # this task is being cancelled, not the write
+                log.error("emergency from session %d not persisted: write cancelled", alert["session_id"])
+        for sink in self.sinks:
+            try:
+                result = sink(alert)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                log.error("alert sink %r failed: %s", getattr(sink, "__name__", sink), e)
+        now = time.time()
+        self.handled.inc()
+        self.device_latency.observe((now - alert["timestamp"]) * 1000.0)
+        handle_ms = (now - alert["received"]) * 1000.0
+        self.handle_latency.observe(handle_ms)
+        if handle_ms > self.budget_ms:
+            self.over_budget.inc()
+            log.warning("emergency from session %d took %.1fms (budget %gms)",
+                        alert["session_id"], handle_ms, self.budget_ms)
+
+    async def close(self):
+        """ handle everything still queued, then stop the dispatcher.
+        """
+        self._closing = True
+        if self._task is None:
+            while self._queue:
+                _, _, alert, durable = heapq.heappop(self._queue)
+                await self._handle(alert, durable)
+            return
+        self._ready.set()
+        await self._task
+        self._task = None
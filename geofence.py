@@ -0,0 +1,142 @@
+import math
+from metrics import MetricsRegistry
+from pdu import PDU
+
+# Server-side geofences. Each session may have a circular fence (center and
+# radius in metres); every telemetry PDU is checked against its own session's
+# fence, so the cost is per sample and independent of the fleet size.
+# Distances use the equirectangular approximation around the fence center,
+# well under 0.5% off for fences up to tens of km. Last known positions of
+# every session are kept in a grid of cell_deg x cell_deg cells for
+# region queries (within()).
+#
+# A device that leaves its fence raises an EMERGENCY with alert code
+# GEOFENCE_ALERT; it is raised again only after the device has been seen
+# back inside.
+
+GEOFENCE_ALERT = 0x80
+METRES_PER_DEGREE = 6_371_000.0 * math.pi / 180
+
+
+class Fence:
+    __slots__ = ("lat", "lon", "radius", "kx", "inside")
+
+    def __init__(self, radius: float, lat: float = None, lon: float = None):
+        self.radius = radius
+        self.inside = True
+        self.lat = self.lon = None
+        if lat is not None:
+            self.move(lat, lon)
+
+    def move(self, lat: float, lon: float):
+        self.lat = lat
+        self.lon = lon
+        self.kx = math.cos(math.radians(lat))  # a degree of longitude, in degrees of latitude
+
+
+class GeofenceEngine:
+    """
+    Fences by session_id plus a grid index of last known positions.
+
+    observe() takes one PDU's samples as columns and returns the EMERGENCY
+    payloads to raise (at most one per call). A fence set without a center
+    is anchored at the first position observed after it.
+    """
+
+    def __init__(self, cell_deg: float = 0.01, metrics: MetricsRegistry = None):
+        self.cell_deg = cell_deg
+        self._fences = {}
+        self._positions = {}  # session_id -> (lat, lon, cell)
+        self._cells = {}      # cell -> set of session_ids
+        metrics = MetricsRegistry() if metrics is None else metrics
+        self.checked = metrics.counter("wtcp_geofence_samples_checked_total", "samples checked against a fence")
+        self.breaches = metrics.counter("wtcp_geofence_breaches_total", "devices seen leaving their fence")
+        metrics.gauge("wtcp_geofence_fences", "sessions with a fence", function=self.__len__)
+
+    def __len__(self):
+        return len(self._fences)
+
+    def fence(self, session_id: int):
+        return self._fences.get(session_id)
+
+    def set_fence(self, session_id: int, radius: float, lat: float = None, lon: float = None):
+        """ radius in metres; 0 removes the fence. Without lat/lon an existing center is kept."""
+        if radius <= 0:
+            self._fences.pop(session_id, None)
+            return
+        fence = self._fences.get(session_id)
+        if fence is None:
+            fence = self._fences[session_id] = Fence(radius)
+        fence.radius = radius
+        if lat is not None:
+            fence.move(lat, lon)
+            fence.inside = True
+
+    def remove(self, session_id: int):
+        self._fences.pop(session_id, None)
+        position = self._positions.pop(session_id, None)
+        if position is not None:
+            self._unindex(session_id, position[2])
+
+    def _cell(self, lat: float, lon: float):
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def _unindex(self, session_id, cell):
+        members = self._cells[cell]
+        members.discard(session_id)
+        if not members:
+            del self._cells[cell]
+
+    def observe(self, session_id: int, timestamps, lats, lons) -> list:
+        if not lats:
+            return []
+        lat, lon = lats[-1], lons[-1]
+        cell = self._cell(lat, lon)
+        old = self._positions.get(session_id)
+        if old is None or old[2] != cell:
+            if old is not None:
+                self._unindex(session_id, old[2])
+            self._cells.setdefault(cell, set()).add(session_id)
+        self._positions[session_id] = (lat, lon, cell)
+
+        fence = self._fences.get(session_id)
+        if fence is None:
+            return []
+        if fence.lat is None:
+            fence.move(lats[0], lons[0])
+        self.checked.value += len(lats)
+        clat, clon, kx = fence.lat, fence.lon, fence.kx
+        limit = (fence.radius / METRES_PER_DEGREE) ** 2
+        d2 = [(y - clat) ** 2 + ((x - clon) * kx) ** 2 for y, x in zip(lats, lons)]
+        if max(d2) <= limit:  # the common case: everything inside
+            fence.inside = True
+            return []
+        alerts = []
+        if fence.inside:
+            i = next(i for i, d in enumerate(d2) if d > limit)
+            distance = math.sqrt(d2[i]) * METRES_PER_DEGREE
+            self.breaches.value += 1
+            details = (f"geofence breach at {lats[i]:.6f},{lons[i]:.6f}: {distance:.0f} m from "
+                       f"{clat:.6f},{clon:.6f}, radius {fence.radius:.0f} m")
+            alerts.append(PDU.build_emergency(session_id, timestamps[i], GEOFENCE_ALERT, details).payload)
+        fence.inside = d2[-1] <= limit
+        return alerts
+
+    def within(self, lat: float, lon: float, radius: float) -> list:
+        """ session_ids whose last known position is within radius metres of lat, lon."""
+        dlat = radius / METRES_PER_DEGREE
+        kx = math.cos(math.radians(lat))
+        dlon = dlat / max(kx, 1e-6)
+        (i0, j0), (i1, j1) = self._cell(lat - dlat, lon - dlon), self._cell(lat + dlat, lon + dlon)
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._cells):
+            candidates = self._positions  # the region spans more cells than are occupied
+        else:
+            candidates = [sid for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)
+                          for sid in self._cells.get((i, j), ())]
+        limit = dlat * dlat
+        found = []
+        for sid in candidates:
+            y, x, _ = self._positions[sid]
+            if (y - lat) ** 2 + ((x - lon) * kx) ** 2 <= limit:
+                found.append(sid)
+        return sorted(found)
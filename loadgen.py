@@ -0,0 +1,370 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import math
+import ssl
+import struct
+import tempfile
+import time
+from uuid import UUID
+from aioquic.asyncio import connect, serve, QuicConnectionProtocol
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.events import StreamDataReceived
+from pdu import PDU, PDUType, PDUFramer, CAP_COMPACT_TELEMETRY, CAP_SEQUENCE
+from codec import build_telemetry_compact, decode_samples
+from persistence import PersistencePipeline
+from emergency import EmergencyPipeline
+from server import WTCPServerProtocol, STREAM_IDS, stream_metrics, handshakes, forget_released, _default_sequences
+from sequence import SequenceCounter
+from geofence import GeofenceEngine
+from rollups import RollupStore
+from capture import CaptureWriter
+from sessions import SessionAllocator, SessionRegistry
+from tickets import TicketStore, TicketCache
+from netio import LOOPS, serve_batched, use_loop
+
+# Fleet load generator: the server runs in this process on loopback with the
+# bundled cert, simulated devices run in separate processes. Devices stamp
+# samples with epoch seconds like client.py. Ingest latency needs a finer
+# clock, so every device also writes the send time of each telemetry PDU
+# into a shared ring of SEND_RING slots, indexed by the PDU's position on
+# its connection; the server side counts the PDUs of each connection the
+# same way (the stream is ordered) and measures arrival - send time.
+# Telemetry is persisted to a throwaway directory.
+#
+# With --blip-every every device drops its connection at the same instant and
+# reconnects (a reconnect storm after a network blip); with --resume devices
+# keep their TLS session ticket and send AUTH_REQUEST as 0-RTT data.
+
+LATENCY_RESERVOIR = 100_000
+SEND_RING = 64  # telemetry PDUs a device can have in flight and still be measured
+
+
+class IngestStats:
+    """PDU/sample counters and a reservoir sample of ingest latencies (ms)."""
+
+    def __init__(self):
+        self.datagrams = 0
+        self.pdus = 0
+        self.samples = 0
+        self.emergencies = 0
+        self.seen = 0
+        self.latencies = []
+
+    def record(self, latency_ms: float):
+        self.seen += 1
+        if len(self.latencies) < LATENCY_RESERVOIR:
+            self.latencies.append(latency_ms)
+        else:
+            i = random.randrange(self.seen)
+            if i < LATENCY_RESERVOIR:
+                self.latencies[i] = latency_ms
+
+    def reset_latencies(self):
+        self.seen = 0
+        self.latencies = []
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return float("nan")
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+stats = IngestStats()
+
+
+class MeasuredServerProtocol(WTCPServerProtocol):
+    sent_at = None  # the devices' send-time rings, SEND_RING slots per device index
+
+    def datagram_received(self, data, addr):
+        stats.datagrams += 1
+        super().datagram_received(data, addr)
+
+    def handle_pdu(self, sid, pdu):
+        super().handle_pdu(sid, pdu)
+        now = time.time()
+        stats.pdus += 1
+        if pdu.pdu_type == PDUType.AUTH_REQUEST:
+            self.first_slot = PDU.parse_auth_req(pdu.payload)["device_uuid"].int * SEND_RING
+            self.received = 0
+        elif pdu.pdu_type in (PDUType.TELEMETRY_REQUEST, PDUType.TELEMETRY_BATCH, PDUType.TELEMETRY_COMPACT):
+            if pdu.pdu_type == PDUType.TELEMETRY_COMPACT:
+                stats.samples += len(decode_samples(pdu.payload))
+            elif pdu.pdu_type == PDUType.TELEMETRY_BATCH:
+                stats.samples += struct.unpack_from(PDU.batch_header_format, pdu.payload)[0]
+            else:
+                stats.samples += 1
+            stats.record((now - self.sent_at[self.first_slot + self.received % SEND_RING]) * 1000)
+            self.received += 1
+        elif pdu.pdu_type == PDUType.EMERGENCY:
+            stats.emergencies += 1
+
+
+class LoadDeviceProtocol(QuicConnectionProtocol):
+    """Minimal device: authenticates, then sends whatever the driver loop asks for."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session_id = 0
+        self.compact = False
+        self.sequenced = False
+        self.authed = asyncio.Event()
+        self._framer = PDUFramer()
+        self.sent_at = None
+        self.first_slot = 0
+        self.telemetry_sent = 0
+
+    def quic_event_received(self, event):
+        if isinstance(event, StreamDataReceived) and event.stream_id == STREAM_IDS["control"]:
+            for frame in self._framer.feed(event.data):
+                pdu = PDU.from_bytes(frame)
+                if pdu.pdu_type == PDUType.AUTH_RESPONSE:
+                    info = PDU.parse_auth_resp(pdu.payload)
+                    self.session_id = info["session_id"]
+                    self.compact = bool(info["capabilities"] & CAP_COMPACT_TELEMETRY)
+                    self.sequenced = bool(info["capabilities"] & CAP_SEQUENCE)
+                    self.authed.set()
+
+    def send(self, sid, pdu):
+        self._quic.send_stream_data(sid, pdu.to_bytes(), end_stream=False)
+        self.transmit()
+
+    def send_telemetry(self, pdu):
+        self.sent_at[self.first_slot + self.telemetry_sent % SEND_RING] = time.time()
+        self.telemetry_sent += 1
+        self.send(STREAM_IDS["telemetry"], pdu)
+
+
+class DeviceCounters:
+    def __init__(self):
+        self.connects = 0
+        self.errors = 0
+        self.sent = 0
+        self.duplicated = 0
+        self.emergencies = 0
+        self.setup_ms = []  # reconnect to AUTH_RESPONSE (first telemetry can go)
+
+
+def next_blip(every: float) -> float:
+    """the next instant, on the shared monotonic clock, at which every device drops."""
+    return (math.floor(time.monotonic() / every) + 1) * every if every else math.inf
+
+
+async def run_device(index, args, deadline, counters, sent_at):
+    config = QuicConfiguration(is_client=True)
+    config.verify_mode = ssl.CERT_NONE
+    tickets = TicketCache() if args.resume else None
+    interval = 1.0 / args.rate
+    sequence = SequenceCounter() if args.sequence else None
+    connected = False
+    await asyncio.sleep(random.uniform(0, args.ramp))
+    while time.monotonic() < deadline:
+        try:
+            config.session_ticket = tickets.get(args.host) if tickets else None
+            early = config.session_ticket is not None
+            start = time.monotonic()
+            async with connect(args.host, args.port, configuration=config,
+                               create_protocol=LoadDeviceProtocol, wait_connected=not early,
+                               session_ticket_handler=tickets.put if tickets else None) as device:
+                device.sent_at, device.first_slot = sent_at, index * SEND_RING
+                # with a ticket the AUTH_REQUEST goes out as 0-RTT data with the ClientHello
+                capabilities = (CAP_COMPACT_TELEMETRY if args.compact else 0) | (CAP_SEQUENCE if sequence else 0)
+                device.send(STREAM_IDS["control"], PDU.build_auth_req(
+                    UUID(int=index), int(args.rate), args.geofence, capabilities))
+                await asyncio.wait_for(device.authed.wait(), 10)
+                if connected:
+                    counters.setup_ms.append((time.monotonic() - start) * 1000)
+                connected = True
+                counters.connects += 1
+                batch = []
+                lat, lon = 37.0 + index * 1e-4, -122.0
+                until = min(deadline, next_blip(args.blip_every))
+                while time.monotonic() < until:
+                    ts = int(time.time())
+                    if random.random() < args.emergency_prob:
+                        device.send(STREAM_IDS["emergency"],
+                                    PDU.build_emergency(device.session_id, ts, 1, "loadgen"))
+                        counters.emergencies += 1
+                        break  # the server terminates the session; reconnect
+                    # a slow random walk, like a device that is moving around
+                    lat += random.uniform(-2e-5, 2e-5)
+                    lon += random.uniform(-2e-5, 2e-5)
+                    sample = (ts, lat, lon, index % 100, 80, 0)
+                    batch.append(sample)
+                    if len(batch) >= args.batch:
+                        seq = sequence.take(len(batch)) if device.sequenced else None
+                        if device.compact:
+                            pdu = build_telemetry_compact(device.session_id, batch, seq)
+                        elif args.batch > 1:
+                            pdu = PDU.build_telemetry_batch(device.session_id, batch, seq)
+                        else:
+                            pdu = PDU.build_telemetry(device.session_id, *sample, seq=seq)
+                        device.send_telemetry(pdu)
+                        counters.sent += len(batch)
+                        if random.random() < args.duplicate_prob:
+                            device.send_telemetry(pdu)  # a buggy or replaying device
+                            counters.duplicated += len(batch)
+                        batch = []
+                    await asyncio.sleep(interval * random.uniform(0.9, 1.1))
+        except (ConnectionError, OSError, asyncio.TimeoutError):
+            counters.errors += 1
+            await asyncio.sleep(1)
+
+
+def device_process(first, count, args, deadline_in, results, sent_at):
+    async def run():
+        counters = DeviceCounters()
+        deadline = time.monotonic() + deadline_in
+        await asyncio.gather(*(run_device(first + i, args, deadline, counters, sent_at) for i in range(count)))
+        results.put(vars(counters))
+    asyncio.run(run())
+
+
+def rss_bytes() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+async def run(args):
+    cfg = QuicConfiguration(is_client=False)
+    cfg.load_cert_chain(args.cert, args.key)
+    with tempfile.TemporaryDirectory(prefix="wtcp-loadgen-") as data_dir:
+        persistence = PersistencePipeline(data_dir)
+        persistence.start()
+        # no console sink: the report below shows emergency latency instead
+        emergency = EmergencyPipeline(persistence, sinks=[], budget_ms=args.emergency_budget_ms)
+        emergency.start()
+        sessions, registry = SessionAllocator(), SessionRegistry()
+        tickets = TicketStore(on_released=forget_released(registry))
+        geofence = GeofenceEngine()
+        rollups = RollupStore()
+        capture = CaptureWriter(args.capture) if args.capture else None
+        if capture is not None:
+            capture.start()
+        quic_args = dict(configuration=cfg,
+                         create_protocol=lambda *a, **k: MeasuredServerProtocol(
+                             *a, persistence=persistence, sessions=sessions, registry=registry,
+                             emergency=emergency, geofence=geofence, capture=capture,
+                             rollups=rollups, tickets=tickets, **k))
+        if args.rx_batch:
+            server = await serve_batched(args.host, args.port, batch=args.rx_batch, **quic_args)
+        else:
+            server = await serve(args.host, args.port, **quic_args)
+
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        # written by the device processes, read here; device indexes start at 1
+        sent_at = MeasuredServerProtocol.sent_at = ctx.RawArray("d", (args.devices + 1) * SEND_RING)
+        total = args.ramp + args.warmup + args.duration
+        per_proc = [args.devices // args.processes + (i < args.devices % args.processes)
+                    for i in range(args.processes)]
+        procs = []
+        first = 1
+        for count in per_proc:
+            proc = ctx.Process(target=device_process, args=(first, count, args, total, results, sent_at))
+            proc.start()
+            procs.append(proc)
+            first += count
+
+        # measure only the steady state, after ramp-up and warm-up
+        await asyncio.sleep(args.ramp + args.warmup)
+        stats.reset_latencies()
+        pdus0, samples0, datagrams0 = stats.pdus, stats.samples, stats.datagrams
+        telemetry_bytes = stream_metrics.stream(STREAM_IDS["telemetry"]).rx_bytes
+        bytes0 = telemetry_bytes.value
+        kinds = ("full", "resumed", "early_data")
+        handshakes0 = [handshakes.labels(kind).value for kind in kinds]
+        cpu0, wall0 = time.process_time(), time.monotonic()
+        await asyncio.sleep(args.duration)
+        cpu1, wall1 = time.process_time(), time.monotonic()
+        handshake_counts = [handshakes.labels(kind).value - n for kind, n in zip(kinds, handshakes0)]
+        pdus1, samples1, datagrams1 = stats.pdus, stats.samples, stats.datagrams
+        bytes1 = telemetry_bytes.value
+        rss = rss_bytes()
+        live = len(registry)
+
+        loop = asyncio.get_running_loop()
+        device_totals = DeviceCounters()
+        for _ in procs:
+            for key, value in (await loop.run_in_executor(None, results.get)).items():
+                setattr(device_totals, key, getattr(device_totals, key) + value)
+        for proc in procs:
+            await loop.run_in_executor(None, proc.join)
+        server.close()
+        await emergency.close()
+        await persistence.close()
+        if capture is not None:
+            capture.close()
+
+    wall = wall1 - wall0
+    cpu_pct = 100 * (cpu1 - cpu0) / wall
+    print(f"devices           {args.devices} in {args.processes} process(es), {live} live sessions at end")
+    print(f"device side       {device_totals.connects} connects, {device_totals.errors} errors, "
+          f"{device_totals.sent} samples, {device_totals.emergencies} emergencies sent")
+    print(f"sustained         {(pdus1 - pdus0) / wall:,.0f} PDUs/s, {(samples1 - samples0) / wall:,.0f} samples/s")
+    print(f"server datagrams  {(datagrams1 - datagrams0) / wall:,.0f} received/s, "
+          f"{1e6 * (cpu1 - cpu0) / max(datagrams1 - datagrams0, 1):.1f} us CPU each "
+          f"({'batched receive x' + str(args.rx_batch) if args.rx_batch else 'asyncio transport'}, "
+          f"{args.loop} loop)")
+    if args.rx_batch:
+        print(f"rx batches        {server.datagrams.value / max(server.wakeups.value, 1):.2f} datagrams per wakeup")
+    print(f"telemetry wire    {(bytes1 - bytes0) / max(samples1 - samples0, 1):.1f} bytes/sample "
+          f"(stream payload, excluding QUIC overhead)")
+    print(f"ingest latency    p50 {stats.percentile(0.50):.2f} ms, p99 {stats.percentile(0.99):.2f} ms")
+    print(f"emergency         {emergency.handled.value} handled, {emergency.over_budget.value} over "
+          f"{args.emergency_budget_ms:g} ms; arrival->handled {emergency.handle_latency.summary()}")
+    if device_totals.setup_ms:
+        setup = sorted(device_totals.setup_ms)
+        print(f"reconnect         {len(setup)} reconnects to first telemetry: p50 {setup[len(setup) // 2]:.1f} ms, "
+              f"p99 {setup[min(len(setup) - 1, int(0.99 * len(setup)))]:.1f} ms")
+    print("handshakes        " + ", ".join(f"{n} {kind}" for kind, n in zip(kinds, handshake_counts)))
+    if args.geofence:
+        print(f"geofence          {geofence.checked.value} samples checked, {geofence.breaches.value} breaches")
+    print(f"rollups           {len(rollups)} devices, {rollups.samples.value} samples folded")
+    if args.sequence:
+        print(f"sequence          {device_totals.duplicated} samples sent twice, "
+              f"{_default_sequences.duplicates.value} dropped as duplicates, {_default_sequences.lost.value} lost, "
+              f"{_default_sequences.resets.value} resets")
+    print(f"server RSS        {rss / 2**20:.1f} MiB")
+    print(f"server CPU        {cpu_pct:.1f}% total, {cpu_pct / max(args.devices / 1000, 1e-9):.1f}% per 1k devices")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q fleet load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4433)
+    parser.add_argument("--cert", default="cert.pem")
+    parser.add_argument("--key", default="key.pem")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) - 1),
+                        help="device processes (the server keeps this one)")
+    parser.add_argument("--rate", type=float, default=1.0, help="samples per second per device")
+    parser.add_argument("--batch", type=int, default=1, help="samples per TELEMETRY_BATCH (1 = single PDUs)")
+    parser.add_argument("--compact", action="store_true", help="negotiate the compact delta codec")
+    parser.add_argument("--sequence", action="store_true", help="devices number their samples (CAP_SEQUENCE)")
+    parser.add_argument("--duplicate-prob", type=float, default=0.0, help="chance a telemetry PDU is sent twice")
+    parser.add_argument("--emergency-prob", type=float, default=0.0001, help="chance per tick of an EMERGENCY")
+    parser.add_argument("--emergency-budget-ms", type=float, default=50.0)
+    parser.add_argument("--geofence", type=float, default=0.0, help="fence radius in metres sent at AUTH (0 = none)")
+    parser.add_argument("--blip-every", type=float, default=0.0,
+                        help="every N seconds all devices drop and reconnect at once (0 = never)")
+    parser.add_argument("--resume", action="store_true", help="devices resume with session tickets and 0-RTT AUTH")
+    parser.add_argument("--capture", help="record the received PDUs for capture.py replay")
+    parser.add_argument("--loop", choices=LOOPS, default="asyncio", help="server event loop")
+    parser.add_argument("--rx-batch", type=int, default=0,
+                        help="server datagrams read per socket wakeup (0 = asyncio's one-datagram transport)")
+    parser.add_argument("--ramp", type=float, default=5.0, help="seconds over which devices connect")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--duration", type=float, default=20.0, help="measured seconds")
+    args = parser.parse_args()
+    use_loop(args.loop)
+    asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import logging
+
+# Process-wide metrics. Updating a metric is an attribute increment on a
+# plain object, so the receive path can afford one per PDU; labelled metrics
+# hand out one child per label value and callers keep the child around
+# instead of looking it up per PDU. Values are read by render() (Prometheus
+# text format, served by serve_http) and snapshot() (the periodic log line).
+
+log = logging.getLogger("wtcp.metrics")
+
+
+def _label_text(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+    """a value that is set, or read from `function` whenever it is collected."""
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self, name, labels):
+        yield name, labels, self.get()
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram.
+
+    counts[i] is the number of observations <= bounds[i]; the last count
+    holds everything above the largest bound.
+    """
+    kind = "histogram"
+    default_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+    def __init__(self, bounds=None):
+        self.bounds = tuple(Histogram.default_bounds if bounds is None else bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q: float) -> float:
+        """ upper bound of the bucket holding the q-th observation (max for the overflow bucket).
+        """
+        if not self.count:
+            return float("nan")
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.bounds, self.counts):
+            seen += n
+            if seen >= rank:
+                return float(bound)
+        return self.max
+
+    def summary(self, unit: str = "ms") -> str:
+        if not self.count:
+            return "no samples"
+        return (f"n={self.count} mean={self.sum / self.count:.1f}{unit} p50<={self.percentile(0.5):g}{unit} "
+                f"p99<={self.percentile(0.99):g}{unit} max={self.max:.1f}{unit}")
+
+    def samples(self, name, labels):
+        names, values = labels
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            yield name + "_bucket", (names + ("le",), values + (f"{bound:g}",)), cumulative
+        yield name + "_bucket", (names + ("le",), values + ("+Inf",)), self.count
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class Family:
+    """one metric name with a child per combination of label values."""
+
+    def __init__(self, name, help, kind, factory, labelnames=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._factory()
+        return child
+
+    def collect(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, (self.labelnames, values))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._families = {}
+
+    def _register(self, name, help, kind, factory, labelnames):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = Family(name, help, kind, factory, labelnames)
+        elif family.kind != kind or family.labelnames != tuple(labelnames):
+            raise ValueError(f"metric {name} already registered as a different {family.kind}")
+        return family if labelnames else family.labels()
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(name, help, "counter", Counter, labelnames)
+
+    def gauge(self, name, help, function=None, labelnames=()):
+        gauge = self._register(name, help, "gauge", lambda: Gauge(function), labelnames)
+        if function is not None and not labelnames:
+            gauge.function = function  # the latest owner of the name reports it
+        return gauge
+
+    def histogram(self, name, help, bounds=None, labelnames=()):
+        return self._register(name, help, "histogram", lambda: Histogram(bounds), labelnames)
+
+    def unregister(self, name):
+        self._families.pop(name, None)
+
+    def render(self) -> str:
+        """ all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for family in self._families.values():
+            lines.append(f"# HELP {family.name} {family.help}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for name, (names, values), value in family.collect():
+                lines.append(f"{name}{_label_text(names, values)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """ {name{labels}: value} for counters and gauges, {name{labels}: summary} for histograms.
+        """
+        snap = {}
+        for family in self._families.values():
+            for values, child in list(family._children.items()):
+                key = family.name + _label_text(family.labelnames, values)
+                if isinstance(child, Histogram):
+                    snap[key] = child.summary("")
+                elif isinstance(child, Gauge):
+                    snap[key] = child.get()
+                else:
+                    snap[key] = child.value
+        return snap
+
+
+REGISTRY = MetricsRegistry()
+
+
+class StreamCounters:
+    __slots__ = ("rx_pdus", "rx_bytes", "tx_pdus", "tx_bytes", "rejected")
+
+
+class StreamMetrics:
+    """
+    PDU and byte counters per stream for one side ("server" or "client"),
+    plus decode timing. stream(sid) returns the cached StreamCounters of a
+    stream, labelled with its STREAM_IDS name.
+    """
+    decode_bounds = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, side: str, stream_ids: dict, registry: MetricsRegistry = None):
+        registry = REGISTRY if registry is None else registry
+        prefix = f"wtcp_{side}"
+        self._families = (
+            registry.counter(f"{prefix}_pdus_received_total", "PDUs received per stream", ("stream",)),
+            registry.counter(f"{prefix}_bytes_received_total", "bytes received per stream", ("stream",)),
+            registry.counter(f"{prefix}_pdus_sent_total", "PDUs sent per stream", ("stream",)),
+            registry.counter(f"{prefix}_bytes_sent_total", "bytes sent per stream", ("stream",)),
+            registry.counter(f"{prefix}_state_rejections_total",
+                             "PDUs rejected by the state machine per stream", ("stream",)),
+        )
+        self.decode_us = registry.histogram(f"{prefix}_decode_us", "PDU decode time, microseconds",
+                                            StreamMetrics.decode_bounds)
+        self.decode_errors = registry.counter(f"{prefix}_decode_errors_total", "undecodable PDUs or streams")
+        self._names = {sid: name for name, sid in stream_ids.items()}
+        self._streams = {}
+
+    def stream(self, sid: int) -> StreamCounters:
+        counters = self._streams.get(sid)
+        if counters is None:
+            name = self._names.get(sid, str(sid))
+            counters = self._streams[sid] = StreamCounters()
+            for slot, family in zip(StreamCounters.__slots__, self._families):
+                setattr(counters, slot, family.labels(name))
+        return counters
+
+
+async def serve_http(host: str = "127.0.0.1", port: int = 9464, registry: MetricsRegistry = None):
+    """ serve registry.render() at http://host:port/metrics; returns the asyncio server.
+    """
+    registry = REGISTRY if registry is None else registry
+
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)).strip():
+                pass  # headers are not needed
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1] in (b"/metrics", b"/"):
+                status, body = "200 OK", registry.render().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+async def log_snapshots(interval: float, registry: MetricsRegistry = None):
+    """ log a one-line snapshot of every metric each `interval` seconds.
+    """
+    registry = REGISTRY if registry is None else registry
+    while True:
+        await asyncio.sleep(interval)
+        snap = registry.snapshot()
+        log.info("metrics %s", " ".join(f"{k}={v}" for k, v in snap.items()) or "none")
+
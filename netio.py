@@ -0,0 +1,144 @@
+import asyncio
+import socket
+from aioquic.asyncio.server import QuicServer
+from metrics import MetricsRegistry
+
+# Event loop and UDP receive options for the server.
+#
+# use_loop() picks the event loop asyncio.run() creates: the stdlib one or
+# uvloop (optional, only imported when asked for).
+#
+# asyncio's datagram transport reads one datagram per readiness callback
+# and aioquic transmits after each one, so at high packet rates every
+# datagram pays a trip through the loop and its own transmit. serve_batched()
+# instead watches the socket with add_reader() and drains up to `batch`
+# datagrams per wakeup (Python has no recvmmsg(), so this is a non-blocking
+# recvfrom() loop), feeds them all to their QUIC connections, then transmits
+# once per connection that received any. Sends that would block are dropped
+# like any lost datagram; QUIC retransmits them.
+
+LOOPS = ("asyncio", "uvloop")
+RECV_SIZE = 65535
+
+
+def use_loop(name: str):
+    """ make asyncio.run() (here and in forked workers) create a `name` loop."""
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            raise SystemExit("--loop uvloop needs the uvloop package (pip install uvloop)")
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    elif name != "asyncio":
+        raise ValueError(f"unknown event loop {name!r}, expected one of {', '.join(LOOPS)}")
+
+
+def bound_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+class SocketTransport(asyncio.DatagramTransport):
+    """ the sending half of a datagram transport, straight on a non-blocking socket."""
+
+    def __init__(self, loop, sock: socket.socket, dropped):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._dropped = dropped
+        self._closing = False
+
+    def sendto(self, data, addr=None):
+        try:
+            self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            self._dropped.value += 1
+        except OSError:
+            pass  # e.g. ICMP unreachable reported on a later send
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+
+    def abort(self):
+        self.close()
+
+
+class BatchedQuicServer(QuicServer):
+    """
+    QuicServer reading its socket itself, `batch` datagrams per wakeup, with
+    one transmit per connection per wakeup.
+    """
+
+    def __init__(self, *, sock: socket.socket, batch: int = 64, metrics: MetricsRegistry = None, **kwargs):
+        create_protocol = kwargs.pop("create_protocol")
+        super().__init__(create_protocol=self._wrap(create_protocol), **kwargs)
+        self.batch = batch
+        self._sock = sock
+        self._draining = False
+        self._pending = {}  # protocol -> its own transmit, run once the batch is in
+        metrics = MetricsRegistry() if metrics is None else metrics
+        self.datagrams = metrics.counter("wtcp_udp_rx_datagrams_total", "datagrams read by the batched receiver")
+        self.wakeups = metrics.counter("wtcp_udp_rx_wakeups_total", "socket wakeups of the batched receiver")
+        dropped = metrics.counter("wtcp_udp_tx_dropped_total", "datagrams dropped on a full socket send buffer")
+        self.connection_made(SocketTransport(self._loop, sock, dropped))
+        self._loop.add_reader(sock.fileno(), self._read_ready)
+
+    def _wrap(self, create_protocol):
+        def create(*args, **kwargs):
+            protocol = create_protocol(*args, **kwargs)
+            transmit = protocol.transmit
+
+            def deferred():
+                if self._draining:
+                    self._pending[protocol] = transmit
+                else:
+                    transmit()
+            protocol.transmit = deferred
+            return protocol
+        return create
+
+    def _read_ready(self):
+        recvfrom = self._sock.recvfrom
+        received = self.datagram_received
+        n = 0
+        self._draining = True
+        try:
+            while n < self.batch:
+                try:
+                    data, addr = recvfrom(RECV_SIZE)
+                except OSError:
+                    break  # drained (or an ICMP error queued on the socket: the rest waits for the next wakeup)
+                n += 1
+                received(data, addr)
+        finally:
+            self._draining = False
+            self.datagrams.value += n
+            self.wakeups.value += 1
+            pending, self._pending = self._pending, {}
+            for transmit in pending.values():
+                transmit()
+
+
+async def serve_batched(host: str, port: int, *, configuration, create_protocol, sock: socket.socket = None,
+                        batch: int = 64, metrics: MetricsRegistry = None, **kwargs) -> BatchedQuicServer:
+    """ aioquic's serve() with the batched receive path; `sock` (e.g. a SO_REUSEPORT one) or a fresh one."""
+    if sock is None:
+        sock = bound_socket(host, port)
+    return BatchedQuicServer(sock=sock, batch=batch, metrics=metrics, configuration=configuration,
+                             create_protocol=create_protocol, **kwargs)
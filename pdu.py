@@ -1,8 +1,9 @@
-from enum import Enum, auto
+from enum import IntEnum
 import struct
 from uuid import UUID
 
-class PDUType(Enum):
+class PDUType(IntEnum):
+    # IntEnum: members pack and hash as plain ints on the hot path
     AUTH_REQUEST = 0x01
     AUTH_RESPONSE = 0x02
     TELEMETRY_REQUEST = 0x03
@@ -11,7 +12,47 @@ class PDUType(Enum):
     SLEEP = 0x06
     WAKE = 0x07
     TERMINATE = 0x08
+    TELEMETRY_BATCH = 0x09
+    TELEMETRY_COMPACT = 0x0A
+
+# capability bits: optional trailing uint32 of AUTH_REQUEST (offered) and
+# AUTH_RESPONSE (accepted); peers that omit it support none of them
+CAP_COMPACT_TELEMETRY = 0x01
+# telemetry payloads (TELEMETRY_REQUEST, _BATCH, _COMPACT) end with a uint32
+# sequence number of their first sample; the samples that follow count up
+CAP_SEQUENCE = 0x02
     
+# precompiled layouts shared by the builders and parsers below
+_HEADER = struct.Struct('!H B B I')
+_TELEMETRY = struct.Struct('!Q f f H B B')
+_BATCH_HEADER = struct.Struct('!H')
+_AUTH_REQ = struct.Struct('!16s I f')
+_AUTH_RESP = struct.Struct('!B I')
+_EMERGENCY = struct.Struct('!Q B B')
+_TLV = struct.Struct('!B B')
+_TLV_U32 = struct.Struct('!B B I')
+_TLV_F32 = struct.Struct('!B B f')
+_U32 = struct.Struct('!I')
+_F32 = struct.Struct('!f')
+_U8 = struct.Struct('!B')
+_CAPABILITIES = _U32
+
+HEADER_SIZE = _HEADER.size
+
+# payload length -> Struct packing header and payload in one call
+_FRAMES = {}
+
+def _frame_struct(payload_len: int) -> struct.Struct:
+    frame = _FRAMES.get(payload_len)
+    if frame is None:
+        frame = struct.Struct(f"{_HEADER.format} {payload_len}s")
+        if len(_FRAMES) < 1024:
+            _FRAMES[payload_len] = frame
+    return frame
+
+# type byte -> PDUType, cheaper than PDUType(value)
+_PDU_TYPES = {t.value: t for t in PDUType}
+
 class PDU:
     """
     Represents a single WTCP-Q PDU (Protocol Data Unit).
@@ -21,82 +62,132 @@ class PDU:
     -session_id : uint32
     payload : bytes
     """
-    header_format = '!H B B I' 
-    header_size = struct.calcsize(header_format)
+    __slots__ = ("pdu_type", "version", "session_id", "payload")
+
+    header_format = _HEADER.format
+    header_size = _HEADER.size
+    header_struct = _HEADER
+    # timestamp: uint64, lat/lon: float32, activity: uint16, battery: uint8, diag_flags: uint8
+    telemetry_format = _TELEMETRY.format
+    telemetry_size = _TELEMETRY.size
+    telemetry_struct = _TELEMETRY
+    telemetry_fields = ("timestamp", "latitude", "longitude", "activity", "battery", "diag_flags")
+    # TELEMETRY_BATCH payload: sample count (uint16) then that many telemetry records
+    batch_header_format = _BATCH_HEADER.format
+    batch_header_size = _BATCH_HEADER.size
+    batch_header_struct = _BATCH_HEADER
+    max_batch_samples = (0xFFFF - header_size - batch_header_size) // telemetry_size
     
     def __init__(self, pdu_type: PDUType, version: int, session_id: int, payload: bytes = b""):
         self.pdu_type = pdu_type
         self.version = version
         self.session_id = session_id 
-        self.payload = payload
         self.payload = payload or b""
+
+    @property
+    def encoded_size(self) -> int:
+        return HEADER_SIZE + len(self.payload)
         
     def to_bytes(self) -> bytes:
         """        Serializes the PDU to bytes.
         """
-        length = PDU.header_size + len(self.payload)
-        header = struct.pack(
-            PDU.header_format, length, 
-            self.pdu_type.value, self.version, 
-            self.session_id)
-        return header + self.payload
+        n = len(self.payload)
+        return _frame_struct(n).pack(HEADER_SIZE + n, self.pdu_type, self.version, self.session_id, self.payload)
+
+    def encode_into(self, buffer, offset: int = 0) -> int:
+        """ serialize into a caller-provided writable buffer at offset; returns the offset just past the PDU.
+        """
+        n = len(self.payload)
+        _frame_struct(n).pack_into(buffer, offset, HEADER_SIZE + n, self.pdu_type, self.version,
+                                   self.session_id, self.payload)
+        return offset + HEADER_SIZE + n
     
     @classmethod
     def from_bytes(cls, data: bytes)-> "PDU":
-        """ parse bytes into PDU instance. 
+        """ parse bytes (or a memoryview) into PDU instance; the payload is a slice of data.
         """
         
-        if len(data) < PDU.header_size: 
+        if len(data) < HEADER_SIZE: 
             raise ValueError(f"incomplete header: {len(data)} bytes recieved, {cls.header_size} requred")
        
-        length, type_val, version, session_id = struct.unpack(
-            cls.header_format, data[:cls.header_size])
+        length, type_val, version, session_id = _HEADER.unpack_from(data)
         
         if len(data) < length:
             raise ValueError(f"incomplete PDU: {len(data)} bytes received, {length} required")
         
-        payload = data[cls.header_size:length]
-        
-        try: 
-            pdu_type = PDUType(type_val)
-        except ValueError:
+        pdu_type = _PDU_TYPES.get(type_val)
+        if pdu_type is None:
             raise ValueError(f"Unknown PDU type: {type_val}")
         
-        return cls(pdu_type, version, session_id, payload)
+        return cls(pdu_type, version, session_id, data[HEADER_SIZE:length])
     
     def __repr__(self):
         return (f"PDU(type={self.pdu_type.name}, version={self.version}, "
                 f"session_id={self.session_id}, payload_length={len(self.payload)})")
         
     @staticmethod
-    def build_auth_req(device_uuid: UUID, sampling_rate: int, geofence_radius: float) -> "PDU":
-        payload = device_uuid.bytes
-        payload += struct.pack("!I", sampling_rate)
-        payload += struct.pack("!f", geofence_radius)
+    def build_auth_req(device_uuid: UUID, sampling_rate: int, geofence_radius: float,
+                       capabilities: int = 0) -> "PDU":
+        payload = _AUTH_REQ.pack(device_uuid.bytes, sampling_rate, geofence_radius)
+        if capabilities:
+            payload += _CAPABILITIES.pack(capabilities)
         return PDU(PDUType.AUTH_REQUEST, version=1, session_id=0, payload=payload)
+
+    @staticmethod
+    def parse_auth_req(payload: bytes):
+        uuid_bytes, rate, radius = _AUTH_REQ.unpack_from(payload)
+        caps = 0
+        if len(payload) >= _AUTH_REQ.size + _CAPABILITIES.size:
+            (caps,) = _CAPABILITIES.unpack_from(payload, _AUTH_REQ.size)
+        return {"device_uuid": UUID(bytes=bytes(uuid_bytes)), "sampling_rate": rate,
+                "geofence_radius": radius, "capabilities": caps}
     
     @staticmethod
     def build_telemetry(session_id: int,timestamp: int, lat: float, lon: float,
-                        activity: int, battery: int, diag_flags: int) -> "PDU":
+                        activity: int, battery: int, diag_flags: int, seq: int = None) -> "PDU":
         # timestamp: uint64, lat/lon: float32, activity: uint16, battery: uint8, diag_flags: uint8
-        payload = struct.pack("!Q f f H B B",
-                              timestamp, lat, lon, activity, battery, diag_flags)
+        payload = _TELEMETRY.pack(timestamp, lat, lon, activity, battery, diag_flags)
+        if seq is not None:
+            payload += _U32.pack(seq)
         return PDU(PDUType.TELEMETRY_REQUEST, version=1,session_id= session_id, payload=payload)
 
     @staticmethod
-    def build_control(session_id: int , new_rate: int = None, new_radius: float = None) -> "PDU":
-        # CONTROL TLVs
+    def build_telemetry_batch(session_id: int, samples, seq: int = None) -> "PDU":
+        # samples: sequence of (timestamp, lat, lon, activity, battery, diag_flags) tuples
+        count = len(samples)
+        if count > PDU.max_batch_samples:
+            raise ValueError(f"too many samples for one batch: {count}, max {PDU.max_batch_samples}")
+        end = _BATCH_HEADER.size + count * _TELEMETRY.size
+        payload = bytearray(end if seq is None else end + _U32.size)
+        _BATCH_HEADER.pack_into(payload, 0, count)
+        offset = _BATCH_HEADER.size
+        pack_into = _TELEMETRY.pack_into
+        for sample in samples:
+            pack_into(payload, offset, *sample)
+            offset += _TELEMETRY.size
+        if seq is not None:
+            _U32.pack_into(payload, end, seq)
+        return PDU(PDUType.TELEMETRY_BATCH, version=1, session_id=session_id, payload=bytes(payload))
+
+    @staticmethod
+    def build_control(session_id: int , new_rate: int = None, new_radius: float = None,
+                      batch_size: int = None, batch_age_ms: int = None) -> "PDU":
+        # CONTROL TLVs; batch_size 1 turns client batching off
         tlv = b""
         if new_rate is not None:
-            tlv += struct.pack("!B B I", 0x01, 4, new_rate)
+            tlv += _TLV_U32.pack(0x01, 4, new_rate)
         if new_radius is not None:
-            tlv += struct.pack("!B B f", 0x02, 4, new_radius)
+            tlv += _TLV_F32.pack(0x02, 4, new_radius)
+        if batch_size is not None:
+            tlv += _TLV_U32.pack(0x03, 4, batch_size)
+        if batch_age_ms is not None:
+            tlv += _TLV_U32.pack(0x04, 4, batch_age_ms)
         return PDU(PDUType.CONTROL, version=1, session_id=session_id, payload=tlv)
     
     @staticmethod
     def build_sleep(session_id: int, wake: bool = False) -> "PDU":
         # No payload for sleep
-        return PDU(PDUType.SLEEP, version=1, session_id=session_id, payload=struct.pack("!B", 1 if wake else 0))
+        return PDU(PDUType.SLEEP, version=1, session_id=session_id, payload=_U8.pack(1 if wake else 0))
     
     @staticmethod
     def build_wake(session_id: int) -> "PDU":
@@ -107,47 +198,153 @@ class PDU:
     def build_emergency(session_id:int, timestamp: int, alert_code: int, details: str="") -> "PDU":
         # timestamp: uint64, alert_code: uint8, details: UTF-8 string
         detail_bytes = details.encode("utf-8")
-        payload = struct.pack("!Q B B", timestamp, alert_code, len(detail_bytes))
-        payload += detail_bytes
+        payload = _EMERGENCY.pack(timestamp, alert_code, len(detail_bytes)) + detail_bytes
         return PDU(PDUType.EMERGENCY, version=1, session_id=session_id, payload=payload)
 
     @staticmethod
     def parse_auth_resp(payload: bytes):
         # status: uint8, session_id: uint32
-        status, session_id = struct.unpack("!B I", payload[:5])
-        return {"status": status, "session_id": session_id}
+        status, session_id = _AUTH_RESP.unpack_from(payload)
+        caps = 0
+        if len(payload) >= _AUTH_RESP.size + _CAPABILITIES.size:
+            (caps,) = _CAPABILITIES.unpack_from(payload, _AUTH_RESP.size)
+        return {"status": status, "session_id": session_id, "capabilities": caps}
 
     @staticmethod
-    def build_auth_resp(status: int, session_id: int) -> "PDU":
-        payload = struct.pack("!B I", status, session_id)  
+    def build_auth_resp(status: int, session_id: int, capabilities: int = 0) -> "PDU":
+        payload = _AUTH_RESP.pack(status, session_id)
+        if capabilities:
+            payload += _CAPABILITIES.pack(capabilities)
         return PDU(PDUType.AUTH_RESPONSE, 1, session_id, payload)
 
     @staticmethod
     def parse_telemetry(payload: bytes):
-        ts, lat, lon, act, bat, flags = struct.unpack("!Q f f H B B", payload)
+        ts, lat, lon, act, bat, flags = _TELEMETRY.unpack_from(payload)
         return {"timestamp": ts, "latitude": lat, "longitude": lon,
                 "activity": act, "battery": bat, "diag_flags": flags}
 
+    @staticmethod
+    def parse_telemetry_batch(payload: bytes):
+        # decode every sample in one pass; returns one tuple per field, keyed like parse_telemetry
+        (count,) = _BATCH_HEADER.unpack_from(payload)
+        end = _BATCH_HEADER.size + count * _TELEMETRY.size
+        if len(payload) < end:
+            raise ValueError(f"truncated TELEMETRY_BATCH: {count} samples need {end} bytes, got {len(payload)}")
+        rows = _TELEMETRY.iter_unpack(memoryview(payload)[_BATCH_HEADER.size:end])
+        columns = tuple(zip(*rows)) or ((),) * len(PDU.telemetry_fields)
+        return dict(zip(PDU.telemetry_fields, columns))
+
+    @staticmethod
+    def parse_sequence(payload) -> int:
+        # the trailing sequence number of a telemetry payload sent under CAP_SEQUENCE
+        if len(payload) < _U32.size:
+            raise ValueError("telemetry payload too short for a sequence number")
+        return _U32.unpack_from(payload, len(payload) - _U32.size)[0]
+
     @staticmethod
     def parse_control(payload: bytes):
         i = 0; result = {}
         while i < len(payload):
-            t, l = struct.unpack("!B B", payload[i:i+2]); i += 2
-            v = payload[i:i+l]; i += l
+            t, l = _TLV.unpack_from(payload, i); i += 2
             if t == 0x01:
-                result["sampling_rate"] = struct.unpack("!I", v)[0]
+                result["sampling_rate"] = _U32.unpack_from(payload, i)[0]
             elif t == 0x02:
-                result["geofence_radius"] = struct.unpack("!f", v)[0]
+                result["geofence_radius"] = _F32.unpack_from(payload, i)[0]
+            elif t == 0x03:
+                result["batch_size"] = _U32.unpack_from(payload, i)[0]
+            elif t == 0x04:
+                result["batch_age_ms"] = _U32.unpack_from(payload, i)[0]
+            i += l
         return result
 
     @staticmethod
     def parse_emergency(payload: bytes):
-        ts, code, dlen = struct.unpack("!Q B B", payload[:10])
-        details = payload[10:10+dlen].decode("utf-8")
+        ts, code, dlen = _EMERGENCY.unpack_from(payload)
+        details = str(payload[_EMERGENCY.size:_EMERGENCY.size + dlen], "utf-8")
         return {"timestamp": ts, "alert_code": code, "details": details}
     
     @staticmethod
     def parse_sleep(payload: bytes):
         if len(payload) != 1:
             raise ValueError("Invalid SLEEP PDU payload length")
-        return struct.unpack("!B", payload)[0] == 1  # Returns True for wake, False for sleep
\ No newline at end of file
+        return _U8.unpack_from(payload)[0] == 1  # Returns True for wake, False for sleep
+
+
+class PDUFramer:
+    """
+    Incremental framer for one QUIC stream.
+
+    QUIC delivers stream data in arbitrary chunks: a single StreamDataReceived
+    event may carry several PDUs, or only part of one. feed() yields every
+    complete PDU in a chunk as a memoryview slice of that chunk, without copying.
+    A PDU split across chunks is stitched together in a buffer allocated for
+    it, sized to its length (a few bytes until its length prefix is in), and
+    released once it is complete, so an idle stream holds no buffer at all.
+
+    Views into the stitching buffer are only valid until the next call to
+    feed(); copy the bytes if they must outlive it. The generator must be
+    consumed fully so a trailing partial PDU is kept for the next chunk.
+    """
+    # the length prefix is the first field of PDU.header_format
+    length_prefix = struct.Struct(PDU.header_format[:2])
+    max_pdu_size = 0xFFFF
+
+    def __init__(self):
+        self._buf = None
+        self._pending = 0
+
+    def _check_length(self, length: int) -> int:
+        if length < PDU.header_size:
+            raise ValueError(f"invalid PDU length: {length} bytes, header alone is {PDU.header_size}")
+        return length
+
+    def feed(self, data):
+        """ yield every complete PDU in data (plus any partial PDU left over from earlier chunks).
+        """
+        view = memoryview(data)
+        end = len(view)
+        offset = 0
+        prefix = PDUFramer.length_prefix.size
+
+        if self._pending:
+            # finish the length prefix, then the rest of the partial PDU
+            if self._pending < prefix:
+                take = min(prefix - self._pending, end)
+                self._buf[self._pending:self._pending + take] = view[:take]
+                self._pending += take
+                offset = take
+                if self._pending < prefix:
+                    return
+            length = self._check_length(PDUFramer.length_prefix.unpack_from(self._buf)[0])
+            if len(self._buf) < length:
+                buf = memoryview(bytearray(length))
+                buf[:self._pending] = self._buf[:self._pending]
+                self._buf = buf
+            take = min(length - self._pending, end - offset)
+            self._buf[self._pending:self._pending + take] = view[offset:offset + take]
+            self._pending += take
+            offset += take
+            if self._pending < length:
+                return
+            self._pending = 0
+            buf, self._buf = self._buf, None
+            yield buf
+
+        while end - offset >= prefix:
+            length = self._check_length(PDUFramer.length_prefix.unpack_from(view, offset)[0])
+            if end - offset < length:
+                break
+            yield view[offset:offset + length]
+            offset += length
+
+        if offset < end:
+            # the loop above has checked the length if the prefix is complete
+            self._pending = end - offset
+            size = PDUFramer.length_prefix.unpack_from(view, offset)[0] if self._pending >= prefix else prefix
+            self._buf = memoryview(bytearray(size))
+            self._buf[:self._pending] = view[offset:]
+
+    @property
+    def pending(self) -> int:
+        """number of bytes of an incomplete PDU currently buffered."""
+        return self._pending
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from pdu import PDU
+
+log = logging.getLogger("wtcp.persistence")
+
+# every segment file starts with: magic, format version, record kind, record size (0 = variable)
+SEGMENT_MAGIC = b"WTSG"
+SEGMENT_VERSION = 1
+segment_header_format = '!4s B B H'
+segment_header_size = struct.calcsize(segment_header_format)
+
+KIND_TELEMETRY = 1
+KIND_EMERGENCY = 2
+
+# telemetry record: session_id (uint32) + the raw TELEMETRY_REQUEST payload
+session_prefix_format = '!I'
+_SESSION_PREFIX = struct.Struct(session_prefix_format)
+telemetry_record_size = struct.calcsize(session_prefix_format) + PDU.telemetry_size
+# emergency record: session_id (uint32), payload length (uint16), raw EMERGENCY payload
+emergency_prefix_format = '!I H'
+_EMERGENCY_PREFIX = struct.Struct(emergency_prefix_format)
+
+
+class SegmentWriter:
+    """
+    Append-only segment files <directory>/<prefix>-NNNNNN.seg.
+
+    A new segment is started every time the writer is opened and whenever the
+    current one would grow past `segment_bytes`. Fixed-size records are never
+    split across segments. `on_sealed(path)` is called for every segment that
+    is closed. All methods block and are meant to run on the persistence
+    thread, not on the event loop.
+    """
+
+    def __init__(self, directory: str, prefix: str, kind: int, record_size: int = 0,
+                 segment_bytes: int = 64 * 1024 * 1024, on_sealed=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.kind = kind
+        self.record_size = record_size
+        self.segment_bytes = segment_bytes
+        self.on_sealed = on_sealed
+        self._file = None
+        self._size = 0
+        self._seq = max(segment_numbers(directory, prefix), default=0)
+        self.path = None
+
+    def _open_next(self):
+        self.close()
+        self._seq += 1
+        self.path = os.path.join(self.directory, f"{self.prefix}-{self._seq:06d}.seg")
+        self._file = open(self.path, "xb")
+        self._file.write(struct.pack(segment_header_format, SEGMENT_MAGIC, SEGMENT_VERSION,
+                                     self.kind, self.record_size))
+        self._size = segment_header_size
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if self._file is None:
+                self._open_next()
+            room = self.segment_bytes - self._size
+            if len(view) <= room:
+                self._file.write(view)
+                self._size += len(view)
+                return
+            # fill the current segment up to a record boundary, then rotate
+            room = room // self.record_size * self.record_size if self.record_size else 0
+            if room <= 0 and self._size == segment_header_size:
+                room = len(view)   # oversized write into an empty segment
+            self._file.write(view[:room])
+            self._size += room
+            view = view[room:]
+            if view:
+                self._open_next()
+
+    def sync(self):
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+            if self.on_sealed is not None:
+                self.on_sealed(self.path)
+
+
+def segment_numbers(directory: str, prefix: str):
+    """ sequence numbers of the existing <prefix>-NNNNNN.seg files in directory.
+    """
+    numbers = []
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        head, _, seq = stem.rpartition("-")
+        if ext == ".seg" and head == prefix and seq.isdigit():
+            numbers.append(int(seq))
+    return numbers
+
+
+class PersistencePipeline:
+    """
+    Background writer for telemetry and emergencies.
+
+    submit_*() only append encoded records to an in-memory buffer, so the
+    ingest path never touches the disk. A background task swaps the buffers
+    out and writes them on a dedicated thread, with an fsync whenever
+    `fsync_bytes` have accumulated or `fsync_interval` seconds have passed,
+    whichever comes first. close() is the flush-on-shutdown hook.
+
+    A failed write is logged and its records are lost (counted in
+    `lost_bytes`); the background task carries on with the next drain. While
+    writes are slow or failing, submissions that would take the backlog past
+    `max_backlog` bytes are dropped (counted in `dropped_bytes`), so a bad
+    disk cannot grow the buffers without bound.
+
+    Emergencies have their own writer thread, so they are never queued
+    behind a telemetry write; append_emergency() writes and fsyncs one
+    record right away instead of waiting for the next drain.
+
+    `index_segment(path)`, if given, is run on a separate thread for every
+    sealed telemetry segment (see storage.build_index).
+    """
+    default_max_backlog = 64 * 1024 * 1024
+
+    def __init__(self, directory: str = "data", segment_bytes: int = 64 * 1024 * 1024,
+                 fsync_bytes: int = 1024 * 1024, fsync_interval: float = 1.0, index_segment=None,
+                 max_backlog: int = None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_bytes = fsync_bytes
+        self.fsync_interval = fsync_interval
+        self.max_backlog = PersistencePipeline.default_max_backlog if max_backlog is None else max_backlog
+        self._telemetry = bytearray()
+        self._emergency = bytearray()
+        self._index_segment = index_segment
+        # indexing a sealed segment is slow, so it must not hold up the writes behind it
+        self._indexer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wtcp-index")
+        self._writers = {
+            KIND_TELEMETRY: SegmentWriter(directory, "telemetry", KIND_TELEMETRY,
+                                          telemetry_record_size, segment_bytes,
+                                          on_sealed=self._sealed),
+            KIND_EMERGENCY: SegmentWriter(directory, "emergency", KIND_EMERGENCY, 0, segment_bytes),
+        }
+        # one thread per segment kind keeps its writes in submission order
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wtcp-persist")
+        self._emergency_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wtcp-emergency")
+        self._wakeup = None
+        self._task = None
+        self.written_bytes = 0
+        self.lost_bytes = 0
+        self.dropped_bytes = 0
+        self.write_errors = 0
+
+    def _sealed(self, path):
+        if self._index_segment is not None:
+            self._indexer.submit(self._index_segment, path)
+
+    @property
+    def backlog(self) -> int:
+        """bytes submitted but not yet handed to the writer thread."""
+        return len(self._telemetry) + len(self._emergency)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _full(self, size: int) -> bool:
+        if self.backlog + size <= self.max_backlog:
+            return False
+        self.dropped_bytes += size
+        return True
+
+    def submit_telemetry(self, session_id: int, payload: bytes):
+        if self._full(telemetry_record_size):
+            return
+        self._telemetry += _SESSION_PREFIX.pack(session_id)
+        # records are fixed size: trailing bytes (e.g. an unnegotiated sequence number) would misalign the segment
+        self._telemetry += memoryview(payload)[:PDU.telemetry_size]
+        self._check_backlog()
+
+    def submit_telemetry_batch(self, session_id: int, payload: bytes):
+        (count,) = struct.unpack_from(PDU.batch_header_format, payload)
+        if self._full(count * telemetry_record_size):
+            return
+        prefix = _SESSION_PREFIX.pack(session_id)
+        view = memoryview(payload)[PDU.batch_header_size:]
+        for offset in range(0, count * PDU.telemetry_size, PDU.telemetry_size):
+            self._telemetry += prefix
+            self._telemetry += view[offset:offset + PDU.telemetry_size]
+        self._check_backlog()
+
+    def submit_emergency(self, session_id: int, payload: bytes):
+        if self._full(_EMERGENCY_PREFIX.size + len(payload)):
+            return
+        self._emergency += _EMERGENCY_PREFIX.pack(session_id, len(payload))
+        self._emergency += payload
+        self._check_backlog()
+
+    def append_emergency(self, session_id: int, payload: bytes) -> asyncio.Future:
+        """ write and fsync one emergency record now; the returned future completes once it is durable.
+        """
+        record = _EMERGENCY_PREFIX.pack(session_id, len(payload)) + bytes(payload)
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(self._emergency_executor, self._write_emergency, record)
+
+    def _check_backlog(self):
+        if self._wakeup is not None and self.backlog >= self.fsync_bytes:
+            self._wakeup.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self._drain(loop)
+
+    async def _drain(self, loop):
+        telemetry, self._telemetry = self._telemetry, bytearray()
+        emergency, self._emergency = self._emergency, bytearray()
+        writes = []
+        if emergency:
+            writes.append((emergency, loop.run_in_executor(self._emergency_executor, self._write_emergency, emergency)))
+        if telemetry:
+            writes.append((telemetry, loop.run_in_executor(self._executor, self._write, telemetry)))
+        results = await asyncio.gather(*(write for _, write in writes), return_exceptions=True)
+        for (data, _), result in zip(writes, results):
+            if isinstance(result, Exception):
+                self.write_errors += 1
+                self.lost_bytes += len(data)
+                log.error("writing %d bytes to %s failed: %s", len(data), self.directory, result)
+
+    def _write(self, telemetry):
+        # runs on the persistence thread
+        self._writers[KIND_TELEMETRY].write(telemetry)
+        self._writers[KIND_TELEMETRY].sync()
+        self.written_bytes += len(telemetry)
+
+    def _write_emergency(self, emergency):
+        # runs on the emergency thread
+        self._writers[KIND_EMERGENCY].write(emergency)
+        self._writers[KIND_EMERGENCY].sync()
+        self.written_bytes += len(emergency)
+
+    async def close(self):
+        """ flush everything still buffered, fsync and close the segments.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        loop = asyncio.get_running_loop()
+        await self._drain(loop)
+        await loop.run_in_executor(self._executor, self._writers[KIND_TELEMETRY].close)
+        await loop.run_in_executor(self._emergency_executor, self._writers[KIND_EMERGENCY].close)
+        self._executor.shutdown(wait=True)
+        self._emergency_executor.shutdown(wait=True)
+        await loop.run_in_executor(None, self._indexer.shutdown, True)
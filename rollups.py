@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from functools import reduce
+from operator import or_
+from metrics import MetricsRegistry
+from pdu import PDU
+
+# Ingest-time rollups. Every telemetry PDU updates, for its session, the
+# last known sample and one bucket per resolution (a minute and an hour by
+# default) holding count, min, max and sum of battery and activity plus the
+# OR of diag_flags. Buckets are keyed by device time, so a spooled backlog
+# replayed after a reconnect lands in the minutes it was sampled in. Each
+# session keeps its newest `retention` buckets per resolution, and at most
+# max_sessions sessions are tracked (the least recently updated go first),
+# so memory is bounded by the fleet size, not by the sample count; dashboard
+# queries read these instead of re-aggregating raw samples.
+
+RESOLUTIONS = {"minute": 60, "hour": 3600}
+
+
+class Bucket:
+    __slots__ = ("start", "count", "battery_min", "battery_max", "battery_sum",
+                 "activity_min", "activity_max", "activity_sum", "diag_flags")
+
+    def __init__(self, start: int):
+        self.start = start  # epoch seconds
+        self.count = 0
+        self.battery_min = self.activity_min = None
+        self.battery_max = self.activity_max = None
+        self.battery_sum = self.activity_sum = 0
+        self.diag_flags = 0
+
+    def add(self, activity, battery, diag_flags):
+        """ fold in columns of samples (any sequences of equal length)."""
+        n = len(battery)
+        lo, hi = min(battery), max(battery)
+        self.battery_min = lo if self.battery_min is None else min(self.battery_min, lo)
+        self.battery_max = hi if self.battery_max is None else max(self.battery_max, hi)
+        lo, hi = min(activity), max(activity)
+        self.activity_min = lo if self.activity_min is None else min(self.activity_min, lo)
+        self.activity_max = hi if self.activity_max is None else max(self.activity_max, hi)
+        self.battery_sum += sum(battery)
+        self.activity_sum += sum(activity)
+        self.diag_flags |= reduce(or_, set(diag_flags))
+        self.count += n
+
+    def add_one(self, activity, battery, diag_flags):
+        if self.count:
+            if battery < self.battery_min:
+                self.battery_min = battery
+            elif battery > self.battery_max:
+                self.battery_max = battery
+            if activity < self.activity_min:
+                self.activity_min = activity
+            elif activity > self.activity_max:
+                self.activity_max = activity
+        else:
+            self.battery_min = self.battery_max = battery
+            self.activity_min = self.activity_max = activity
+        self.battery_sum += battery
+        self.activity_sum += activity
+        self.diag_flags |= diag_flags
+        self.count += 1
+
+    def merge(self, other: "Bucket"):
+        if not self.count:
+            self.battery_min, self.battery_max = other.battery_min, other.battery_max
+            self.activity_min, self.activity_max = other.activity_min, other.activity_max
+        else:
+            self.battery_min = min(self.battery_min, other.battery_min)
+            self.battery_max = max(self.battery_max, other.battery_max)
+            self.activity_min = min(self.activity_min, other.activity_min)
+            self.activity_max = max(self.activity_max, other.activity_max)
+        self.battery_sum += other.battery_sum
+        self.activity_sum += other.activity_sum
+        self.diag_flags |= other.diag_flags
+        self.count += other.count
+
+    def as_dict(self) -> dict:
+        return {
+            "start": self.start, "count": self.count,
+            "battery_min": self.battery_min, "battery_max": self.battery_max,
+            "battery_mean": self.battery_sum / self.count,
+            "activity_min": self.activity_min, "activity_max": self.activity_max,
+            "activity_mean": self.activity_sum / self.count,
+            "diag_flags": self.diag_flags,
+        }
+
+
+class RollupStore:
+    """
+    Per-session rollups, updated by add_sample() / add_columns() on ingest.
+
+    latest() and status() cost O(sessions); series() costs O(buckets kept)
+    for one session, or O(sessions * buckets kept) for the whole fleet.
+    """
+    default_retention = {"minute": 120, "hour": 48}
+    default_max_sessions = 100_000
+
+    def __init__(self, retention: dict = None, max_sessions: int = None, metrics: MetricsRegistry = None):
+        self.retention = dict(RollupStore.default_retention if retention is None else retention)
+        for name in self.retention:
+            if name not in RESOLUTIONS:
+                raise ValueError(f"unknown resolution {name!r}, expected one of {', '.join(RESOLUTIONS)}")
+        self.max_sessions = RollupStore.default_max_sessions if max_sessions is None else max_sessions
+        self._latest = OrderedDict()  # session_id -> (sample tuple, samples seen), least recently updated first
+        self._buckets = {}            # (resolution, session_id) -> {start: Bucket}
+        metrics = MetricsRegistry() if metrics is None else metrics
+        self.samples = metrics.counter("wtcp_rollup_samples_total", "samples folded into rollups")
+        self.late = metrics.counter("wtcp_rollup_late_samples_total",
+                                    "samples older than every bucket kept for their session")
+        metrics.gauge("wtcp_rollup_sessions", "sessions with rollups", function=self.__len__)
+
+    def __len__(self):
+        return len(self._latest)
+
+    def add_sample(self, session_id: int, payload):
+        """ one raw TELEMETRY_REQUEST payload."""
+        self.add_row(session_id, PDU.telemetry_struct.unpack_from(payload))
+
+    def add_row(self, session_id: int, sample):
+        """ one sample tuple ordered like PDU.telemetry_fields."""
+        self.samples.value += 1
+        self._touch(session_id, sample, 1)
+        second = int(sample[0])
+        _, _, _, activity, battery, flags = sample
+        for name, keep in self.retention.items():
+            start = second - second % RESOLUTIONS[name]
+            buckets = self._buckets.get((name, session_id))
+            bucket = None if buckets is None else buckets.get(start)
+            if bucket is None:
+                self._fold((name, session_id), keep, start, (activity,), (battery,), (flags,))
+            else:
+                bucket.add_one(activity, battery, flags)
+
+    def add_columns(self, session_id: int, columns):
+        """ samples as columns ordered like PDU.telemetry_fields (parse_telemetry_batch values)."""
+        timestamps, lats, lons, activity, battery, flags = columns
+        n = len(timestamps)
+        if not n:
+            return
+        self.samples.value += n
+        newest = max(range(n), key=timestamps.__getitem__) if n > 1 else 0
+        self._touch(session_id, tuple(column[newest] for column in columns), n)
+
+        seconds = [int(timestamps[0]), int(timestamps[-1])]
+        for name, keep in self.retention.items():
+            width = RESOLUTIONS[name]
+            key = (name, session_id)
+            if seconds[0] // width == seconds[1] // width:
+                # the usual case: the whole PDU (samples are in time order) falls in one bucket
+                self._fold(key, keep, seconds[0] - seconds[0] % width, activity, battery, flags)
+                continue
+            groups = {}
+            for i, t in enumerate(timestamps):
+                second = int(t)
+                groups.setdefault(second - second % width, []).append(i)
+            for start, rows in groups.items():
+                self._fold(key, keep, start, [activity[i] for i in rows], [battery[i] for i in rows],
+                           [flags[i] for i in rows])
+
+    def _touch(self, session_id, sample, n):
+        entry = self._latest.get(session_id)
+        if entry is None:
+            self._latest[session_id] = (sample, n)
+            while len(self._latest) > self.max_sessions:
+                self.forget(next(iter(self._latest)))
+        else:
+            if sample[0] < entry[0][0]:
+                sample = entry[0]  # a replayed backlog does not move the device back in time
+            self._latest[session_id] = (sample, entry[1] + n)
+            self._latest.move_to_end(session_id)
+
+    def _fold(self, key, keep, start, activity, battery, flags):
+        buckets = self._buckets.get(key)
+        if buckets is None:
+            buckets = self._buckets[key] = {}
+        bucket = buckets.get(start)
+        if bucket is None:
+            if len(buckets) >= keep:
+                oldest = min(buckets)
+                if start < oldest:
+                    self.late.value += len(battery)
+                    return
+                del buckets[oldest]
+            bucket = buckets[start] = Bucket(start)
+        bucket.add(activity, battery, flags)
+
+    def forget(self, session_id: int):
+        self._latest.pop(session_id, None)
+        for name in self.retention:
+            self._buckets.pop((name, session_id), None)
+
+    def latest(self, sessions=None) -> dict:
+        """ {session_id: last known sample as a dict plus "samples"} for sessions (None = all)."""
+        selected = self._latest if sessions is None else [s for s in sessions if s in self._latest]
+        result = {}
+        for session_id in selected:
+            sample, count = self._latest[session_id]
+            state = dict(zip(PDU.telemetry_fields, sample))
+            state["samples"] = count
+            result[session_id] = state
+        return result
+
+    def series(self, resolution: str, session_id: int = None, since: int = None) -> list:
+        """ bucket dicts oldest first, since epoch second `since`; session None merges the fleet."""
+        if resolution not in self.retention:
+            raise ValueError(f"no {resolution!r} rollups kept")
+        if session_id is not None:
+            buckets = self._buckets.get((resolution, session_id), {})
+        else:
+            buckets = {}
+            for (name, _), kept in self._buckets.items():
+                if name != resolution:
+                    continue
+                for start, bucket in kept.items():
+                    total = buckets.get(start)
+                    if total is None:
+                        total = buckets[start] = Bucket(start)
+                    total.merge(bucket)
+        return [buckets[start].as_dict() for start in sorted(buckets)
+                if since is None or start >= since]
+
+    def status(self, low_battery: int = 20) -> dict:
+        """ fleet summary from the last known samples only."""
+        samples = [sample for sample, _ in self._latest.values()]
+        if not samples:
+            return {"devices": 0}
+        battery = [s[4] for s in samples]
+        return {
+            "devices": len(samples),
+            "battery_min": min(battery),
+            "battery_mean": sum(battery) / len(battery),
+            "low_battery": sorted(sid for sid, (s, _) in self._latest.items() if s[4] < low_battery),
+            "diag_flags": reduce(or_, {s[5] for s in samples}),
+            "newest": max(s[0] for s in samples),
+            "oldest": min(s[0] for s in samples),
+        }
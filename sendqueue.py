@@ -0,0 +1,164 @@
+import asyncio
+from collections import deque
+from metrics import MetricsRegistry
+from pdu import PDU, PDUType
+
+# Outbound scheduling for one connection.
+#
+# PDUs are queued per stream and moved into the QUIC stream buffers by
+# drain(), which the protocol runs at the start of every transmit(); a
+# push() also schedules one transmit for the current event loop tick, so a
+# burst of sends (a fan-out command, a WAKE round) costs a single transmit
+# per connection. Urgent streams (control, emergency) are drained first,
+# but every stream only while the connection's unacknowledged bytes stay
+# under max_buffered; beyond that PDUs wait here for ACKs. A backlog over
+# max_buffered drops its oldest expendable PDUs: bulk-stream PDUs and WAKEs
+# (a WAKE is also skipped while another is last in line). AUTH_RESPONSE,
+# CONTROL, SLEEP and TERMINATE change the device's state and are never
+# dropped; they only come from the handshake and the operator, and
+# CONTROLs merge (below). So a slow or vanished peer costs about twice
+# max_buffered of memory.
+#
+# A CONTROL pushed while another one is still queued, with nothing queued
+# after it on its stream, is merged into it parameter by parameter with the
+# latest value winning, so repeated rate or fence changes to a slow peer
+# never pile up. A CONTROL behind a queued SLEEP (or anything else) is
+# queued on its own, so the device still sees them in order.
+
+_default_metrics = MetricsRegistry()
+
+
+def control_tlvs(payload) -> dict:
+    """ {type: raw TLV bytes} of a CONTROL payload."""
+    tlvs = {}
+    i = 0
+    while i + 2 <= len(payload):
+        end = i + 2 + payload[i + 1]
+        tlvs[payload[i]] = bytes(payload[i:end])
+        i = end
+    return tlvs
+
+
+def encode_control(header, tlvs) -> bytes:
+    payload = b"".join(tlvs.values())
+    _, pdu_type, version, session_id = PDU.header_struct.unpack(header)
+    return PDU.header_struct.pack(PDU.header_struct.size + len(payload), pdu_type, version, session_id) + payload
+
+
+def entry_size(entry) -> int:
+    """ bytes of a queued PDU; a pending CONTROL counts as its encoded size."""
+    if isinstance(entry, list):
+        return PDU.header_struct.size + sum(len(tlv) for tlv in entry[1].values())
+    return len(entry)
+
+
+class SendQueue:
+    """
+    push(stream_id, pdu_type, data) queues an encoded PDU; drain() hands
+    what may go now to `quic`; `transmit` is called once per tick with
+    anything queued.
+    """
+    default_max_buffered = 64 * 1024
+
+    def __init__(self, quic, transmit, urgent=(), max_buffered: int = None, metrics: MetricsRegistry = None):
+        self._quic = quic
+        self._transmit = transmit
+        self.urgent = tuple(urgent)
+        self.max_buffered = SendQueue.default_max_buffered if max_buffered is None else max_buffered
+        self._queues = {sid: deque() for sid in self.urgent}  # urgent streams come first
+        self._queued_bytes = 0
+        self._scheduled = False
+        metrics = _default_metrics if metrics is None else metrics
+        self.coalesced = metrics.counter("wtcp_send_control_coalesced_total",
+                                         "CONTROL PDUs merged into one that was still queued")
+        self.held = metrics.counter("wtcp_send_backpressure_total",
+                                    "drains that held PDUs back for a peer over its buffer cap")
+        self.dropped = metrics.counter("wtcp_send_dropped_total",
+                                       "queued bulk PDUs and WAKEs dropped for a peer over its buffer cap")
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues.values())
+
+    @property
+    def buffered(self) -> int:
+        """ bytes queued here plus bytes QUIC has not had acknowledged yet."""
+        return self._queued_bytes + self.unacknowledged()
+
+    def unacknowledged(self) -> int:
+        return sum(len(s.sender._buffer) for s in self._quic._streams.values())
+
+    def push(self, stream_id: int, pdu_type, data):
+        queue = self._queues.get(stream_id)
+        if queue is None:
+            queue = self._queues[stream_id] = deque()
+        if pdu_type == PDUType.CONTROL:
+            # a queued CONTROL is a [header, {type: tlv}] list, encoded when drained
+            header, payload = bytes(data[:PDU.header_struct.size]), data[PDU.header_struct.size:]
+            if queue and isinstance(queue[-1], list):
+                size = entry_size(queue[-1])
+                queue[-1][0] = header
+                queue[-1][1].update(control_tlvs(payload))
+                self._queued_bytes += entry_size(queue[-1]) - size
+                self.coalesced.value += 1
+                return
+            data = [header, control_tlvs(payload)]
+        elif pdu_type == PDUType.WAKE and queue and not isinstance(queue[-1], list) and queue[-1][2] == PDUType.WAKE:
+            return  # the queued WAKE does the job
+        queue.append(data)
+        self._queued_bytes += entry_size(data)
+        if self._queued_bytes > self.max_buffered:
+            self._shed(stream_id)
+        self._schedule()
+
+    def _expendable(self, stream_id, entry) -> bool:
+        return stream_id not in self.urgent or (not isinstance(entry, list) and entry[2] == PDUType.WAKE)
+
+    def _shed(self, pushed_to):
+        """ drop the oldest expendable PDUs (never the one just pushed) until back under the cap."""
+        bulk_first = sorted(self._queues.items(), key=lambda item: item[0] in self.urgent)
+        for sid, queue in bulk_first:
+            i = 0
+            keep = len(queue) - 1 if sid == pushed_to else len(queue)
+            while i < keep and self._queued_bytes > self.max_buffered:
+                entry = queue[i]
+                if self._expendable(sid, entry):
+                    del queue[i]
+                    keep -= 1
+                    self._queued_bytes -= len(entry)
+                    self.dropped.value += 1
+                else:
+                    i += 1
+
+    def _schedule(self):
+        if self._scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # drained by the next transmit()
+        self._scheduled = True
+        loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._scheduled = False
+        if any(self._queues.values()):
+            self._transmit()
+
+    def drain(self):
+        """ move queued PDUs into the QUIC stream buffers, urgent streams first, up to the cap."""
+        send = self._quic.send_stream_data
+        room = None
+        for sid, queue in self._queues.items():
+            if not queue:
+                continue
+            if room is None:
+                room = self.max_buffered - self.unacknowledged()
+            while queue and room > 0:
+                data = queue.popleft()
+                self._queued_bytes -= entry_size(data)
+                if isinstance(data, list):
+                    data = encode_control(*data)
+                room -= len(data)
+                send(sid, data, end_stream=False)
+            if queue:
+                self.held.value += 1
@@ -0,0 +1,130 @@
+import random
+from array import array
+from metrics import MetricsRegistry
+
+# Telemetry sequence numbers (CAP_SEQUENCE).
+#
+# A device numbers its samples with a uint32 counter that keeps counting
+# across reconnects and starts at a random value in every client process.
+# Each telemetry payload carries the number of its first sample.
+#
+# The server keeps one sliding window per session: the highest number seen
+# and a 64-bit bitmap of the 64 numbers up to it, 12 bytes in two arrays.
+# Numbers within the window are checked and marked in O(1). Numbers up to
+# RESET_DISTANCE behind it are too old to tell and are dropped as
+# duplicates. A number farther away in either direction means the device
+# restarted its counter, so the window starts over there. A sample counts
+# as lost once the window has moved 64 numbers past it without it.
+
+SEQ_WINDOW = 64
+RESET_DISTANCE = 1 << 24
+_SEQ_MASK = 0xFFFFFFFF
+_WINDOW_MASK = (1 << SEQ_WINDOW) - 1
+
+
+class SequenceCounter:
+    """ a device's next sequence number; take(n) reserves n consecutive ones."""
+
+    def __init__(self, start: int = None):
+        self.next = random.getrandbits(32) if start is None else start & _SEQ_MASK
+
+    def take(self, n: int = 1) -> int:
+        first = self.next
+        self.next = (first + n) & _SEQ_MASK
+        return first
+
+
+class SequenceWindows:
+    """
+    Duplicate and loss detection for every session of the server.
+
+    accept(session_id, seq, count) covers a PDU of `count` samples numbered
+    from seq and returns None if every sample is new, otherwise one bool
+    per sample (False = duplicate, to be dropped).
+    """
+
+    def __init__(self, metrics: MetricsRegistry = None):
+        self._slots = {}          # session_id -> index into the arrays
+        self._high = array("I")   # highest sequence number seen
+        self._bits = array("Q")   # bit i set: number high - i seen
+        self._free = []
+        metrics = MetricsRegistry() if metrics is None else metrics
+        self.duplicates = metrics.counter("wtcp_telemetry_duplicates_total",
+                                          "telemetry samples dropped as already received")
+        self.lost = metrics.counter("wtcp_telemetry_lost_total",
+                                    "telemetry sequence numbers never received (gaps)")
+        self.resets = metrics.counter("wtcp_telemetry_sequence_resets_total",
+                                      "sessions whose device restarted its sequence numbers")
+
+    def __len__(self):
+        return len(self._slots)
+
+    def forget(self, session_id: int):
+        slot = self._slots.pop(session_id, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def _start(self, session_id, slot, seq, count):
+        # numbers before the first one seen count as seen: the telemetry stream
+        # is ordered, so they were never sent on this counter
+        high = (seq + count - 1) & _SEQ_MASK
+        bits = _WINDOW_MASK
+        if slot is None:
+            if self._free:
+                slot = self._slots[session_id] = self._free.pop()
+                self._high[slot], self._bits[slot] = high, bits
+            else:
+                slot = self._slots[session_id] = len(self._high)
+                self._high.append(high)
+                self._bits.append(bits)
+        else:
+            self._high[slot], self._bits[slot] = high, bits
+
+    def _advance(self, bits, d, received):
+        """ shift the window d numbers up; holes leaving it are lost (received: new numbers among them)."""
+        if d >= SEQ_WINDOW:
+            self.lost.value += SEQ_WINDOW - bits.bit_count() + d - SEQ_WINDOW - received
+            return 0
+        self.lost.value += d - (bits >> (SEQ_WINDOW - d)).bit_count()
+        return (bits << d) & _WINDOW_MASK
+
+    def accept(self, session_id: int, seq: int, count: int = 1):
+        slot = self._slots.get(session_id)
+        if slot is None:
+            self._start(session_id, None, seq, count)
+            return None
+        high = self._high[slot]
+        ahead = (seq - high) & _SEQ_MASK
+        if 0 < ahead <= RESET_DISTANCE:
+            # the usual case: the whole PDU is past the window
+            d = ahead + count - 1
+            bits = self._advance(self._bits[slot], d, max(0, count - SEQ_WINDOW))
+            self._high[slot] = (high + d) & _SEQ_MASK
+            self._bits[slot] = bits | ((1 << min(count, SEQ_WINDOW)) - 1)
+            return None
+        if (high - seq) & _SEQ_MASK > RESET_DISTANCE:
+            self.resets.value += 1
+            self._start(session_id, slot, seq, count)
+            return None
+        bits = self._bits[slot]
+        fresh = []
+        for i in range(count):
+            s = (seq + i) & _SEQ_MASK
+            ahead = (s - high) & _SEQ_MASK
+            if 0 < ahead <= RESET_DISTANCE:
+                bits = self._advance(bits, ahead, 0) | 1
+                high = s
+                fresh.append(True)
+                continue
+            behind = (high - s) & _SEQ_MASK
+            if behind >= SEQ_WINDOW or bits >> behind & 1:
+                fresh.append(False)
+            else:
+                bits |= 1 << behind
+                fresh.append(True)
+        self._high[slot], self._bits[slot] = high, bits
+        duplicates = fresh.count(False)
+        if not duplicates:
+            return None
+        self.duplicates.value += duplicates
+        return fresh
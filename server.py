@@ -1,11 +1,33 @@
 
+import argparse
 import asyncio
 import csv
+import logging
+import os
+import signal
+import struct
+import time
 from aioquic.asyncio import serve, QuicConnectionProtocol
 from aioquic.quic.configuration import QuicConfiguration
-from aioquic.quic.events import StreamDataReceived, ConnectionTerminated
-from pdu import PDU, PDUType
-from state_machine import create_server_state_machine, StateMachineError
+from aioquic.quic.events import StreamDataReceived, ConnectionTerminated, HandshakeCompleted
+from pdu import PDU, PDUType, PDUFramer, CAP_COMPACT_TELEMETRY, CAP_SEQUENCE
+from codec import decode_samples
+from state_machine import create_server_state_machine, compile_dispatch, ServerState, StateMachineError
+from telemetry_store import TelemetryStore
+from persistence import PersistencePipeline
+from emergency import EmergencyPipeline
+from geofence import GeofenceEngine
+from rollups import RollupStore
+from sequence import SequenceWindows
+from capture import CaptureWriter
+from metrics import REGISTRY, StreamMetrics, serve_http, log_snapshots
+from storage import build_index
+from sessions import SessionAllocator, SessionRegistry
+from tickets import TicketStore
+from timerwheel import TimerWheel
+from sendqueue import SendQueue
+from workers import run_workers, serve_reuseport, reuseport_socket
+from netio import LOOPS, serve_batched, use_loop
 import sys
 
 STREAM_IDS = {
@@ -14,74 +36,337 @@ STREAM_IDS = {
     'emergency': 4,
 }
 
+# stream each PDU type is sent on
+PDU_STREAMS = {
+    PDUType.AUTH_RESPONSE: STREAM_IDS['control'],
+    PDUType.CONTROL:   STREAM_IDS['control'],
+    PDUType.SLEEP:     STREAM_IDS['control'],
+    PDUType.WAKE:      STREAM_IDS['control'],
+    PDUType.TERMINATE: STREAM_IDS['control'],
+    PDUType.TELEMETRY_REQUEST: STREAM_IDS['telemetry'],
+    PDUType.TELEMETRY_BATCH: STREAM_IDS['telemetry'],
+    PDUType.TELEMETRY_COMPACT: STREAM_IDS['telemetry'],
+    PDUType.EMERGENCY: STREAM_IDS['emergency'],
+}
+# drained ahead of (and never held back like) the telemetry stream
+URGENT_STREAMS = (STREAM_IDS['control'], STREAM_IDS['emergency'])
+
+# (stream, received PDU type) -> handler method. PDUs on these streams drive
+# the state machine whether or not they have a handler; other streams are ignored.
+SERVER_HANDLERS = {
+    (STREAM_IDS['control'], PDUType.AUTH_REQUEST): "on_auth_request",
+    (STREAM_IDS['control'], PDUType.CONTROL): "on_control",
+    (STREAM_IDS['control'], PDUType.TERMINATE): "on_terminate",
+    (STREAM_IDS['telemetry'], PDUType.TELEMETRY_REQUEST): "on_telemetry",
+    (STREAM_IDS['telemetry'], PDUType.TELEMETRY_BATCH): "on_telemetry_batch",
+    (STREAM_IDS['telemetry'], PDUType.TELEMETRY_COMPACT): "on_telemetry_compact",
+    (STREAM_IDS['emergency'], PDUType.EMERGENCY): "on_emergency",
+}
+
+log = logging.getLogger("wtcp.server")
+stream_metrics = StreamMetrics("server", STREAM_IDS)
+handshakes = REGISTRY.counter("wtcp_server_handshakes_total",
+                              "completed handshakes: full, resumed or early_data (0-RTT accepted)", ("kind",))
+
+_default_sessions = SessionAllocator()
+_default_registry = SessionRegistry()
+_default_timers = TimerWheel()
+_default_sequences = SequenceWindows(metrics=REGISTRY)
+
+def forget_released(registry, sequences=_default_sequences):
+    """TicketStore on_released callback: with no ticket left, an ended session's dedup window goes."""
+    def released(session_id):
+        if registry.get(session_id) is None:
+            sequences.forget(session_id)
+    return released
+
 class WTCPServerProtocol(QuicConnectionProtocol):
-    def __init__(self, *args, telemetry_file=None, **kwargs):
+    wake_interval = 60.0  # seconds between WAKEs to an OPERATIONAL session
+    control_every = 10    # an (empty) CONTROL back to the device every N telemetry PDUs
+
+    def __init__(self, *args, telemetry_file=None, telemetry_capacity=None, persistence=None,
+                 sessions=None, registry=None, emergency=None,
+                 capabilities=CAP_COMPACT_TELEMETRY | CAP_SEQUENCE, timers=None, geofence=None,
+                 capture=None, max_send_buffer=None, rollups=None, sequences=None, tickets=None, **kwargs):
         super().__init__(*args, **kwargs)
         self.state_machine = create_server_state_machine()
-        self.telemetry = []
+        self._dispatch = compile_dispatch(type(self), SERVER_HANDLERS, STREAM_IDS.values())
+        self.telemetry = TelemetryStore(telemetry_capacity)
         self.emergencies = []
         self.telemetry_file = "telemetry.csv" if telemetry_file is None else telemetry_file
-        self.next_session = 1
-        self.wake = asyncio.create_task(self.wake_loop())
+        # shared background writer; without one, telemetry is dumped to CSV on disconnect
+        self.persistence = persistence
+        # shared emergency dispatcher; without one, emergencies are kept for the CSV dump
+        self.emergency = emergency
+        # shared GeofenceEngine; breaches take the EMERGENCY path
+        self.geofence = geofence
+        # shared RollupStore, updated with every telemetry PDU
+        self.rollups = rollups
+        # shared CaptureWriter recording every received frame, for capture.py replay
+        self.capture = capture
+        self.capture_id = capture.open_connection() if capture is not None else 0
+        # process-wide allocator so every connection gets its own session_id
+        self.sessions = _default_sessions if sessions is None else sessions
+        self.session_id = 0
+        # capability bits this server offers; the session uses those the device also offered
+        self.capabilities = capabilities
+        self.session_capabilities = 0
+        self.registry = _default_registry if registry is None else registry
+        # this process's TicketStore: resuming with a ticket gives back the session_id it was issued on
+        self.tickets = tickets
+        self.ticket_session_id = None
+        self._unbound_tickets = []
+        if tickets is not None:
+            self._quic._session_ticket_fetcher = self.fetch_ticket
+            self._quic._session_ticket_handler = self.issue_ticket
+        # process-wide dedup windows, kept while a live connection or a ticket can use them
+        self.sequences = _default_sequences if sequences is None else sequences
+        self.device_known = False
+        self._framers = {}
+        # process-wide timer wheel; the WAKE timer is armed once the session is OPERATIONAL
+        self.timers = _default_timers if timers is None else timers
+        self._wake_timer = None
+        # outbound PDUs wait here until the next transmit(), at most one per loop tick
+        self.sendq = SendQueue(self._quic, self.transmit, URGENT_STREAMS, max_send_buffer, metrics=REGISTRY)
+        self.telemetry_count = 0
 
     def quic_event_received(self, event):
       
         if isinstance(event, StreamDataReceived):
-            pdu = PDU.from_bytes(event.data)
-            sid = event.stream_id
-            # CONTROL stream
-            if sid == STREAM_IDS['control']:
-                _, new = self.state_machine.on_pdu(pdu)
-                if pdu.pdu_type == PDUType.AUTH_REQUEST:
-                    self.send_auth_resp()
-                elif pdu.pdu_type == PDUType.CONTROL:
-                    print("Received CONTROL:", PDU.parse_control(pdu.payload))
-                elif pdu.pdu_type == PDUType.TERMINATE:
-                    self.send_terminate()
-            # TELEMETRY stream
-            elif sid == STREAM_IDS['telemetry']:
-                _, new = self.state_machine.on_pdu(pdu)
-                self.telemetry.append(PDU.parse_telemetry(pdu.payload))
-            self.telemetry_count = getattr(self, 'telemetry_count', 0) + 1
-            if self.telemetry_count % 10 == 0:
-                ctl = PDU.build_control(pdu.session_id)
-                self.send_pdu(ctl)
-            # EMERGENCY stream
-            elif sid == STREAM_IDS['emergency']:
-                _, new = self.state_machine.on_pdu(pdu)
-                self.emergencies.append(PDU.parse_emergency(pdu.payload))
-                print("EMERGENCY from client:", PDU.parse_emergency(pdu.payload))
-                self.send_terminate()
+            # one event may carry several PDUs, or only part of one
+            framer = self._framers.get(event.stream_id)
+            if framer is None:
+                framer = self._framers[event.stream_id] = PDUFramer()
+            counters = stream_metrics.stream(event.stream_id)
+            counters.rx_bytes.value += len(event.data)
+            capture = self.capture
+            try:
+                for frame in framer.feed(event.data):
+                    counters.rx_pdus.value += 1
+                    if capture is not None:
+                        capture.record(self.capture_id, event.stream_id, frame)
+                    try:
+                        start = time.perf_counter_ns()
+                        pdu = PDU.from_bytes(frame)
+                        stream_metrics.decode_us.observe((time.perf_counter_ns() - start) / 1000)
+                        self.handle_pdu(event.stream_id, pdu)
+                    except StateMachineError as e:
+                        counters.rejected.value += 1
+                        log.debug("session %d: %s", self.session_id, e)
+                    except (ValueError, struct.error) as e:
+                        # struct.error: a payload too short for its PDU type
+                        stream_metrics.decode_errors.value += 1
+                        log.warning("session %d: bad PDU on stream %d: %s", self.session_id, event.stream_id, e)
+            except ValueError as e:
+                # a corrupt length prefix leaves the rest of the stream unframeable
+                stream_metrics.decode_errors.value += 1
+                log.warning("session %d: cannot frame stream %d: %s", self.session_id, event.stream_id, e)
+
+        elif isinstance(event, HandshakeCompleted):
+            kind = "early_data" if event.early_data_accepted else "resumed" if event.session_resumed else "full"
+            handshakes.labels(kind).inc()
+            log.debug("%s handshake completed", kind)
 
         elif isinstance(event, ConnectionTerminated):
-            self.dump_telemetry()
+            if self.capture is not None:
+                self.capture.close_connection(self.capture_id)
+            if self._wake_timer is not None:
+                self._wake_timer.cancel()
+            if self.registry.get(self.session_id) is self:  # unless a resumed connection took the session over
+                if self.geofence is not None:
+                    self.geofence.remove(self.session_id)
+                self.release_sequences(self.session_id)
+            elif not self.session_id and self.ticket_session_id is not None:
+                self.release_sequences(self.ticket_session_id)  # resumed, but never authenticated
+            self.registry.unregister(self.session_id, self)
+            if self.persistence is None:
+                self.dump_telemetry()
+
+    def handle_pdu(self, sid, pdu):
+        """dispatch one complete PDU received on stream sid."""
+        handlers = self._dispatch.get(sid)
+        if handlers is None:
+            return
+        pdu_type = pdu.pdu_type
+        self.state_machine.advance(pdu_type)
+        handler = handlers[pdu_type]
+        if handler is not None:
+            handler(self, pdu)
+
+    # CONTROL stream
+    def on_auth_request(self, pdu):
+        info = PDU.parse_auth_req(pdu.payload)
+        self.session_capabilities = info["capabilities"] & self.capabilities
+        self.send_auth_resp(info["device_uuid"])
+        if self.geofence is not None and info["geofence_radius"] > 0:
+            # centered on the first position the device reports
+            self.geofence.set_fence(self.session_id, info["geofence_radius"])
+
+    def on_control(self, pdu):
+        log.debug("received CONTROL: %s", PDU.parse_control(pdu.payload))
+
+    def on_terminate(self, pdu):
+        self.send_terminate()
+
+    # TELEMETRY stream: each payload is parsed once, then fed to every consumer. Samples
+    # belong to the authenticated session, whatever session_id the PDU header claims.
+    def on_telemetry(self, pdu):
+        payload, seq = self.telemetry_payload(pdu)
+        if seq is None or self.sequences.accept(self.session_id, seq) is None:
+            sample = PDU.telemetry_struct.unpack_from(payload)
+            self.telemetry.append_row(self.session_id, sample)
+            if self.persistence is not None:
+                self.persistence.submit_telemetry(self.session_id, payload)
+            if self.rollups is not None:
+                self.rollups.add_row(self.session_id, sample)
+            if self.geofence is not None:
+                self.check_geofence((sample[0],), (sample[1],), (sample[2],))
+        self.count_telemetry(self.session_id)
+
+    def on_telemetry_batch(self, pdu):
+        payload, seq = self.telemetry_payload(pdu)
+        columns = tuple(PDU.parse_telemetry_batch(payload).values())
+        if seq is not None:
+            fresh = self.sequences.accept(self.session_id, seq, len(columns[0]))
+            if fresh is not None:
+                samples = [sample for sample, keep in zip(zip(*columns), fresh) if keep]
+                payload = PDU.build_telemetry_batch(self.session_id, samples).payload
+                columns = sample_columns(samples)
+        self.ingest_batch(self.session_id, payload, columns)
+        self.count_telemetry(self.session_id)
+
+    def on_telemetry_compact(self, pdu):
+        if not self.session_capabilities & CAP_COMPACT_TELEMETRY:
+            raise ValueError("TELEMETRY_COMPACT without CAP_COMPACT_TELEMETRY negotiated")
+        payload, seq = self.telemetry_payload(pdu)
+        samples = decode_samples(payload)
+        if seq is not None:
+            fresh = self.sequences.accept(self.session_id, seq, len(samples))
+            if fresh is not None:
+                samples = [sample for sample, keep in zip(samples, fresh) if keep]
+        batch = None
+        if self.persistence is not None:
+            # persisted in the fixed layout like any other batch
+            batch = PDU.build_telemetry_batch(self.session_id, samples).payload
+        self.ingest_batch(self.session_id, batch, sample_columns(samples))
+        self.count_telemetry(self.session_id)
+
+    def telemetry_payload(self, pdu):
+        """(payload, sequence number or None): the trailing CAP_SEQUENCE field split off."""
+        payload = pdu.payload
+        if self.session_capabilities & CAP_SEQUENCE:
+            return payload[:-4], PDU.parse_sequence(payload)
+        return payload, None
+
+    def ingest_batch(self, session_id, payload, columns):
+        """columns ordered like PDU.telemetry_fields; payload in the TELEMETRY_BATCH layout."""
+        self.telemetry.append_columns(session_id, columns)
+        if self.persistence is not None:
+            self.persistence.submit_telemetry_batch(session_id, payload)
+        if self.rollups is not None:
+            self.rollups.add_columns(session_id, columns)
+        if self.geofence is not None:
+            self.check_geofence(columns[0], columns[1], columns[2])
+
+    def count_telemetry(self, session_id):
+        self.telemetry_count += 1
+        if self.telemetry_count % self.control_every == 0:
+            # merged into any CONTROL still queued for this device
+            self.send_pdu(PDU.build_control(session_id))
+
+    # EMERGENCY stream
+    def on_emergency(self, pdu):
+        self.submit_emergency(pdu.session_id, pdu.payload)
+        self.send_terminate()
+
+    def submit_emergency(self, session_id, payload):
+        """hand an EMERGENCY payload, from the device or raised here, to the emergency path."""
+        if self.emergency is not None:
+            self.emergency.submit(session_id, payload)
+        else:
+            alert = PDU.parse_emergency(payload)
+            self.emergencies.append(alert)
+            if self.persistence is not None:
+                self.persistence.submit_emergency(session_id, payload)
+            log.warning("EMERGENCY from session %d: %s", session_id, alert)
+
+    def check_geofence(self, timestamps, lats, lons):
+        for payload in self.geofence.observe(self.session_id, timestamps, lats, lons):
+            self.submit_emergency(self.session_id, payload)
 
     def send_pdu(self, pdu):
-        sid = {
-            PDUType.AUTH_RESPONSE: STREAM_IDS['control'],
-            PDUType.CONTROL:   STREAM_IDS['control'],
-            PDUType.TELEMETRY_REQUEST: STREAM_IDS['telemetry'],
-            PDUType.EMERGENCY: STREAM_IDS['emergency'],
-            PDUType.TERMINATE: STREAM_IDS['control'],
-        }[pdu.pdu_type]
-        self._quic.send_stream_data(sid, pdu.to_bytes(), end_stream=False)
-
-    def send_auth_resp(self):
-        sid = self.next_session
-        pdu = PDU.build_auth_resp(status=0, session_id=sid)
-        self.next_session += 1
-        print("Sending AUTH_RESPONSE with payload len:", len(pdu.payload))
+        self.send_encoded(pdu.pdu_type, pdu.to_bytes())
+
+    def send_encoded(self, pdu_type, data):
+        """queue an already-encoded PDU on the stream for its type."""
+        sid = PDU_STREAMS[pdu_type]
+        counters = stream_metrics.stream(sid)
+        counters.tx_pdus.value += 1
+        counters.tx_bytes.value += len(data)
+        self.sendq.push(sid, pdu_type, data)
+
+    def transmit(self):
+        self.sendq.drain()
+        super().transmit()
+
+    def fetch_ticket(self, label):
+        """session_ticket_fetcher for this connection."""
+        ticket, self.ticket_session_id = self.tickets.take(label)
+        return ticket
+
+    def issue_ticket(self, ticket):
+        """session_ticket_handler for this connection."""
+        self.tickets.add(ticket, self.session_id if self.device_known else None)
+        if not self.session_id:
+            self._unbound_tickets.append(ticket.ticket)  # bound once AUTH assigns the session_id
+
+    def send_auth_resp(self, device_uuid=None):
+        # a device that resumed with a ticket issued on one of our sessions
+        # (possibly sending this AUTH as 0-RTT) gets that session back; the
+        # UUID it claims plays no part. The nil UUID is an unconfigured device.
+        known = device_uuid is not None and device_uuid.int != 0
+        session_id = None
+        if known and self.session_resumed:
+            session_id = self.ticket_session_id
+        if session_id is None:
+            session_id = self.sessions.allocate()
+        self.device_known = known
+        self.session_id = session_id
+        if known:
+            # only a known device can resume into this session, so only its tickets hold it
+            for label in self._unbound_tickets:
+                self.tickets.bind(label, session_id)
+        self._unbound_tickets.clear()
+        if self.ticket_session_id not in (None, session_id):
+            self.release_sequences(self.ticket_session_id)
+        self.registry.register(self.session_id, self)
+        pdu = PDU.build_auth_resp(status=0, session_id=self.session_id, capabilities=self.session_capabilities)
+        log.debug("sending AUTH_RESPONSE for session %d", self.session_id)
         self.send_pdu(pdu)
         self.state_machine.on_pdu(pdu)  # transition to OPERATIONAL state
-        
-    async def wake_loop(self):
-        while True: 
-            await asyncio.sleep(60)  # wake every 60 seconds
-            if self.state_machine.state == 'OPERATIONAL':
-                pdu = PDU.build_wake(session_id=self.next_session - 1)
-                self.send_pdu(pdu)
-                print("Sent WAKE PDU to client")
-        
+        if self._wake_timer is None:
+            self._wake_timer = self.timers.schedule(self.wake_interval, self.send_wake)
+
+    def release_sequences(self, session_id):
+        """forget session_id's dedup window unless another connection or a ticket can still use it."""
+        if self.registry.get(session_id) not in (None, self):
+            return
+        if self.tickets is not None and self.tickets.holds(session_id):
+            return
+        self.sequences.forget(session_id)
+
+    @property
+    def session_resumed(self) -> bool:
+        """True if the device resumed a TLS session with a ticket from this process."""
+        return self._quic.tls.session_resumed
+
+    def send_wake(self):
+        """WAKE timer: nudge the device, then re-arm while the session stays OPERATIONAL."""
+        if self.state_machine.state != ServerState.OPERATIONAL:
+            return
+        self.send_pdu(PDU.build_wake(session_id=self.session_id))
+        log.debug("sent WAKE to session %d", self.session_id)
+        self._wake_timer = self.timers.schedule(self.wake_interval, self.send_wake)
         
     def send_terminate(self):
         pdu = PDU(PDUType.TERMINATE, version=1, session_id=0)
@@ -90,53 +375,210 @@ class WTCPServerProtocol(QuicConnectionProtocol):
 
     def dump_telemetry(self):
         if  self.telemetry:
-            # write a CSV of the parsed telemetry dicts
-            with open("telemetry.csv", "a", newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=self.telemetry[0].keys())
+            # write a CSV straight from the store columns (session_id is not part of the CSV layout)
+            with open(self.telemetry_file, "a", newline='') as f:
+                writer = csv.writer(f)
                 if f.tell() == 0:
-                    writer.writeheader()
-                writer.writerows(self.telemetry)
-                print(f"Telemetry written to {self.telemetry_file}")
+                    writer.writerow(PDU.telemetry_fields)
+                n = len(PDU.telemetry_fields)
+                writer.writerows(row[:n] for row in self.telemetry.rows())
+                log.info("telemetry written to %s", self.telemetry_file)
         if self.emergencies:
             with open("emergency.csv","a",newline="") as f:
                 wr = csv.DictWriter(f,self.emergencies[0].keys())
                 if f.tell()==0: wr.writeheader()
                 wr.writerows(self.emergencies)
-                print(f"Emergencies written to emergency.csv")
+                log.info("emergencies written to emergency.csv")
         
+def sample_columns(samples):
+    """sample tuples as columns ordered like PDU.telemetry_fields."""
+    return tuple(zip(*samples)) or ((),) * len(PDU.telemetry_fields)
+
 #interactive command line interface for server control
-async def stdin_cmd(server: WTCPServerProtocol):
+def parse_targets(args):
+    """session IDs listed after a command, or None for every session."""
+    return [int(a) for a in args] or None
+
+def set_fences(geofence, registry, targets, radius, lat=None, lon=None):
+    """server side of a fence change: the selected sessions, or every session."""
+    if geofence is not None:
+        for sid in registry if targets is None else targets:
+            geofence.set_fence(sid, radius, lat, lon)
+
+def print_rollups(rollups, args):
+    """`status [sid...]`: fleet summary, or the last known sample of each listed session."""
+    if not args:
+        print("Fleet:", " ".join(f"{k}={v}" for k, v in rollups.status().items()))
+        return
+    for sid, state in rollups.latest(parse_targets(args)).items():
+        print(f"  {sid}:", " ".join(f"{k}={v}" for k, v in state.items()))
+
+def print_series(rollups, resolution, sid=None):
+    """`rollup minute|hour [sid]`: the buckets of one session, or of the whole fleet."""
+    series = rollups.series(resolution, sid)
+    print(f"{'start':>10} {'count':>6} {'battery min/mean/max':>22} {'activity min/mean/max':>22} flags")
+    for b in series:
+        print(f"{b['start']:>10} {b['count']:>6} "
+              f"{b['battery_min']:>6} {b['battery_mean']:>7.1f} {b['battery_max']:>7} "
+              f"{b['activity_min']:>6} {b['activity_mean']:>7.1f} {b['activity_max']:>7} 0x{b['diag_flags']:02x}")
+
+async def stdin_cmd(registry: SessionRegistry, commands=None, emergency=None, geofence=None, rollups=None):
     loop = asyncio.get_event_loop()
     reader = asyncio.StreamReader()
     protocol = asyncio.StreamReaderProtocol(reader)
-    await loop.connect_read_pipe(lambda: protocol, sys.stdin)
+    await loop.connect_read_pipe(lambda: protocol, sys.stdin if commands is None else commands)
     while True:
-        line = (await reader.readline()).decode().strip().split()
+        raw = await reader.readline()
+        if not raw:
+            return  # stdin closed: keep serving without the command line
+        line = raw.decode().strip().split()
         if not line: continue
         cmd, *args = line
-        if cmd == "r" and args:
-            server.send_pdu(PDU.build_control(0,new_rate=int(args[0])))
-        elif cmd == "g" and args:
-            server.send_pdu(PDU.build_control(0,new_radius=float(args[0])))
-        elif cmd == "sleep":
-            server.send_pdu(PDU.build_sleep(0,wake=False))
-        elif cmd == "wake":
-            server.send_pdu(PDU.build_sleep(0,wake=True))
-        else:
-            print("Commands:  r <rate> | g <radius> | sleep | wake")
+        try:
+            if cmd == "r" and args:
+                n = registry.send_control(new_rate=int(args[0]), sessions=parse_targets(args[1:]))
+            elif cmd == "g" and args:
+                targets = parse_targets(args[1:])
+                set_fences(geofence, registry, targets, float(args[0]))
+                n = registry.send_control(new_radius=float(args[0]), sessions=targets)
+            elif cmd == "fence" and len(args) >= 3:
+                lat, lon, radius = (float(a) for a in args[:3])
+                targets = parse_targets(args[3:])
+                set_fences(geofence, registry, targets, radius, lat, lon)
+                n = registry.send_control(new_radius=radius, sessions=targets)
+            elif cmd == "who" and len(args) == 3 and geofence is not None:
+                inside = geofence.within(*(float(a) for a in args))
+                print(f"Inside: {' '.join(str(s) for s in inside) or 'none'}")
+                continue
+            elif cmd == "batch" and args:
+                age = int(args[1]) if len(args) > 1 else None
+                n = registry.send_control(batch_size=int(args[0]), batch_age_ms=age,
+                                          sessions=parse_targets(args[2:]))
+            elif cmd == "sleep":
+                n = registry.send_sleep(wake=False, sessions=parse_targets(args))
+            elif cmd == "wake":
+                n = registry.send_sleep(wake=True, sessions=parse_targets(args))
+            elif cmd == "list":
+                print("Sessions:", " ".join(str(s) for s in sorted(registry)) or "none")
+                continue
+            elif cmd == "status" and rollups is not None:
+                print_rollups(rollups, args)
+                continue
+            elif cmd == "rollup" and args and rollups is not None:
+                print_series(rollups, args[0], int(args[1]) if len(args) > 1 else None)
+                continue
+            elif cmd == "alerts" and emergency is not None:
+                print(f"Emergencies handled: {emergency.handled.value}, over budget: {emergency.over_budget.value}")
+                print("  arrival -> handled:", emergency.handle_latency.summary())
+                print("  device  -> handled:", emergency.device_latency.summary())
+                continue
+            else:
+                print("Commands:  r <rate> [sid...] | g <radius> [sid...] | fence <lat> <lon> <radius> [sid...] | "
+                      "who <lat> <lon> <radius> | batch <size> [age_ms [sid...]] | "
+                      "sleep [sid...] | wake [sid...] | list | alerts | status [sid...] | rollup minute|hour [sid]")
+                continue
+        except ValueError as e:
+            print(e if cmd == "rollup" else "Session IDs, rates, radii and coordinates must be numbers")
+            continue
+        print(f"{cmd}: sent to {n} session(s)")
 
-async def main():
+async def main(args, worker=0, workers=1, commands=None):
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
     cfg = QuicConfiguration(is_client=False)
     cfg.load_cert_chain("cert.pem","key.pem")
-    server_proto = None
+    # workers share the port but each writes its own segment files
+    data_dir = args.data_dir if workers == 1 else os.path.join(args.data_dir, f"worker-{worker}")
+    persistence = PersistencePipeline(data_dir, fsync_interval=args.fsync_interval,
+                                      index_segment=build_index)
+    persistence.start()
+    emergency = EmergencyPipeline(persistence, budget_ms=args.emergency_budget_ms, metrics=REGISTRY)
+    emergency.start()
+    geofence = GeofenceEngine(metrics=REGISTRY)
+    rollups = RollupStore(metrics=REGISTRY)
+    capture = None
+    if args.capture:
+        capture = CaptureWriter(args.capture if workers == 1 else f"{args.capture}.worker-{worker}")
+        capture.start()
+    sessions = SessionAllocator(worker, workers)
+    registry = SessionRegistry()
+    tickets = TicketStore(args.max_tickets, on_released=forget_released(registry))
+    REGISTRY.gauge("wtcp_server_active_sessions", "authenticated sessions", function=registry.__len__)
+    REGISTRY.gauge("wtcp_server_session_tickets", "resumption tickets held", function=tickets.__len__)
+    REGISTRY.gauge("wtcp_server_pending_timers", "session timers in the timer wheel",
+                   function=_default_timers.__len__)
+    REGISTRY.gauge("wtcp_persistence_backlog_bytes", "bytes submitted but not yet written",
+                   function=lambda: persistence.backlog)
+    REGISTRY.gauge("wtcp_persistence_written_bytes", "bytes written to segments",
+                   function=lambda: persistence.written_bytes)
+    REGISTRY.gauge("wtcp_persistence_write_errors", "segment writes that failed",
+                   function=lambda: persistence.write_errors)
+    REGISTRY.gauge("wtcp_persistence_lost_bytes", "bytes lost to failed segment writes",
+                   function=lambda: persistence.lost_bytes)
+    REGISTRY.gauge("wtcp_persistence_dropped_bytes", "bytes dropped with the backlog at its cap",
+                   function=lambda: persistence.dropped_bytes)
+    if args.metrics_port:
+        # each worker serves its own metrics on the next port up
+        await serve_http(args.metrics_host, args.metrics_port + worker)
+    if args.metrics_interval > 0:
+        asyncio.create_task(log_snapshots(args.metrics_interval))
     def factory(*a, **k):
-        nonlocal server_proto
-        server_proto = WTCPServerProtocol(*a, **k)
-        return server_proto
-    await serve("0.0.0.0",4433,configuration=cfg,create_protocol=factory)
-    print("WTCP server on :4433 —-type 'help' for commands")
-    await stdin_cmd(lambda:server_proto)
+        return WTCPServerProtocol(*a, persistence=persistence, sessions=sessions, registry=registry,
+                                  emergency=emergency, geofence=geofence, capture=capture,
+                                  max_send_buffer=args.max_send_buffer, rollups=rollups, tickets=tickets, **k)
+    try:
+        # every connection installs its own ticket callbacks (tickets=), so serve() gets none
+        quic_args = dict(configuration=cfg, create_protocol=factory)
+        if args.rx_batch:
+            sock = reuseport_socket(args.host, args.port) if workers > 1 else None
+            await serve_batched(args.host, args.port, sock=sock, batch=args.rx_batch, metrics=REGISTRY, **quic_args)
+        elif workers == 1:
+            await serve(args.host, args.port, **quic_args)
+        else:
+            await serve_reuseport(args.host, args.port, **quic_args)
+        if workers == 1:
+            print(f"WTCP server on :{args.port} —-type 'help' for commands")
+        else:
+            print(f"WTCP worker {worker}/{workers} (pid {os.getpid()}) on :{args.port}")
+        await stdin_cmd(registry, commands, emergency, geofence, rollups)
+        await asyncio.Event().wait()
+    finally:
+        # flush-on-shutdown: everything submitted so far reaches disk
+        await emergency.close()
+        await persistence.close()
+        if capture is not None:
+            capture.close()
 
 if __name__ == "__main__":
-    print("Starting WTCP server on port 4433...")
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="WTCP-Q Server")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=4433)
+    parser.add_argument("--data-dir", default="data", help="directory for telemetry/emergency segments")
+    parser.add_argument("--fsync-interval", type=float, default=1.0, help="max seconds between fsyncs")
+    parser.add_argument("--emergency-budget-ms", type=float, default=50.0,
+                        help="arrival-to-handled budget for EMERGENCY PDUs")
+    parser.add_argument("--max-tickets", type=int, default=TicketStore.default_max_tickets,
+                        help="session resumption tickets kept per worker")
+    parser.add_argument("--max-send-buffer", type=int, default=SendQueue.default_max_buffered,
+                        help="unacknowledged bytes per session before telemetry-stream sends are held back")
+    parser.add_argument("--capture", help="record every received PDU to this file (replay with capture.py)")
+    parser.add_argument("--loop", choices=LOOPS, default="asyncio", help="event loop (uvloop must be installed)")
+    parser.add_argument("--rx-batch", type=int, default=0,
+                        help="datagrams read per socket wakeup, one transmit per connection each (0 = asyncio's "
+                             "one-datagram transport)")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes sharing the port (SO_REUSEPORT)")
+    parser.add_argument("--metrics-host", default="127.0.0.1")
+    parser.add_argument("--metrics-port", type=int, default=9464, help="Prometheus /metrics port (0 = off)")
+    parser.add_argument("--metrics-interval", type=float, default=60.0,
+                        help="seconds between metrics snapshot log lines (0 = off)")
+    parser.add_argument("--log-level", default="INFO", help="DEBUG logs every PDU")
+    cli_args = parser.parse_args()
+    logging.basicConfig(level=cli_args.log_level.upper(), format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    print(f"Starting WTCP server on port {cli_args.port}...")
+    use_loop(cli_args.loop)
+    if cli_args.workers > 1:
+        run_workers(main, cli_args, cli_args.workers)
+    else:
+        try:
+            asyncio.run(main(cli_args))
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            pass
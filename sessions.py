@@ -0,0 +1,94 @@
+from pdu import PDU
+
+class SessionAllocator:
+    """
+    Hands out session IDs that are unique across all server workers.
+
+    Worker `worker` of `workers` owns the IDs first + worker + k * workers, so
+    no two workers can ever produce the same ID and no coordination (shared
+    memory, locks) is needed on the AUTH path.
+    """
+    max_session_id = 0xFFFFFFFF  # session_id is a uint32 in the PDU header
+
+    def __init__(self, worker: int = 0, workers: int = 1, first: int = 1):
+        if not 0 <= worker < workers:
+            raise ValueError(f"worker index {worker} out of range for {workers} workers")
+        self.worker = worker
+        self.workers = workers
+        self._next = first + worker
+
+    def allocate(self) -> int:
+        session_id = self._next
+        if session_id > SessionAllocator.max_session_id:
+            raise RuntimeError("session ID space exhausted")
+        self._next += self.workers
+        return session_id
+
+    def owns(self, session_id: int) -> bool:
+        """True if session_id falls in this worker's range."""
+        return session_id % self.workers == self._next % self.workers
+
+
+class SessionRegistry:
+    """
+    Live server protocols of this process, keyed by session_id.
+
+    The send_* methods fan one command out to every selected session: the PDU
+    payload is encoded once, only the 8-byte header (which carries the
+    session_id) is packed per session, and each connection is transmitted
+    once after all of its data has been queued.
+
+    `sessions` selects the targets: None for all, an iterable of session IDs,
+    or a predicate called with each protocol.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+
+    def register(self, session_id: int, protocol):
+        self._sessions[session_id] = protocol
+
+    def unregister(self, session_id: int, protocol=None):
+        if protocol is None or self._sessions.get(session_id) is protocol:
+            self._sessions.pop(session_id, None)
+
+    def get(self, session_id: int):
+        return self._sessions.get(session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def __iter__(self):
+        return iter(list(self._sessions))
+
+    def select(self, sessions=None):
+        if sessions is None:
+            return list(self._sessions.values())
+        if callable(sessions):
+            return [p for p in self._sessions.values() if sessions(p)]
+        return [self._sessions[s] for s in sessions if s in self._sessions]
+
+    def broadcast(self, pdu, sessions=None) -> int:
+        """ send pdu to the selected sessions, each with its own session_id; returns the count.
+        """
+        targets = self.select(sessions)
+        header = PDU.header_struct
+        length = header.size + len(pdu.payload)
+        payload = bytes(pdu.payload)
+        for protocol in targets:
+            data = header.pack(length, pdu.pdu_type, pdu.version, protocol.session_id) + payload
+            protocol.send_encoded(pdu.pdu_type, data)
+        for protocol in targets:
+            protocol.transmit()
+        return len(targets)
+
+    def send_control(self, new_rate: int = None, new_radius: float = None, sessions=None,
+                     batch_size: int = None, batch_age_ms: int = None) -> int:
+        return self.broadcast(PDU.build_control(0, new_rate=new_rate, new_radius=new_radius,
+                                                batch_size=batch_size, batch_age_ms=batch_age_ms), sessions)
+
+    def send_sleep(self, wake: bool = False, sessions=None) -> int:
+        return self.broadcast(PDU.build_sleep(0, wake=wake), sessions)
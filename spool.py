@@ -0,0 +1,92 @@
+import mmap
+import os
+import struct
+from pdu import PDU
+
+# Client-side store-and-forward queue: a memory-mapped ring file of fixed-size
+# telemetry records (the TELEMETRY_REQUEST payload layout). The header holds
+# absolute head/tail counters, so the ring position of record n is
+# n % capacity and the queue survives a restart of the client. Records are
+# written before the tail counter that publishes them.
+#   header: magic, version, record size, capacity, head, tail, dropped
+SPOOL_MAGIC = b"WTSP"
+SPOOL_VERSION = 1
+spool_header_format = '=4s B 3x I I 4x Q Q Q'
+spool_header_size = 64
+_HEADER = struct.Struct(spool_header_format)
+_COUNTERS = struct.Struct('=Q Q Q')
+_COUNTERS_OFFSET = _HEADER.size - _COUNTERS.size
+
+
+class SampleSpool:
+    """
+    Persistent FIFO of telemetry samples with a fixed capacity.
+
+    append() never blocks: when the ring is full the oldest sample is
+    overwritten and counted in `dropped`. Readers peek() a run of samples,
+    send them and then consume() them, so a crash in between replays
+    rather than loses them. flush() msyncs the mapping.
+    """
+    default_capacity = 65536
+
+    def __init__(self, path: str, capacity: int = None):
+        self.path = path
+        capacity = SampleSpool.default_capacity if capacity is None else capacity
+        record = PDU.telemetry_struct
+        fresh = not os.path.exists(path) or os.path.getsize(path) == 0
+        with open(path, "a+b") as f:
+            if fresh:
+                f.truncate(spool_header_size + capacity * record.size)
+            self._mmap = mmap.mmap(f.fileno(), 0)
+        if fresh:
+            _HEADER.pack_into(self._mmap, 0, SPOOL_MAGIC, SPOOL_VERSION, record.size, capacity, 0, 0, 0)
+        magic, version, record_size, self.capacity, self._head, self._tail, self.dropped = \
+            _HEADER.unpack_from(self._mmap)
+        if magic != SPOOL_MAGIC or version != SPOOL_VERSION or record_size != record.size:
+            self._mmap.close()
+            raise ValueError(f"{path}: not a WTCP sample spool")
+        if len(self._mmap) < spool_header_size + self.capacity * record_size:
+            self._mmap.close()
+            raise ValueError(f"{path}: spool file is truncated")
+
+    def __len__(self):
+        return self._tail - self._head
+
+    @property
+    def backlog(self) -> int:
+        """samples waiting to be replayed."""
+        return self._tail - self._head
+
+    def _offset(self, n: int) -> int:
+        return spool_header_size + (n % self.capacity) * PDU.telemetry_size
+
+    def _publish(self):
+        _COUNTERS.pack_into(self._mmap, _COUNTERS_OFFSET, self._head, self._tail, self.dropped)
+
+    def append(self, sample):
+        """ sample: (timestamp, lat, lon, activity, battery, diag_flags).
+        """
+        if self._tail - self._head == self.capacity:
+            self._head += 1
+            self.dropped += 1
+        PDU.telemetry_struct.pack_into(self._mmap, self._offset(self._tail), *sample)
+        self._tail += 1
+        self._publish()
+
+    def peek(self, n: int):
+        """ up to n of the oldest samples, without removing them.
+        """
+        unpack_from = PDU.telemetry_struct.unpack_from
+        stop = min(self._tail, self._head + n)
+        return [unpack_from(self._mmap, self._offset(i)) for i in range(self._head, stop)]
+
+    def consume(self, n: int):
+        self._head = min(self._tail, self._head + n)
+        self._publish()
+
+    def flush(self):
+        self._mmap.flush()
+
+    def close(self):
+        self._mmap.flush()
+        self._mmap.close()
@@ -25,27 +25,54 @@ class StateMachineError(Exception):
 class StateMachine:
     """state machine for WTCP-Q client and server.
        handles transitions based on current state and incoming PDU types.
-        
+
+       The transition dict is compiled (once per dict) into a dense table:
+       one row per state, indexed by the raw PDU type byte, holding the
+       next state's index or -1. A transition is then two list lookups on
+       ints; `state` maps the index back to the Enum member.
     """
-    
+
     def __init__(self, initial_state, transitions):
-        
-        self.state = initial_state
-        self._transitions = transitions
-        
-    def on_pdu(self, pdu): 
+        self._states, self._table = compile_transitions(transitions, type(initial_state))
+        self.index = self._states.index(initial_state)
+
+    @property
+    def state(self):
+        return self._states[self.index]
+
+    @state.setter
+    def state(self, state):
+        self.index = self._states.index(state)
+
+    def advance(self, pdu_type: int) -> int:
+        """ take the transition for a raw type byte; returns the new state index."""
+        index = self._table[self.index][pdu_type]
+        if index < 0:
+            raise StateMachineError(f"Invalid transition from {self.state} with PDU type {pdu_type}")
+        self.index = index
+        return index
+
+    def on_pdu(self, pdu):
         """
         process an incoming PDU and transition state if valid.
         """
-        key = (self.state, pdu.pdu_type)
-        if key in self._transitions:
-            old_state = self.state
-            self.state = self._transitions[key]
-            
-            return old_state, self.state
-        else: 
-            raise StateMachineError(f"Invalid transition from {self.state} with PDU type {pdu.pdu_type}")
-        
+        old_state = self._states[self.index]
+        return old_state, self._states[self.advance(pdu.pdu_type)]
+
+
+_compiled = {}
+
+def compile_transitions(transitions, states):
+    """ (states as a list, one 256-entry row of next-state indexes per state) for a transition dict."""
+    compiled = _compiled.get(id(transitions))
+    if compiled is None or compiled[0] is not transitions:
+        members = list(states)
+        table = [[-1] * 256 for _ in members]
+        for (state, pdu_type), new in transitions.items():
+            table[members.index(state)][pdu_type] = members.index(new)
+        compiled = _compiled[id(transitions)] = (transitions, members, table)
+    return compiled[1], compiled[2]
+
 
 # client transitions: (current_state, received_pdu) -> next_state
 CLIENT_TRANSITIONS = {
@@ -54,6 +81,8 @@ CLIENT_TRANSITIONS = {
     (ClientState.OPERATIONAL, PDUType.CONTROL)         : ClientState.OPERATIONAL,
     (ClientState.OPERATIONAL, PDUType.SLEEP)           : ClientState.SLEEPING,
     (ClientState.SLEEPING,    PDUType.SLEEP)           : ClientState.OPERATIONAL,
+    (ClientState.OPERATIONAL, PDUType.WAKE)            : ClientState.OPERATIONAL,
+    (ClientState.SLEEPING,    PDUType.WAKE)            : ClientState.SLEEPING,
     (ClientState.OPERATIONAL, PDUType.EMERGENCY)       : ClientState.TERMINATING,
     (ClientState.OPERATIONAL, PDUType.TERMINATE)       : ClientState.TERMINATING,
     (ClientState.TERMINATING, PDUType.TERMINATE)       : ClientState.TERMINATED,
@@ -65,6 +94,10 @@ SERVER_TRANSITIONS = {
     (ServerState.AUTHORIZING, PDUType.AUTH_RESPONSE): ServerState.OPERATIONAL,
     (ServerState.AUTHORIZING, PDUType.TELEMETRY_REQUEST): ServerState.OPERATIONAL,
     (ServerState.OPERATIONAL, PDUType.TELEMETRY_REQUEST): ServerState.OPERATIONAL,
+    (ServerState.AUTHORIZING, PDUType.TELEMETRY_BATCH): ServerState.OPERATIONAL,
+    (ServerState.OPERATIONAL, PDUType.TELEMETRY_BATCH): ServerState.OPERATIONAL,
+    (ServerState.AUTHORIZING, PDUType.TELEMETRY_COMPACT): ServerState.OPERATIONAL,
+    (ServerState.OPERATIONAL, PDUType.TELEMETRY_COMPACT): ServerState.OPERATIONAL,
     (ServerState.OPERATIONAL, PDUType.EMERGENCY): ServerState.TERMINATING,
     (ServerState.OPERATIONAL, PDUType.TERMINATE): ServerState.TERMINATED,
     (ServerState.TERMINATING, PDUType.TERMINATE): ServerState.TERMINATED,
@@ -76,4 +109,23 @@ def create_client_state_machine():
 
 def create_server_state_machine():
     """Create a state machine for the WTCP-Q server."""
-    return StateMachine(ServerState.LISTENING, SERVER_TRANSITIONS)
\ No newline at end of file
+    return StateMachine(ServerState.LISTENING, SERVER_TRANSITIONS)
+
+
+_dispatch = {}
+
+def compile_dispatch(cls, handlers, streams):
+    """
+    {stream_id: 256-entry list of cls's handler functions (or None), indexed
+    by the raw PDU type byte} from handlers {(stream_id, pdu_type): method
+    name}; every stream in `streams` gets a list. Compiled once per class,
+    so subclasses that override a handler get their own.
+    """
+    key = (cls, id(handlers))
+    table = _dispatch.get(key)
+    if table is None:
+        table = {sid: [None] * 256 for sid in streams}
+        for (sid, pdu_type), name in handlers.items():
+            table[sid][pdu_type] = getattr(cls, name)
+        _dispatch[key] = table
+    return table
@@ -0,0 +1,268 @@
+import argparse
+import bisect
+import csv
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pdu import PDU
+from persistence import (SegmentWriter, KIND_TELEMETRY, SEGMENT_MAGIC, segment_header_format,
+                         segment_header_size, segment_numbers, session_prefix_format,
+                         telemetry_record_size)
+
+# a raw telemetry segment record: session_id followed by the TELEMETRY_REQUEST payload layout
+telemetry_record_format = session_prefix_format + PDU.telemetry_format[1:]
+
+# Index files (<segment>.idx) hold the samples of one sealed segment sorted by
+# (session_id, timestamp) and stored column by column in host byte order, so a
+# memory-mapped index can hand out column slices without copying or decoding.
+#   header:   magic, version, byte order, sample count, session count
+#   sessions: session_id (uint32) per session, then start row (uint64) per session + end
+#   columns:  timestamp, latitude, longitude, activity, battery, diag_flags
+INDEX_MAGIC = b"WTIX"
+INDEX_VERSION = 1
+index_header_format = '=4s B c 2x Q I 4x'
+index_header_size = struct.calcsize(index_header_format)
+index_typecodes = ("Q", "f", "f", "H", "B", "B")
+
+
+def _padding(size: int) -> int:
+    return -size % 8
+
+
+def read_segment_header(path: str):
+    with open(path, "rb") as f:
+        magic, version, kind, record_size = struct.unpack(segment_header_format, f.read(segment_header_size))
+    if magic != SEGMENT_MAGIC:
+        raise ValueError(f"{path}: not a WTCP segment")
+    return version, kind, record_size
+
+
+def build_index(segment_path: str) -> str:
+    """ write <segment_path>.idx for a sealed telemetry segment and return its path.
+    """
+    _, kind, record_size = read_segment_header(segment_path)
+    if kind != KIND_TELEMETRY or record_size != telemetry_record_size:
+        raise ValueError(f"{segment_path}: not a telemetry segment")
+    with open(segment_path, "rb") as f:
+        data = f.read()[segment_header_size:]
+    # a crash can leave a partial record at the end of the last segment
+    data = data[:len(data) - len(data) % telemetry_record_size]
+    rows = sorted(struct.iter_unpack(telemetry_record_format, data), key=lambda r: (r[0], r[1]))
+
+    session_ids = array("I")
+    starts = array("Q")
+    for i, row in enumerate(rows):
+        if not session_ids or row[0] != session_ids[-1]:
+            session_ids.append(row[0])
+            starts.append(i)
+    starts.append(len(rows))
+    columns = [array(code, col) for code, col in
+               zip(index_typecodes, list(zip(*rows))[1:] or ((),) * len(index_typecodes))]
+
+    index_path = segment_path + ".idx"
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(index_header_format, INDEX_MAGIC, INDEX_VERSION,
+                            b"<" if sys.byteorder == "little" else b">", len(rows), len(session_ids)))
+        for arr in [session_ids, starts] + columns:
+            size = len(arr) * arr.itemsize
+            arr.tofile(f)
+            f.write(bytes(_padding(size)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+    return index_path
+
+
+class SegmentIndex:
+    """
+    Memory-mapped reader for one .idx file.
+
+    query() binary-searches the session directory and then the timestamp
+    column, and returns memoryview slices of the mapped columns: nothing is
+    copied or decoded until the caller touches the values. Drop the returned
+    views before close(), a mapping with live views cannot be unmapped.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        magic, version, order, count, sessions = struct.unpack_from(index_header_format, self._view)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError(f"{path}: not a WTCP index")
+        if order != (b"<" if sys.byteorder == "little" else b">"):
+            raise ValueError(f"{path}: index was written with a different byte order")
+        self.count = count
+        offset = index_header_size
+        arrays = []
+        for code, n in [("I", sessions), ("Q", sessions + 1)] + [(c, count) for c in index_typecodes]:
+            size = n * struct.calcsize(code)
+            arrays.append(self._view[offset:offset + size].cast(code))
+            offset += size + _padding(size)
+        self.session_ids, self._starts = arrays[0], arrays[1]
+        self._columns = dict(zip(PDU.telemetry_fields, arrays[2:]))
+
+    def __len__(self):
+        return self.count
+
+    def sessions(self):
+        return self.session_ids.tolist()
+
+    def _session_range(self, session_id: int):
+        i = bisect.bisect_left(self.session_ids, session_id)
+        if i == len(self.session_ids) or self.session_ids[i] != session_id:
+            return 0, 0
+        return self._starts[i], self._starts[i + 1]
+
+    def query(self, session_id: int, start: int = None, end: int = None):
+        """ samples of session_id with start <= timestamp < end, as {field: memoryview}.
+        """
+        lo, hi = self._session_range(session_id)
+        ts = self._columns["timestamp"]
+        if start is not None:
+            lo = bisect.bisect_left(ts, start, lo, hi)
+        if end is not None:
+            hi = bisect.bisect_left(ts, end, lo, hi)
+        return {name: col[lo:hi] for name, col in self._columns.items()}
+
+    def close(self):
+        # column views must be released before the mapping can be closed
+        for col in self._columns.values():
+            col.release()
+        self.session_ids.release()
+        self._starts.release()
+        self._view.release()
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TelemetryArchive:
+    """
+    All indexed telemetry segments of a data directory, including the
+    worker-N subdirectories written by a multi-worker server.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.indexes = [SegmentIndex(path + ".idx") for path in telemetry_segments(directory)
+                        if os.path.exists(path + ".idx")]
+
+    def __len__(self):
+        return sum(len(ix) for ix in self.indexes)
+
+    def sessions(self):
+        return sorted(set().union(*(ix.sessions() for ix in self.indexes)))
+
+    def query(self, session_id: int, start: int = None, end: int = None):
+        """ one {field: memoryview} per segment that has matching samples, oldest segment first.
+        """
+        results = []
+        for ix in self.indexes:
+            cols = ix.query(session_id, start, end)
+            if len(cols["timestamp"]):
+                results.append(cols)
+        return results
+
+    def close(self):
+        for ix in self.indexes:
+            ix.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def telemetry_segments(directory: str):
+    """ paths of the telemetry segments under directory, grouped by directory and in write order.
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        paths += [os.path.join(root, n) for n in sorted(files)
+                  if n.startswith("telemetry-") and n.endswith(".seg")]
+    return paths
+
+
+def index_directory(directory: str, include_live: bool = False):
+    """ build missing indexes; the newest segment of each directory is still being written unless include_live.
+    """
+    segments = telemetry_segments(directory)
+    built = []
+    for i, path in enumerate(segments):
+        live = i + 1 == len(segments) or os.path.dirname(segments[i + 1]) != os.path.dirname(path)
+        if (include_live or not live) and not os.path.exists(path + ".idx"):
+            built.append(build_index(path))
+    return built
+
+
+def convert_csv(csv_path: str, directory: str, session_id: int = 0,
+                segment_bytes: int = 64 * 1024 * 1024):
+    """ convert a telemetry.csv dump into indexed segments; returns the number of samples.
+    rows without a session_id column are assigned `session_id`.
+    """
+    os.makedirs(directory, exist_ok=True)
+    record = struct.Struct(telemetry_record_format)
+    first = max(segment_numbers(directory, "telemetry"), default=0) + 1
+    writer = SegmentWriter(directory, "telemetry", KIND_TELEMETRY, telemetry_record_size, segment_bytes)
+    count = 0
+    with open(csv_path, newline="") as f:
+        buf = bytearray()
+        for row in csv.DictReader(f):
+            buf += record.pack(int(row.get("session_id") or session_id), int(row["timestamp"]),
+                               float(row["latitude"]), float(row["longitude"]), int(row["activity"]),
+                               int(row["battery"]), int(row["diag_flags"]))
+            count += 1
+            if len(buf) >= 1024 * 1024:
+                writer.write(buf)
+                buf = bytearray()
+        writer.write(buf)
+    writer.close()
+    for seq in range(first, max(segment_numbers(directory, "telemetry"), default=0) + 1):
+        build_index(os.path.join(directory, f"telemetry-{seq:06d}.seg"))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WTCP-Q telemetry storage tools")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("convert", help="convert a telemetry CSV into indexed segments")
+    p.add_argument("csv")
+    p.add_argument("directory")
+    p.add_argument("--session-id", type=int, default=0, help="session_id for rows without one")
+    p = sub.add_parser("index", help="index sealed segments that have no index yet")
+    p.add_argument("directory")
+    p.add_argument("--include-live", action="store_true", help="also index the newest segment")
+    p = sub.add_parser("query", help="print one session's samples in a time window")
+    p.add_argument("directory")
+    p.add_argument("session_id", type=int)
+    p.add_argument("--start", type=int)
+    p.add_argument("--end", type=int)
+    args = parser.parse_args()
+
+    if args.cmd == "convert":
+        n = convert_csv(args.csv, args.directory, args.session_id)
+        print(f"Converted {n} samples into {args.directory}")
+    elif args.cmd == "index":
+        for path in index_directory(args.directory, args.include_live):
+            print(f"Indexed {path}")
+    elif args.cmd == "query":
+        with TelemetryArchive(args.directory) as archive:
+            out = csv.writer(sys.stdout)
+            out.writerow(PDU.telemetry_fields)
+            for cols in archive.query(args.session_id, args.start, args.end):
+                out.writerows(zip(*cols.values()))
+                del cols  # release the views before the archive is closed
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from array import array
+from itertools import chain
+from pdu import PDU
+
+class TelemetryStore:
+    """
+    Bounded columnar store for telemetry samples.
+
+    Each field lives in its own typed array (8-byte timestamp, 4-byte floats,
+    small ints, uint32 session_id), so a sample costs 24 bytes instead of a
+    dict. Arrays grow on demand up to `capacity` samples; after that the store
+    is a ring buffer and every new sample evicts the oldest one.
+    -timestamp : uint64
+    -latitude / longitude : float32
+    -activity : uint16
+    -battery / diag_flags : uint8
+    -session_id : uint32
+    """
+    fields = PDU.telemetry_fields + ("session_id",)
+    typecodes = ("Q", "f", "f", "H", "B", "B", "I")
+    default_capacity = 4096
+
+    def __init__(self, capacity: int = None):
+        self.capacity = TelemetryStore.default_capacity if capacity is None else capacity
+        if self.capacity <= 0:
+            raise ValueError(f"capacity must be positive, got {self.capacity}")
+        self._columns = tuple(array(code) for code in TelemetryStore.typecodes)
+        self._next = 0        # slot the next sample is written to
+        self.evicted = 0      # samples lost to the capacity bound
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def append(self, session_id: int, payload: bytes):
+        """ store one raw TELEMETRY_REQUEST payload.
+        """
+        self.append_row(session_id, PDU.telemetry_struct.unpack_from(payload))
+
+    def append_row(self, session_id: int, sample):
+        """ store one sample tuple ordered like PDU.telemetry_fields.
+        """
+        sample = sample + (session_id,)
+        if len(self) < self.capacity:
+            for col, value in zip(self._columns, sample):
+                col.append(value)
+        else:
+            for col, value in zip(self._columns, sample):
+                col[self._next] = value
+            self.evicted += 1
+        self._next = (self._next + 1) % self.capacity
+
+    def append_batch(self, session_id: int, payload: bytes):
+        """ store every sample of a raw TELEMETRY_BATCH payload, column by column.
+        """
+        self.append_columns(session_id, tuple(PDU.parse_telemetry_batch(payload).values()))
+
+    def append_columns(self, session_id: int, columns):
+        """ store samples given as columns ordered like PDU.telemetry_fields.
+        """
+        count = len(columns[0])
+        if count:
+            self._write(tuple(columns) + ((session_id,) * count,), count)
+
+    def _write(self, values, count):
+        if count > self.capacity:
+            # only the newest `capacity` samples can survive anyway
+            skip = count - self.capacity
+            values = tuple(v[skip:] for v in values)
+            self.evicted += skip
+            count = self.capacity
+        start = 0
+        grow = min(count, self.capacity - len(self))
+        if grow:
+            for col, v in zip(self._columns, values):
+                col.extend(v[:grow])
+            start = grow
+            self._next = len(self) % self.capacity
+        while start < count:
+            # full: overwrite the oldest slots, wrapping at most once
+            i = self._next
+            n = min(count - start, self.capacity - i)
+            for col, v in zip(self._columns, values):
+                col[i:i + n] = array(col.typecode, v[start:start + n])
+            self.evicted += n
+            self._next = (i + n) % self.capacity
+            start += n
+
+    def _ordered(self, col):
+        if len(col) < self.capacity or self._next == 0:
+            return col
+        return col[self._next:] + col[:self._next]
+
+    def columns(self):
+        """ return {field: array} with samples oldest first.
+        """
+        return {name: self._ordered(col) for name, col in zip(TelemetryStore.fields, self._columns)}
+
+    def rows(self):
+        """ iterate samples oldest first as tuples ordered like `fields`.
+        """
+        if len(self) < self.capacity or self._next == 0:
+            return zip(*self._columns)
+        return chain(zip(*(col[self._next:] for col in self._columns)),
+                     zip(*(col[:self._next] for col in self._columns)))
+
+    def clear(self):
+        for col in self._columns:
+            del col[:]
+        self._next = 0
@@ -1,10 +1,26 @@
 # test_pdu.py
 
+import asyncio
+import os
 import struct
+import types
 import pytest
 from uuid import UUID, uuid4
 
-from pdu import PDU, PDUType
+from pdu import PDU, PDUType, PDUFramer, CAP_COMPACT_TELEMETRY
+from codec import build_telemetry_compact, decode_samples
+from telemetry_store import TelemetryStore
+from persistence import PersistencePipeline, segment_header_size, telemetry_record_size
+from storage import SegmentIndex, TelemetryArchive, build_index, convert_csv
+from sessions import SessionAllocator, SessionRegistry
+from emergency import EmergencyPipeline
+from metrics import MetricsRegistry, StreamMetrics
+from client import WTCPClientProtocol
+from spool import SampleSpool
+from aioquic.quic.configuration import QuicConfiguration
+from aioquic.quic.connection import QuicConnection
+
+HERE = os.path.dirname(os.path.abspath(__file__))
 
 def test_auth_req_roundtrip():
     device_uuid    = uuid4()
@@ -98,3 +114,871 @@ def test_unknown_type_raises():
     fake_hdr = struct.pack("!H B B I", length, 0xFF, 1, 0)
     with pytest.raises(ValueError):
         PDU.from_bytes(fake_hdr)
+
+def _telemetry_stream(count):
+    return b"".join(
+        PDU.build_telemetry(7, 1_625_000_000 + i, 1.0, 2.0, i, 50, 0).to_bytes()
+        for i in range(count))
+
+def test_encode_into_and_memoryview_decode():
+    pdus = [PDU.build_telemetry(7, 1_700_000_000 + i, 37.0, -122.0, i, 80, 0) for i in range(3)]
+    pdus.append(PDU.build_emergency(7, 1_700_000_100, 3, "fall"))
+    buf = bytearray(sum(p.encoded_size for p in pdus) + 4)
+    offset = 4
+    for p in pdus:
+        offset = p.encode_into(buf, offset)
+    assert offset == len(buf)
+    assert bytes(buf[4:]) == b"".join(p.to_bytes() for p in pdus)
+
+    view = memoryview(buf)[4:]
+    for p in pdus:
+        parsed = PDU.from_bytes(view)
+        assert parsed.pdu_type == p.pdu_type and parsed.session_id == 7
+        assert bytes(parsed.payload) == p.payload
+        view = view[parsed.encoded_size:]
+    assert PDU.parse_emergency(parsed.payload)["details"] == "fall"
+
+def test_metrics_registry_render_and_snapshot():
+    registry = MetricsRegistry()
+    streams = StreamMetrics("server", {"control": 0, "telemetry": 2}, registry)
+    streams.stream(2).rx_pdus.value += 3
+    streams.stream(2).rx_bytes.inc(84)
+    assert streams.stream(2) is streams.stream(2)
+    for us in (0.5, 3, 3000):
+        streams.decode_us.observe(us)
+    depth = [7]
+    registry.gauge("wtcp_queue_depth", "queued items", function=lambda: depth[0])
+
+    text = registry.render()
+    assert '# TYPE wtcp_server_pdus_received_total counter' in text
+    assert 'wtcp_server_pdus_received_total{stream="telemetry"} 3' in text
+    assert 'wtcp_server_decode_us_bucket{le="5"} 2' in text
+    assert 'wtcp_server_decode_us_bucket{le="+Inf"} 3' in text
+    assert 'wtcp_queue_depth 7' in text
+    depth[0] = 2
+    snap = registry.snapshot()
+    assert snap['wtcp_server_bytes_received_total{stream="telemetry"}'] == 84
+    assert snap["wtcp_queue_depth"] == 2
+    with pytest.raises(ValueError):
+        registry.gauge("wtcp_server_decode_us", "not a gauge")
+
+def test_framer_coalesced_chunk():
+    framer = PDUFramer()
+    frames = list(framer.feed(_telemetry_stream(300)))
+
+    assert len(frames) == 300
+    assert all(isinstance(f, memoryview) for f in frames)
+    assert PDU.parse_telemetry(PDU.from_bytes(frames[299]).payload)["activity"] == 299
+    assert framer.pending == 0
+
+def test_framer_split_chunks():
+    data = _telemetry_stream(5)
+    framer = PDUFramer()
+    seen = []
+    # feed one byte at a time, then in uneven slices
+    for i in range(len(data)):
+        seen += [PDU.parse_telemetry(PDU.from_bytes(f).payload)["activity"]
+                 for f in framer.feed(data[i:i + 1])]
+    for i in range(0, len(data), 13):
+        seen += [PDU.parse_telemetry(PDU.from_bytes(f).payload)["activity"]
+                 for f in framer.feed(data[i:i + 13])]
+
+    assert seen == list(range(5)) * 2
+    assert framer.pending == 0 and framer._buf is None  # nothing held between PDUs
+
+def test_framer_buffer_sized_to_pending_pdu():
+    data = _telemetry_stream(2)
+    size = len(data) // 2
+    framer = PDUFramer()
+    assert framer._buf is None
+    assert list(framer.feed(data[:1])) == [] and len(framer._buf) == PDUFramer.length_prefix.size
+    assert list(framer.feed(data[1:size - 3])) == [] and len(framer._buf) == size
+    frames = [bytes(f) for f in framer.feed(data[size - 3:size + 5])]
+    assert frames == [data[:size]] and len(framer._buf) == size and framer.pending == 5
+
+def test_framer_bad_length_raises():
+    with pytest.raises(ValueError):
+        list(PDUFramer().feed(b'\x00\x03\x01\x01'))
+
+def test_telemetry_batch_roundtrip():
+    samples = [(1_625_000_000 + i, 37.5, -122.25, i, 100 - i, i % 4) for i in range(100)]
+
+    pdu1 = PDU.build_telemetry_batch(7, samples)
+    pdu2 = PDU.from_bytes(pdu1.to_bytes())
+    columns = PDU.parse_telemetry_batch(pdu2.payload)
+
+    assert pdu2.pdu_type == PDUType.TELEMETRY_BATCH
+    assert len(pdu2.payload) == PDU.batch_header_size + 100 * PDU.telemetry_size
+    assert list(columns) == list(PDU.telemetry_fields)
+    assert list(zip(*columns.values())) == samples
+
+def test_telemetry_batch_empty_and_limits():
+    columns = PDU.parse_telemetry_batch(PDU.build_telemetry_batch(7, []).payload)
+    assert all(col == () for col in columns.values())
+
+    with pytest.raises(ValueError):
+        PDU.build_telemetry_batch(7, [(0, 0.0, 0.0, 0, 0, 0)] * (PDU.max_batch_samples + 1))
+    with pytest.raises(ValueError):
+        PDU.parse_telemetry_batch(struct.pack("!H", 2) + bytes(PDU.telemetry_size))
+
+def test_control_batch_tlvs():
+    pdu = PDU.from_bytes(PDU.build_control(5, new_rate=2, batch_size=20, batch_age_ms=1500).to_bytes())
+    assert PDU.parse_control(pdu.payload) == {"sampling_rate": 2, "batch_size": 20, "batch_age_ms": 1500}
+
+def test_client_batches_flush_by_count_age_and_emergency():
+    from aioquic.quic.events import ConnectionTerminated
+    sent = []
+
+    async def run():
+        quic = QuicConnection(configuration=QuicConfiguration(is_client=True))
+        client = WTCPClientProtocol(quic, session_id=9, rate=1, batch_size=3, batch_age=0.05)
+        quic.send_stream_data = lambda sid, data, end_stream=False: sent.append((sid, PDU.from_bytes(data)))
+        client.transmit = lambda: None
+        for ts in (1, 2, 3, 4):
+            client.buffer_sample((ts, 1.0, 2.0, 0, 90, 0))
+        assert len(sent) == 1                      # full batch of 3
+        await asyncio.sleep(0.1)
+        assert len(sent) == 2                      # sample 4 flushed by age
+        client.buffer_sample((5, 1.0, 2.0, 0, 90, 0))
+        client.handle_control(PDU.build_control(9, batch_size=10, batch_age_ms=60_000).payload)
+        client.buffer_sample((6, 1.0, 2.0, 0, 90, 0))
+        await client.send_emergency(2, "fall")     # flushes 5 and 6 first
+        client.handle_control(PDU.build_control(9, batch_age_ms=50).payload)
+        client.buffer_sample((7, 1.0, 2.0, 0, 90, 0))
+        client.quic_event_received(ConnectionTerminated(error_code=0, frame_type=None, reason_phrase=""))
+        n = len(sent)
+        await asyncio.sleep(0.1)
+        assert len(sent) == n and client._batch == []  # nothing flushed onto the closed connection
+
+    asyncio.run(run())
+    batches = [PDU.parse_telemetry_batch(p.payload)["timestamp"] for _, p in sent
+               if p.pdu_type == PDUType.TELEMETRY_BATCH]
+    assert batches == [(1, 2, 3), (4,), (5, 6)]
+    assert sent[-1][1].pdu_type == PDUType.EMERGENCY and sent[-1][0] == 4
+
+def test_compact_codec_roundtrip_and_size():
+    samples = [(1_700_000_000 + i, 37.774929 + i * 1e-5, -122.419416 - (i % 3) * 1e-5,
+                2 if i < 10 else 3, 80 - i // 10, 0) for i in range(20)]
+    pdu = PDU.from_bytes(build_telemetry_compact(7, samples).to_bytes())
+    assert pdu.pdu_type == PDUType.TELEMETRY_COMPACT
+    decoded = decode_samples(pdu.payload)
+    assert [s[0] for s in decoded] == [s[0] for s in samples]
+    assert [s[3:] for s in decoded] == [s[3:] for s in samples]
+    assert all(abs(d[1] - s[1]) < 1e-6 and abs(d[2] - s[2]) < 1e-6 for d, s in zip(decoded, samples))
+    fixed = PDU.build_telemetry_batch(7, samples).encoded_size
+    assert fixed >= 3 * pdu.encoded_size
+    with pytest.raises(ValueError):
+        decode_samples(pdu.payload[:-1])
+
+def test_auth_capability_negotiation():
+    req = PDU.build_auth_req(UUID(int=5), 10, 5.5, capabilities=CAP_COMPACT_TELEMETRY)
+    assert PDU.parse_auth_req(req.payload)["capabilities"] == CAP_COMPACT_TELEMETRY
+    # devices and servers that predate the field offer nothing
+    assert PDU.parse_auth_req(PDU.build_auth_req(UUID(int=5), 10, 5.5).payload)["capabilities"] == 0
+    assert PDU.parse_auth_resp(PDU.build_auth_resp(0, 9).payload)["capabilities"] == 0
+    resp = PDU.build_auth_resp(0, 9, capabilities=CAP_COMPACT_TELEMETRY)
+    assert PDU.parse_auth_resp(resp.payload) == {"status": 0, "session_id": 9,
+                                                 "capabilities": CAP_COMPACT_TELEMETRY}
+
+def test_sample_spool_ring_and_reopen(tmp_path):
+    path = str(tmp_path / "spool.bin")
+    spool = SampleSpool(path, capacity=4)
+    for ts in range(1, 7):
+        spool.append((ts, 1.5, 2.5, ts, 80, 0))
+    assert len(spool) == 4 and spool.dropped == 2
+    assert [s[0] for s in spool.peek(2)] == [3, 4]
+    spool.consume(1)
+    spool.close()
+
+    spool = SampleSpool(path, capacity=1024)   # capacity comes from the file
+    assert spool.capacity == 4 and spool.dropped == 2
+    assert [s[0] for s in spool.peek(10)] == [4, 5, 6]
+    assert spool.peek(1)[0][1:] == (1.5, 2.5, 4, 80, 0)
+    spool.consume(10)
+    assert len(spool) == 0 and spool.peek(5) == []
+    spool.close()
+    (tmp_path / "bad.bin").write_bytes(b"x" * 100)
+    with pytest.raises(ValueError):
+        SampleSpool(str(tmp_path / "bad.bin"))
+
+def test_telemetry_store_ring_eviction():
+    store = TelemetryStore(capacity=4)
+    for i in range(3):
+        store.append(7, PDU.build_telemetry(7, 100 + i, 1.5, 2.5, i, 90, 0).payload)
+    samples = [(200 + i, 1.5, 2.5, i, 80, 1) for i in range(3)]
+    store.append_batch(8, PDU.build_telemetry_batch(8, samples).payload)
+
+    assert len(store) == 4
+    assert store.evicted == 2
+    assert [row[0] for row in store.rows()] == [102, 200, 201, 202]
+    assert list(store.columns()["session_id"]) == [7, 8, 8, 8]
+
+    big = [(300 + i, 0.0, 0.0, 0, 0, 0) for i in range(10)]
+    store.append_batch(9, PDU.build_telemetry_batch(9, big).payload)
+    assert list(store.columns()["timestamp"]) == [306, 307, 308, 309]
+    assert store.evicted == 12
+
+def test_persistence_pipeline_segments(tmp_path):
+    async def run():
+        pipeline = PersistencePipeline(str(tmp_path), segment_bytes=segment_header_size + 10 * telemetry_record_size)
+        pipeline.start()
+        for i in range(15):
+            pipeline.submit_telemetry(3, PDU.build_telemetry(3, 100 + i, 1.0, 2.0, i, 50, 0).payload)
+        samples = [(200 + i, 1.0, 2.0, i, 50, 0) for i in range(5)]
+        pipeline.submit_telemetry_batch(4, PDU.build_telemetry_batch(4, samples).payload)
+        pipeline.submit_emergency(3, PDU.build_emergency(3, 300, 2, "fall").payload)
+        assert pipeline.backlog > 0
+        pipeline.submit_telemetry(4, PDU.build_telemetry(4, 205, 1.0, 2.0, 5, 50, 0, seq=9).payload)  # trailing seq
+        await pipeline.close()
+        assert pipeline.backlog == 0
+
+    asyncio.run(run())
+
+    segments = sorted(p.name for p in tmp_path.iterdir())
+    assert segments == ["emergency-000001.seg", "telemetry-000001.seg", "telemetry-000002.seg",
+                        "telemetry-000003.seg"]
+    records = b"".join((tmp_path / name).read_bytes()[segment_header_size:] for name in segments[1:])
+    rows = list(struct.iter_unpack("!I" + PDU.telemetry_format[1:], records))
+    assert [(r[0], r[1]) for r in rows] == [(3, 100 + i) for i in range(15)] + [(4, 200 + i) for i in range(6)]
+    assert (tmp_path / "telemetry-000001.seg").stat().st_size == segment_header_size + 10 * telemetry_record_size
+
+def test_persistence_pipeline_survives_write_errors(tmp_path):
+    async def run():
+        pipeline = PersistencePipeline(str(tmp_path), fsync_interval=0.01, max_backlog=3 * telemetry_record_size)
+        written = pipeline._write
+        def broken(telemetry):
+            raise OSError("disk full")
+        pipeline._write = broken
+        pipeline.start()
+        payload = PDU.build_telemetry(3, 100, 1.0, 2.0, 0, 50, 0).payload
+        for _ in range(5):
+            pipeline.submit_telemetry(3, payload)
+        assert pipeline.backlog == 3 * telemetry_record_size  # the rest is over the cap
+        assert pipeline.dropped_bytes == 2 * telemetry_record_size
+        await asyncio.sleep(0.05)
+        assert (pipeline.write_errors, pipeline.lost_bytes) == (1, 3 * telemetry_record_size)
+        pipeline._write = written
+        pipeline.submit_telemetry(3, payload)
+        await asyncio.sleep(0.05)  # the background task is still draining
+        assert pipeline.backlog == 0 and pipeline.written_bytes == telemetry_record_size
+        await pipeline.close()
+
+    asyncio.run(run())
+
+def test_emergency_pipeline_priority_and_durability(tmp_path):
+    handled = []
+
+    async def run():
+        persistence = PersistencePipeline(str(tmp_path))
+        persistence.start()
+        record_size = 4 + 2 + PDU.build_emergency(1, 0, 0, "x").encoded_size - PDU.header_size
+
+        def on_disk(alert):
+            # the record must be durable before any sink sees the alert
+            size = (tmp_path / "emergency-000001.seg").stat().st_size
+            handled.append((alert["alert_code"], size - segment_header_size >= record_size))
+
+        def broken(alert):
+            raise RuntimeError("sink down")
+
+        pipeline = EmergencyPipeline(persistence, sinks=[broken, on_disk],
+                                     priority=lambda alert: -alert["alert_code"])
+        pipeline.submit(1, PDU.build_emergency(1, 1_700_000_000, 1, "x").payload)
+        pipeline.submit(2, PDU.build_emergency(2, 1_700_000_000, 3, "y").payload)
+        pipeline.submit(3, PDU.build_emergency(3, 1_700_000_000, 2, "z").payload)
+        pipeline.start()
+        await pipeline.close()
+        await persistence.close()
+        return pipeline
+
+    pipeline = asyncio.run(run())
+    assert handled == [(3, True), (2, True), (1, True)]
+    assert pipeline.handled.value == 3 and len(pipeline) == 0
+    assert pipeline.handle_latency.count == 3 and pipeline.device_latency.count == 3
+
+def test_emergency_pipeline_survives_failed_writes():
+    class Persistence:  # every write fails, one way or another
+        def __init__(self):
+            self.outcomes = [ValueError("bad record"), None, OSError("disk full")]
+
+        def append_emergency(self, session_id, payload):
+            future = asyncio.get_running_loop().create_future()
+            outcome = self.outcomes.pop(0)
+            if outcome is None:
+                future.cancel()  # the writer shut down
+            else:
+                future.set_exception(outcome)
+            return future
+
+    async def run():
+        handled = []
+        pipeline = EmergencyPipeline(Persistence(), sinks=[handled.append], metrics=MetricsRegistry())
+        pipeline.start()
+        for sid in (1, 2, 3):
+            pipeline.submit(sid, PDU.build_emergency(sid, 1_700_000_000, 1, "x").payload)
+            await asyncio.sleep(0)
+        await pipeline.close()
+        return handled
+
+    assert [alert["session_id"] for alert in asyncio.run(run())] == [1, 2, 3]
+
+def test_storage_convert_and_query(tmp_path):
+    csv_path = tmp_path / "telemetry.csv"
+    lines = ["timestamp,latitude,longitude,activity,battery,diag_flags,session_id"]
+    lines += [f"{1000 + i // 2},1.5,2.5,{i},50,0,{i % 2 + 1}" for i in range(200)]
+    csv_path.write_text("\n".join(lines) + "\n")
+
+    assert convert_csv(str(csv_path), str(tmp_path / "data"),
+                       segment_bytes=segment_header_size + 64 * telemetry_record_size) == 200
+    with TelemetryArchive(str(tmp_path / "data")) as archive:
+        assert len(archive.indexes) == 4
+        assert archive.sessions() == [1, 2]
+        results = archive.query(2, start=1010, end=1040)
+        timestamps = [ts for cols in results for ts in cols["timestamp"]]
+        activities = [a for cols in results for a in cols["activity"]]
+        assert all(isinstance(cols["latitude"], memoryview) for cols in results)
+        del results
+
+    assert timestamps == list(range(1010, 1040))
+    assert activities == [2 * (ts - 1000) + 1 for ts in timestamps]
+
+def test_pipeline_indexes_sealed_segments(tmp_path):
+    async def run():
+        pipeline = PersistencePipeline(str(tmp_path), index_segment=build_index)
+        pipeline.start()
+        for i in (5, 3, 4):
+            pipeline.submit_telemetry(9, PDU.build_telemetry(9, i, 1.0, 2.0, i, 50, 0).payload)
+        await pipeline.close()
+
+    asyncio.run(run())
+    with SegmentIndex(str(tmp_path / "telemetry-000001.seg.idx")) as index:
+        assert index.sessions() == [9]
+        assert index.query(9)["timestamp"].tolist() == [3, 4, 5]
+
+def test_session_allocator_unique_across_workers():
+    allocators = [SessionAllocator(worker, 4) for worker in range(4)]
+    ids = [a.allocate() for _ in range(100) for a in allocators]
+
+    assert len(set(ids)) == len(ids) == 400
+    assert sorted(ids) == list(range(1, 401))
+    assert all(a.owns(a.allocate()) for a in allocators)
+    assert not allocators[0].owns(allocators[1].allocate())
+    with pytest.raises(ValueError):
+        SessionAllocator(4, 4)
+
+class _FakeSession:
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.sent = []
+        self.transmits = 0
+
+    def send_encoded(self, pdu_type, data):
+        self.sent.append((pdu_type, data))
+
+    def transmit(self):
+        self.transmits += 1
+
+def test_registry_fan_out():
+    registry = SessionRegistry()
+    fakes = [_FakeSession(sid) for sid in range(1, 6)]
+    for fake in fakes:
+        registry.register(fake.session_id, fake)
+    registry.unregister(5)
+
+    assert registry.send_control(new_rate=30) == 4
+    assert registry.send_sleep(wake=True, sessions=[2, 3, 99]) == 2
+    assert registry.send_control(new_radius=2.5, sessions=lambda p: p.session_id % 2) == 2
+
+    for fake in fakes[:4]:
+        pdu = PDU.from_bytes(fake.sent[0][1])
+        assert (pdu.pdu_type, pdu.session_id) == (PDUType.CONTROL, fake.session_id)
+        assert PDU.parse_control(pdu.payload) == {"sampling_rate": 30}
+        assert fake.transmits == len(fake.sent)
+    assert [len(f.sent) for f in fakes] == [2, 2, 3, 1, 0]
+    assert PDU.parse_sleep(PDU.from_bytes(fakes[1].sent[1][1]).payload) is True
+
+def _ticket(label, server_name="localhost", valid=True):
+    import datetime
+    from aioquic.tls import CipherSuite, SessionTicket
+    now = datetime.datetime.now(datetime.timezone.utc)
+    hour = datetime.timedelta(hours=1)
+    return SessionTicket(age_add=0, cipher_suite=CipherSuite.AES_128_GCM_SHA256,
+                         not_valid_after=now + hour if valid else now - hour, not_valid_before=now - 2 * hour,
+                         resumption_secret=b"s" * 32, server_name=server_name, ticket=label)
+
+def server_config() -> QuicConfiguration:
+    cfg = QuicConfiguration(is_client=False)
+    cfg.load_cert_chain(os.path.join(HERE, "cert.pem"), os.path.join(HERE, "key.pem"))
+    return cfg
+
+def server_protocol(sent=None, resumed_with=None, **kwargs):
+    """
+    A WTCPServerProtocol on a fresh server-side QuicConnection, without a
+    handshake: PDUs it sends are appended to `sent` (or dropped), and with
+    `resumed_with` the connection resumes with the ticket of that label.
+    Call it inside a running event loop.
+    """
+    from server import WTCPServerProtocol
+    kwargs.setdefault("registry", SessionRegistry())
+    quic = QuicConnection(configuration=server_config(), original_destination_connection_id=os.urandom(8))
+    proto = WTCPServerProtocol(quic, **kwargs)
+    ticket = proto._quic._session_ticket_fetcher(resumed_with) if resumed_with else None
+    proto._quic.tls = types.SimpleNamespace(session_resumed=ticket is not None)
+    proto.send_pdu = (lambda pdu: None) if sent is None else sent.append
+    return proto
+
+def test_session_tickets(tmp_path):
+    from tickets import TicketStore, TicketCache
+    store = TicketStore(max_tickets=2)
+    for label in (b"a", b"b", b"c"):
+        store.add(_ticket(label))
+    store.add(_ticket(b"old", valid=False))
+    assert len(store) == 2 and store.pop(b"a") is None  # evicted
+    assert store.pop(b"c").ticket == b"c"
+    assert store.pop(b"c") is None  # single use: a 0-RTT replay gets a full handshake
+    assert store.pop(b"old") is None
+
+    path = str(tmp_path / "ticket")
+    TicketCache(path).put(_ticket(b"t"))
+    cache = TicketCache(path)  # a restarted client
+    assert cache.get("localhost").ticket == b"t"
+    assert cache.get("elsewhere") is None
+    cache.put(_ticket(b"expired", valid=False))
+    assert TicketCache(path).get("localhost") is None
+
+def test_resumed_device_keeps_session_id():
+    from tickets import TicketStore
+    registry = SessionRegistry()
+    allocator = SessionAllocator()
+    store = TicketStore()
+
+    async def auth(device_uuid, resumed_with=None, issue=None, issue_first=False):
+        proto = server_protocol(resumed_with=resumed_with, sessions=allocator, registry=registry, tickets=store)
+        if issue and issue_first:
+            proto._quic._session_ticket_handler(_ticket(issue))  # handshake done before AUTH
+        proto.handle_pdu(0, PDU.build_auth_req(device_uuid, 1, 0.0))
+        if issue and not issue_first:
+            proto._quic._session_ticket_handler(_ticket(issue))
+        return proto.session_id
+
+    async def scenario():
+        device = uuid4()
+        first = await auth(device, issue=b"t1", issue_first=True)
+        assert await auth(device, resumed_with=b"t1", issue=b"t2") == first
+        assert await auth(device, resumed_with=b"t1") != first  # single use
+        assert await auth(device) != first  # no ticket, no reuse
+        # another device's UUID does not get its session; the ticket decides
+        other = await auth(uuid4(), issue=b"t3")
+        assert await auth(device, resumed_with=b"t3") == other
+        assert await auth(device, resumed_with=b"t2") == first
+        nil = await auth(UUID(int=0), issue=b"t4")
+        assert await auth(UUID(int=0), resumed_with=b"t4") != nil
+    asyncio.run(scenario())
+
+def test_sequence_windows_freed_with_their_sessions(tmp_path):
+    from aioquic.quic.events import ConnectionTerminated
+    from pdu import CAP_SEQUENCE
+    from sequence import SequenceWindows
+    from server import forget_released
+    from tickets import TicketStore
+    registry, allocator, windows = SessionRegistry(), SessionAllocator(), SequenceWindows()
+    store = TicketStore(max_tickets=2, on_released=forget_released(registry, windows))
+
+    async def connect(device_uuid, resumed_with=None, issue=None):
+        proto = server_protocol(resumed_with=resumed_with, sessions=allocator, registry=registry, sequences=windows,
+                                tickets=store, telemetry_file=str(tmp_path / "telemetry.csv"))
+        proto.handle_pdu(0, PDU.build_auth_req(device_uuid, 1, 0.0, capabilities=CAP_SEQUENCE))
+        proto.handle_pdu(2, PDU.build_telemetry(proto.session_id, 1, 40.0, 10.0, 0, 90, 0, seq=1))
+        if issue:
+            proto._quic._session_ticket_handler(_ticket(issue))
+        return proto
+
+    def close(proto):
+        proto.quic_event_received(ConnectionTerminated(error_code=0, frame_type=None, reason_phrase=""))
+
+    async def scenario():
+        device = uuid4()
+        first = await connect(device, issue=b"t1")
+        close(first)
+        assert len(windows) == 1  # the ticket can still bring the session back
+        second = await connect(device)  # no resumption: a new session
+        close(second)
+        assert len(windows) == 1
+        resumed = await connect(device, resumed_with=b"t1")
+        assert resumed.session_id == first.session_id and len(windows) == 1
+        close(resumed)
+        assert len(windows) == 0  # resumed without being issued a new ticket
+        live = await connect(device, issue=b"t2")
+        nil = await connect(UUID(int=0), issue=b"t3")  # cannot resume into its session: no window kept
+        close(nil)
+        assert len(windows) == 1
+        last = await connect(uuid4(), issue=b"t4")  # evicts t2 while its session is live
+        close(live)
+        assert len(windows) == 1 and not store.holds(live.session_id)
+        close(last)
+        assert len(windows) == 1
+        for label in (b"t5", b"t6"):  # t3, then t4 are evicted
+            close(await connect(UUID(int=0), issue=label))
+        assert len(windows) == 0
+    asyncio.run(scenario())
+
+def test_timer_wheel():
+    from timerwheel import TimerWheel
+    from aioquic.quic.events import ConnectionTerminated
+    now = [0.0]
+    wheel = TimerWheel(tick=1.0, slots=4, levels=3, clock=lambda: now[0])
+    fired = []
+    # spread over every level, including past the wheel's 64-tick span
+    timers = {d: wheel.schedule(d, lambda d: fired.append((d, now[0])), d) for d in (0.5, 3, 4, 17, 40, 63, 100)}
+    timers[17].cancel()
+    timers[17].cancel()
+    assert len(wheel) == 6
+    for t in range(1, 120):
+        now[0] = float(t)
+        wheel.advance()
+    assert [d for d, _ in fired] == [0.5, 3, 4, 40, 63, 100] and len(wheel) == 0
+    assert all(d <= t < d + 1 for d, t in fired)  # within one tick of the deadline
+
+    # a server session arms one WAKE timer and drops it on disconnect
+    wheel = TimerWheel(tick=1.0, clock=lambda: now[0])
+
+    async def session():
+        sent = []
+        proto = server_protocol(sent, timers=wheel)
+        proto.transmit = lambda: None
+        proto.handle_pdu(0, PDU.build_auth_req(uuid4(), 1, 0.0))
+        assert len(wheel) == 1
+        now[0] += proto.wake_interval + 1
+        wheel.advance()
+        assert sent[-1].pdu_type == PDUType.WAKE and len(wheel) == 1
+        proto.quic_event_received(ConnectionTerminated(error_code=0, frame_type=None, reason_phrase=""))
+        assert len(wheel) == 0
+    asyncio.run(session())
+
+def test_geofence():
+    from geofence import GeofenceEngine, GEOFENCE_ALERT, METRES_PER_DEGREE
+    engine = GeofenceEngine()
+    step = 100 / METRES_PER_DEGREE  # 100 m north
+    engine.set_fence(1, 250.0)  # anchored at the first position
+    assert engine.observe(1, (1, 2), (37.0, 37.0 + step), (-122.0, -122.0)) == []
+    alerts = engine.observe(1, (3, 4, 5), (37.0 + 2 * step, 37.0 + 3 * step, 37.0 + 4 * step), (-122.0,) * 3)
+    assert len(alerts) == 1
+    alert = PDU.parse_emergency(alerts[0])
+    assert (alert["timestamp"], alert["alert_code"]) == (4, GEOFENCE_ALERT)
+    assert engine.observe(1, (6,), (37.0 + 5 * step,), (-122.0,)) == []  # still outside: no repeat
+    engine.observe(1, (7,), (37.0,), (-122.0,))
+    assert len(engine.observe(1, (8,), (37.0 - 3 * step,), (-122.0,))) == 1  # back in, out again
+    assert engine.breaches.value == 2
+
+    engine.observe(2, (1,), (37.0 + 2 * step,), (-122.0,))  # no fence, still indexed
+    engine.observe(3, (1,), (38.0,), (-122.0,))
+    assert engine.within(37.0, -122.0, 500) == [1, 2]
+    assert engine.within(37.0, -122.0, 200_000) == [1, 2, 3]
+    engine.remove(2)
+    assert engine.within(37.0, -122.0, 500) == [1]
+
+    # a breach reaches the same emergency path as an EMERGENCY PDU
+    async def session():
+        proto = server_protocol(geofence=engine)
+        proto.handle_pdu(0, PDU.build_auth_req(uuid4(), 1, 50.0))
+        sid = proto.session_id
+        samples = [(10, 40.0, 10.0, 0, 90, 0), (11, 40.001, 10.0, 0, 90, 0)]  # ~111 m apart
+        proto.handle_pdu(2, PDU.build_telemetry_batch(sid, samples))
+        assert [a["alert_code"] for a in proto.emergencies] == [GEOFENCE_ALERT]
+        assert engine.fence(sid).radius == 50.0
+    asyncio.run(session())
+
+def test_capture_roundtrip_and_in_process_replay(tmp_path):
+    from capture import CaptureWriter, read_capture, replay_in_process, CLOSE_STREAM
+    from aioquic.quic.events import StreamDataReceived, ConnectionTerminated
+    path = str(tmp_path / "cap.bin")
+    writer = CaptureWriter(path)
+    a, b = writer.open_connection(), writer.open_connection()
+    auth = PDU.build_auth_req(uuid4(), 1, 0.0).to_bytes()
+    writer.record(a, 0, auth)
+    writer.record(b, 0, auth)
+    writer.record(a, 2, b"\x00\x01\x02")
+    writer.close_connection(a)
+    writer.close()
+    records = list(read_capture(path))
+    assert [(c, s, None if f is None else bytes(f)) for _, c, s, f in records] == \
+        [(a, 0, auth), (b, 0, auth), (a, 2, b"\x00\x01\x02"), (a, CLOSE_STREAM, None)]
+    assert all(r0[0] <= r1[0] for r0, r1 in zip(records, records[1:]))
+    with open(path, "ab") as f:
+        f.write(b"\x00" * 5)  # a record cut off mid-write is ignored
+    assert len(list(read_capture(path))) == 4
+
+    class Recorder:
+        def __init__(self, connection):
+            self.events = []
+            seen[connection] = self.events
+
+        def quic_event_received(self, event):
+            self.events.append(event)
+    seen = {}
+    stats = asyncio.run(replay_in_process(path, 0, Recorder))
+    assert (stats["connections"], stats["frames"]) == (2, 3)
+    assert [type(e) for e in seen[a]] == [StreamDataReceived, StreamDataReceived, ConnectionTerminated]
+    assert [type(e) for e in seen[b]] == [StreamDataReceived, ConnectionTerminated]  # closed at the end
+    assert seen[a][1].stream_id == 2 and seen[a][0].data == auth
+
+    async def flushed():
+        writer = CaptureWriter(path, flush_interval=0.01)
+        writer.start()
+        writer.record(writer.open_connection(), 0, auth)
+        await asyncio.sleep(0.05)
+        assert len(list(read_capture(path))) == 1  # on disk before close()
+        writer.close()
+    asyncio.run(flushed())
+
+def test_send_queue_coalescing_priority_and_backpressure():
+    from sendqueue import SendQueue
+
+    class FakeQuic:
+        def __init__(self):
+            self._streams = {}
+            self.sent = []
+
+        def send_stream_data(self, sid, data, end_stream=False):
+            stream = self._streams.setdefault(sid, types.SimpleNamespace(sender=types.SimpleNamespace(_buffer=b"")))
+            stream.sender._buffer += data  # nothing is ever acknowledged
+            self.sent.append((sid, bytes(data)))
+
+    async def scenario():
+        quic = FakeQuic()
+        transmits = []
+        q = SendQueue(quic, lambda: (q.drain(), transmits.append(len(quic.sent))), urgent=(0, 4),
+                      max_buffered=180, metrics=MetricsRegistry())
+        bulk = [bytes([i]) * 40 for i in range(4)]
+        q.push(2, PDUType.TELEMETRY_REQUEST, bulk[0])
+        q.push(0, PDUType.CONTROL, PDU.build_control(7, new_rate=5).to_bytes())
+        q.push(0, PDUType.CONTROL, PDU.build_control(7, new_radius=50.0).to_bytes())
+        q.push(0, PDUType.SLEEP, PDU.build_sleep(7).to_bytes())
+        q.push(0, PDUType.CONTROL, PDU.build_control(7, new_rate=9).to_bytes())
+        for data in bulk[1:]:
+            q.push(2, PDUType.TELEMETRY_REQUEST, data)  # 203 bytes > 180: the oldest bulk PDU goes
+        assert q.dropped.value == 1 and q.coalesced.value == 1
+        await asyncio.sleep(0)
+        assert transmits == [len(quic.sent)]  # one transmit for the whole tick
+        assert [sid for sid, _ in quic.sent] == [0, 0, 0, 2, 2, 2]
+        control = PDU.from_bytes(quic.sent[0][1])
+        assert (control.pdu_type, control.session_id) == (PDUType.CONTROL, 7)
+        assert PDU.parse_control(control.payload) == {"sampling_rate": 5, "geofence_radius": 50.0}
+        assert PDU.from_bytes(quic.sent[1][1]).pdu_type == PDUType.SLEEP
+        # queued behind the SLEEP, so not merged into the earlier CONTROL
+        assert PDU.parse_control(PDU.from_bytes(quic.sent[2][1]).payload) == {"sampling_rate": 9}
+        assert [data for sid, data in quic.sent[3:]] == bulk[1:]
+
+        # over the cap: every stream waits for ACKs, a repeated WAKE is skipped
+        quic._streams[0].sender._buffer, quic._streams[2].sender._buffer = b"", b"x" * 200
+        sent = len(quic.sent)
+        wake, sleep = PDU.build_wake(7).to_bytes(), PDU.build_sleep(7).to_bytes()
+        q.push(2, PDUType.TELEMETRY_REQUEST, bulk[0])
+        q.push(0, PDUType.WAKE, wake)
+        q.push(0, PDUType.WAKE, wake)
+        await asyncio.sleep(0)
+        assert len(quic.sent) == sent and len(q) == 2 and q.held.value == 2
+        # the backlog sheds bulk PDUs and WAKEs, never SLEEPs
+        for _ in range(15):
+            q.push(0, PDUType.SLEEP, sleep)
+            q.push(0, PDUType.WAKE, wake)
+        assert q.buffered - q.unacknowledged() <= 180 and q.dropped.value == 1 + 1 + 11
+        quic._streams[2].sender._buffer = b""  # acknowledged
+        q.drain()
+        types_sent = [PDU.from_bytes(data).pdu_type for _, data in quic.sent[sent:]]
+        assert types_sent.count(PDUType.SLEEP) == 15 and types_sent[-1] == PDUType.WAKE and len(q) == 0
+    asyncio.run(scenario())
+
+def test_server_control_every_n_telemetry_pdus():
+    async def session():
+        sent = []
+        proto = server_protocol(sent)
+        proto.handle_pdu(0, PDU.build_auth_req(uuid4(), 1, 0.0))
+        sid = proto.session_id
+        for i in range(proto.control_every * 2):
+            proto.handle_pdu(2, PDU.build_telemetry_batch(sid, [(i, 40.0, 10.0, 0, 90, 0)]))
+            proto.handle_pdu(0, PDU.build_telemetry(sid, i, 40.0, 10.0, 0, 90, 0))  # only the telemetry stream counts
+        assert [p.pdu_type for p in sent] == [PDUType.AUTH_RESPONSE, PDUType.CONTROL, PDUType.CONTROL]
+        proto.handle_pdu(4, PDU.build_emergency(sid, 99, 1, "fall"))
+        assert proto.emergencies[0]["alert_code"] == 1 and sent[-1].pdu_type == PDUType.TERMINATE
+    asyncio.run(session())
+
+def test_rollups_buckets_latest_and_retention():
+    from rollups import RollupStore
+    store = RollupStore(retention={"minute": 2, "hour": 2}, max_sessions=2)
+    t0 = 1_700_000_080  # 40 s into a minute
+    rows = [(t0, 1.0, 2.0, 3, 90, 0x01), (t0 + 10, 1.1, 2.1, 5, 80, 0x04),
+            (t0 + 30, 1.2, 2.2, 1, 70, 0x00)]  # the last one is in the next minute
+    store.add_columns(7, tuple(zip(*rows)))
+    store.add_sample(7, PDU.build_telemetry(7, t0 + 31, 1.3, 2.3, 2, 60, 0x02).payload)
+    minutes = store.series("minute", 7)
+    assert [(b["start"], b["count"]) for b in minutes] == [(t0 - 40, 2), (t0 + 20, 2)]
+    assert (minutes[0]["battery_min"], minutes[0]["battery_max"], minutes[0]["battery_mean"]) == (80, 90, 85)
+    assert (minutes[0]["diag_flags"], minutes[1]["diag_flags"], minutes[1]["activity_mean"]) == (0x05, 0x02, 1.5)
+
+    store.add_columns(7, tuple(zip((t0 - 100, 0.0, 0.0, 0, 10, 0))))  # replayed backlog: too old a minute, same hour
+    assert store.late.value == 1 and store.latest()[7]["latitude"] == pytest.approx(1.3)
+    assert store.latest()[7]["samples"] == 5
+
+    store.add_sample(8, PDU.build_telemetry(8, t0, 0.0, 0.0, 0, 10, 0x80).payload)
+    assert store.status()["battery_min"] == 10 and store.status()["low_battery"] == [8]
+    fleet = store.series("hour")
+    assert len(fleet) == 1 and fleet[0]["count"] == 6 and fleet[0]["diag_flags"] == 0x87
+    store.add_sample(9, PDU.build_telemetry(9, t0, 0.0, 0.0, 0, 50, 0).payload)
+    assert sorted(store.latest()) == [8, 9] and store.series("minute", 7) == []  # 7 was least recent
+
+def test_sequence_windows_dedup_gaps_and_reset():
+    from sequence import SequenceCounter, SequenceWindows, SEQ_WINDOW
+    w = SequenceWindows(metrics=MetricsRegistry())
+    top = 0xFFFFFFFF
+    assert w.accept(1, top - 1, 3) is None             # wraps past 2**32
+    assert w.accept(1, top, 1) == [False]              # retransmit
+    assert w.accept(1, 3, 2) is None and w.lost.value == 0  # 1 and 2 not seen yet
+    assert w.accept(1, 2, 3) == [True, False, False]   # late 2, then a replay of 3 and 4
+    w.accept(1, 5 + SEQ_WINDOW, 1)                     # 1 and 5 leave the window unseen
+    assert (w.duplicates.value, w.lost.value) == (3, 2)
+    assert w.accept(1, 4, 1) == [False]                # too old to tell: dropped
+    assert w.accept(1, 0x80000000, 1) is None and w.resets.value == 1  # device restarted
+    w.forget(1)
+    assert len(w) == 0 and w.accept(2, 7, 1) is None and len(w._high) == 1  # slot reused
+    counter = SequenceCounter(top)
+    assert (counter.take(2), counter.take()) == (top, 1)
+
+def test_server_drops_duplicate_telemetry():
+    from codec import build_telemetry_compact
+    from pdu import CAP_SEQUENCE
+    from sequence import SequenceWindows
+
+    async def session():
+        windows = SequenceWindows()
+        sent = []
+        proto = server_protocol(sent, sequences=windows)
+        proto.handle_pdu(0, PDU.build_auth_req(uuid4(), 1, 0.0, capabilities=CAP_SEQUENCE | CAP_COMPACT_TELEMETRY))
+        assert PDU.parse_auth_resp(sent[0].payload)["capabilities"] & CAP_SEQUENCE
+        sid = proto.session_id
+        samples = [(t, 40.0, 10.0, 0, 90, 0) for t in range(10, 15)]
+        batch = PDU.build_telemetry_batch(sid, samples[:3], seq=100)
+        proto.handle_pdu(2, batch)
+        proto.handle_pdu(2, batch)  # sent twice
+        proto.handle_pdu(2, build_telemetry_compact(sid, samples[2:4], 102))  # overlaps by one
+        proto.handle_pdu(2, PDU.build_telemetry(sid, *samples[4], seq=104))
+        proto.handle_pdu(2, PDU.build_telemetry(sid, *samples[4], seq=104))
+        assert [row[0] for row in proto.telemetry.rows()] == [10, 11, 12, 13, 14]
+        assert windows.duplicates.value == 5
+    asyncio.run(session())
+
+def test_compiled_state_machine_and_dispatch_tables():
+    from state_machine import (SERVER_TRANSITIONS, ServerState, StateMachine, StateMachineError,
+                               compile_dispatch)
+    from server import SERVER_HANDLERS, STREAM_IDS, WTCPServerProtocol
+    for (state, pdu_type) in ((s, t) for s in ServerState for t in PDUType):
+        sm = StateMachine(state, SERVER_TRANSITIONS)
+        if (state, pdu_type) in SERVER_TRANSITIONS:
+            assert sm.on_pdu(PDU(pdu_type, 1, 0, b"")) == (state, SERVER_TRANSITIONS[(state, pdu_type)])
+        else:
+            with pytest.raises(StateMachineError):
+                sm.advance(pdu_type)
+            assert sm.state is state
+
+    class Override(WTCPServerProtocol):
+        def on_control(self, pdu):
+            pass
+    base = compile_dispatch(WTCPServerProtocol, SERVER_HANDLERS, STREAM_IDS.values())
+    sub = compile_dispatch(Override, SERVER_HANDLERS, STREAM_IDS.values())
+    assert base is compile_dispatch(WTCPServerProtocol, SERVER_HANDLERS, STREAM_IDS.values())
+    assert base[STREAM_IDS['control']][PDUType.CONTROL] is WTCPServerProtocol.on_control
+    assert sub[STREAM_IDS['control']][PDUType.CONTROL] is Override.on_control
+    assert base[STREAM_IDS['emergency']][PDUType.TELEMETRY_REQUEST] is None
+
+def test_batched_receive_server_handshake_and_ping():
+    import ssl
+    from aioquic.asyncio import connect, QuicConnectionProtocol
+    from netio import bound_socket, serve_batched
+    cfg = server_config()
+    client_cfg = QuicConfiguration(is_client=True)
+    client_cfg.verify_mode = ssl.CERT_NONE
+
+    async def session():
+        sock = bound_socket("127.0.0.1", 0)
+        server = await serve_batched("127.0.0.1", 0, sock=sock, batch=8, configuration=cfg,
+                                     create_protocol=QuicConnectionProtocol)
+        port = sock.getsockname()[1]
+        async with connect("127.0.0.1", port, configuration=client_cfg) as client:
+            await asyncio.wait_for(client.ping(), 5)
+        assert server.datagrams.value >= 2
+        assert 0 < server.wakeups.value <= server.datagrams.value
+        server.close()
+    asyncio.run(session())
+
+def test_analytics_chunked_map_reduce(tmp_path):
+    from analytics import _bounded_map, plan_chunks, summarize, write_summaries
+    from persistence import SegmentWriter, KIND_TELEMETRY
+    from storage import telemetry_record_format
+    record = struct.Struct(telemetry_record_format)
+    (tmp_path / "data").mkdir()
+    writer = SegmentWriter(str(tmp_path / "data"), "telemetry", KIND_TELEMETRY, telemetry_record_size,
+                           segment_header_size + 50 * telemetry_record_size)
+    csv_lines = ["timestamp,latitude,longitude,activity,battery,diag_flags,session_id"]
+    # session 1: two trips 1 h apart, 0.001 deg north per minute, 1% battery per 10 min
+    for i in range(120):
+        t = 1_700_000_000 + i * 60 + (3600 if i >= 60 else 0)
+        writer.write(record.pack(1, t, 40.0 + i * 0.001, 10.0, 2, 100 - i // 10, 0x01 if i % 4 else 0x81))
+        csv_lines.append(f"{t},{40.0 + i * 0.001},10.0,2,{100 - i // 10},{0x01 if i % 4 else 0x81},7")
+    writer.write(record.pack(2, 1_700_000_000, 1.0, 1.0, 0, 50, 0))
+    writer.close()
+    (tmp_path / "t.csv").write_text("\n".join(csv_lines) + "\n")
+
+    serial = summarize([str(tmp_path / "data"), str(tmp_path / "t.csv")], processes=1, chunk_bytes=300)
+    pooled = summarize([str(tmp_path / "data"), str(tmp_path / "t.csv")], processes=2)
+    rows = {sid: s.as_row(sid) for sid, s in serial.items()}
+    assert rows == {sid: s.as_row(sid) for sid, s in pooled.items()}
+    _, samples, first, last, trips, distance, moving, drain, bmin, bmax, _, ooo, *bits = rows[1]
+    assert (samples, trips, bmin, bmax, ooo) == (120, 2, 89, 100, 0)
+    assert first == 1_700_000_000 and last == first + 119 * 60 + 3600
+    assert abs(distance - 118 * 0.001 * 6_371_000 * 3.14159265 / 180) < 1
+    assert moving == 118 * 60 and bits[0] == 120 and bits[7] == 30
+    assert rows[7][1:5] + rows[7][6:] == rows[1][1:5] + rows[1][6:]  # the CSV has float64 positions
+    assert rows[2][1] == 1
+    with open(tmp_path / "out.csv", "w", newline="") as f:
+        write_summaries(serial, f)
+    assert len((tmp_path / "out.csv").read_text().splitlines()) == 4
+
+    class Pool:  # runs a task when its result is collected
+        outstanding = most = 0
+
+        def apply_async(self, fn, args):
+            self.outstanding += 1
+            self.most = max(self.most, self.outstanding)
+            return types.SimpleNamespace(get=lambda: self.collect(fn, args))
+
+        def collect(self, fn, args):
+            self.outstanding -= 1
+            return fn(*args)
+    pool = Pool()
+    tasks = ((chunk, 300.0, 0) for chunk in plan_chunks([str(tmp_path / "data")], 300))
+    assert sum(sum(s.count for s in part.values()) for part in _bounded_map(pool, tasks, 4)) == 121
+    assert pool.most == 4
+
+def test_server_survives_short_payloads():
+    from aioquic.quic.events import StreamDataReceived
+    from server import stream_metrics
+
+    async def session():
+        proto = server_protocol()
+        proto.handle_pdu(0, PDU.build_auth_req(uuid4(), 1, 0.0))
+        sid = proto.session_id
+        errors = stream_metrics.decode_errors.value
+        data = (PDU(PDUType.TELEMETRY_REQUEST, 1, sid, b"\x00\x01\x02").to_bytes()
+                + PDU.build_telemetry(sid, 5, 40.0, 10.0, 0, 90, 0).to_bytes())
+        proto.quic_event_received(StreamDataReceived(data=data, end_stream=False, stream_id=2))
+        assert stream_metrics.decode_errors.value == errors + 1
+        assert [row[0] for row in proto.telemetry.rows()] == [5]  # the rest of the chunk still counts
+        # compact telemetry was not negotiated
+        compact = build_telemetry_compact(sid, [(6, 40.0, 10.0, 0, 90, 0)]).to_bytes()
+        proto.quic_event_received(StreamDataReceived(data=compact, end_stream=False, stream_id=2))
+        assert stream_metrics.decode_errors.value == errors + 2 and len(proto.telemetry) == 1
+        # the header's session_id is the device's claim; the samples belong to the authenticated session
+        proto.handle_pdu(2, PDU.build_telemetry_batch(sid + 1, [(7, 40.0, 10.0, 0, 90, 0)]))
+        proto.handle_pdu(2, PDU.build_telemetry(sid + 1, 8, 40.0, 10.0, 0, 90, 0))
+        assert [(row[0], row[-1]) for row in proto.telemetry.rows()] == [(5, sid), (7, sid), (8, sid)]
+    asyncio.run(session())
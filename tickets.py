@@ -0,0 +1,124 @@
+import logging
+import os
+import pickle
+from collections import OrderedDict
+
+# TLS 1.3 session tickets for QUIC resumption.
+#
+# A resumed handshake skips the certificate signature on the server (most of
+# its handshake CPU) and lets the client send 0-RTT early data, so the
+# AUTH_REQUEST rides in the first flight next to the ClientHello. If the
+# server no longer knows the ticket, aioquic falls back to a full handshake
+# and resends the early data in 1-RTT, so a stale ticket only costs time.
+
+log = logging.getLogger("wtcp.tickets")
+
+
+class TicketStore:
+    """
+    Server side: tickets issued by this process, for serve()'s
+    session_ticket_handler (add) and session_ticket_fetcher (pop).
+
+    Tickets are single use: pop() removes what it returns, so 0-RTT data
+    cannot be replayed against this process with the same ticket, and each
+    resumed connection is issued a fresh one. Beyond max_tickets the oldest
+    are evicted. Workers keep separate stores; a device that lands on
+    another worker simply does a full handshake.
+
+    Each ticket also records the session_id of the connection it was issued
+    on, so resuming with it is what entitles a device to that session_id;
+    take() hands both back. holds(session_id) tells whether any ticket could
+    still bring a session back, and `on_released(session_id)`, if given, is
+    called when eviction removes the last ticket bound to one.
+    """
+    default_max_tickets = 100_000
+
+    def __init__(self, max_tickets: int = None, on_released=None):
+        self.max_tickets = TicketStore.default_max_tickets if max_tickets is None else max_tickets
+        self.on_released = on_released
+        self._tickets = OrderedDict()  # label -> [ticket, session_id or None]
+        self._bound = {}  # session_id -> tickets bound to it
+
+    def __len__(self):
+        return len(self._tickets)
+
+    def holds(self, session_id: int) -> bool:
+        return session_id in self._bound
+
+    def _unbind(self, session_id) -> bool:
+        """ True if that was the last ticket bound to session_id."""
+        if session_id is None:
+            return False
+        n = self._bound[session_id] - 1
+        if n:
+            self._bound[session_id] = n
+            return False
+        del self._bound[session_id]
+        return True
+
+    def add(self, ticket, session_id: int = None):
+        old = self._tickets.pop(ticket.ticket, None)
+        if old is not None:
+            self._unbind(old[1])
+        self._tickets[ticket.ticket] = [ticket, None]
+        if session_id is not None:
+            self.bind(ticket.ticket, session_id)
+        while len(self._tickets) > self.max_tickets:
+            _, (_, evicted) = self._tickets.popitem(last=False)
+            if self._unbind(evicted) and self.on_released is not None:
+                self.on_released(evicted)
+
+    def bind(self, label: bytes, session_id: int):
+        """ tie a ticket issued before AUTH to the session_id AUTH then assigned."""
+        entry = self._tickets.get(label)
+        if entry is not None and entry[1] != session_id:
+            self._unbind(entry[1])
+            entry[1] = session_id
+            self._bound[session_id] = self._bound.get(session_id, 0) + 1
+
+    def take(self, label: bytes):
+        """ (ticket, session_id it was issued on), or (None, None); single use like pop()."""
+        entry = self._tickets.pop(label, None)
+        if entry is None:
+            return None, None
+        self._unbind(entry[1])
+        if not entry[0].is_valid:
+            return None, None
+        return entry[0], entry[1]
+
+    def pop(self, label: bytes):
+        return self.take(label)[0]
+
+
+class TicketCache:
+    """
+    Client side: the latest ticket received from the server.
+
+    With a path the ticket is also written to disk (atomically, on every
+    new ticket), so a restarted client resumes as well. get() only returns
+    a ticket that is still valid for server_name.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        self.ticket = None
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    self.ticket = pickle.load(f)
+            except Exception as e:
+                log.warning("ignoring unreadable ticket file %s: %s", path, e)
+
+    def get(self, server_name: str):
+        ticket = self.ticket
+        if ticket is None or not ticket.is_valid or ticket.server_name != server_name:
+            return None
+        return ticket
+
+    def put(self, ticket):
+        self.ticket = ticket
+        if self.path is not None:
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(ticket, f)
+            os.replace(tmp, self.path)
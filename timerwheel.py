@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import math
+import time
+
+# Hierarchical timing wheel: one per process schedules the per-session
+# deadlines (server WAKE, client idle timeout and keepalive) instead of a
+# sleeping task per session.
+#
+# Level 0 has `slots` buckets of one tick each; every level above covers
+# `slots` times the span of the one below. A timer goes into the lowest level
+# whose span reaches its deadline, and when the wheel turns past a bucket of
+# an upper level the timers in it cascade down. Buckets are dicts keyed by
+# Timer, so insert and cancel are O(1) and a pending timer costs one small
+# object plus a dict entry. With the defaults (0.25 s ticks, 64 slots,
+# 4 levels) deadlines up to about 48 days away are exact to a tick; later
+# ones are parked in the farthest bucket and re-placed when it cascades.
+
+log = logging.getLogger("wtcp.timers")
+
+
+class Timer:
+    """ a pending callback; cancel() is O(1) and safe to call more than once.
+    """
+    __slots__ = ("expires", "callback", "args", "_slot", "_wheel")
+
+    def __init__(self, wheel, expires: int, callback, args):
+        self._wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self._slot = None
+
+    @property
+    def active(self) -> bool:
+        return self._slot is not None
+
+    def cancel(self):
+        slot = self._slot
+        if slot is not None:
+            del slot[self]
+            self._slot = None
+            self._wheel._count -= 1
+
+
+class TimerWheel:
+    """
+    schedule(delay, callback, *args) runs callback(*args) once, within one
+    tick after the delay. Inside a running event loop the wheel drives
+    itself with a single loop.call_at() that only exists while timers are
+    pending; without one, call advance(now) to fire what is due.
+    """
+
+    def __init__(self, tick: float = 0.25, slots: int = 64, levels: int = 4, clock=time.monotonic):
+        if slots & (slots - 1):
+            raise ValueError("slots must be a power of two")
+        self.tick = tick
+        self.clock = clock
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._levels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._current = math.floor(clock() / tick)  # last tick processed
+        self._count = 0
+        self._loop = None
+        self._handle = None
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay: float, callback, *args) -> Timer:
+        if not self._count:
+            # nothing pending: the wheel may have stopped turning, catch up
+            self._current = max(self._current, math.floor(self.clock() / self.tick))
+        expires = max(math.ceil((self.clock() + delay) / self.tick), self._current + 1)
+        timer = Timer(self, expires, callback, args)
+        self._insert(timer)
+        self._count += 1
+        self._drive()
+        return timer
+
+    def _insert(self, timer):
+        delta = timer.expires - self._current
+        bits = self._bits
+        top = len(self._levels) - 1
+        for level in range(top + 1):
+            if delta >> (bits * (level + 1)) == 0:
+                index = (timer.expires >> (bits * level)) & self._mask
+                break
+        else:
+            # beyond the wheel: the farthest top-level bucket, re-placed when it cascades
+            level = top
+            index = ((self._current >> (bits * top)) - 1) & self._mask
+        slot = self._levels[level][index]
+        slot[timer] = None
+        timer._slot = slot
+
+    def _step(self):
+        self._current += 1
+        now = self._current
+        bits = self._bits
+        for level in range(1, len(self._levels)):
+            if now & ((1 << (bits * level)) - 1):
+                break
+            buckets = self._levels[level]
+            index = (now >> (bits * level)) & self._mask
+            slot = buckets[index]
+            if slot:
+                buckets[index] = {}
+                for timer in slot:
+                    self._insert(timer)
+        buckets = self._levels[0]
+        index = now & self._mask
+        due = buckets[index]
+        if due:
+            buckets[index] = {}
+            self._count -= len(due)
+            for timer in due:
+                timer._slot = None
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    log.exception("timer callback %r failed", timer.callback)
+
+    def advance(self, now: float = None):
+        """ fire every timer due at or before now."""
+        target = math.floor((self.clock() if now is None else now) / self.tick)
+        while self._current < target and self._count:
+            self._step()
+        self._current = max(self._current, target)
+
+    def _drive(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # driven by explicit advance() calls
+        if self._handle is None or self._loop is not loop:
+            if self._handle is not None:
+                self._handle.cancel()
+            self._loop = loop
+            self._handle = loop.call_at((self._current + 1) * self.tick, self._run)
+
+    def _run(self):
+        self._handle = None
+        self.advance(self._loop.time())
+        if self._count and self._handle is None:  # callbacks may have restarted it
+            self._handle = self._loop.call_at((self._current + 1) * self.tick, self._run)
@@ -0,0 +1,80 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from aioquic.asyncio.server import QuicServer
+
+# Multi-process mode: N forked workers each bind their own UDP socket to the
+# same port with SO_REUSEPORT. The kernel picks a worker by hashing the
+# datagram's 4-tuple, so every packet of a connection (and therefore every
+# QUIC connection ID it uses) lands on the worker that owns that connection,
+# as long as the client keeps its address. QUIC connection migration to a new
+# address is not supported in this mode.
+
+def reuseport_socket(host: str, port: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.setblocking(False)
+    return sock
+
+
+async def serve_reuseport(host: str, port: int, *, configuration, create_protocol, **kwargs) -> QuicServer:
+    """ aioquic's serve(), but on a SO_REUSEPORT socket shared with the other workers.
+    """
+    loop = asyncio.get_running_loop()
+    _, server = await loop.create_datagram_endpoint(
+        lambda: QuicServer(configuration=configuration, create_protocol=create_protocol, **kwargs),
+        sock=reuseport_socket(host, port))
+    return server
+
+
+def _worker_main(main, args, worker, workers, command_fd, parent_fds):
+    # drop the inherited write ends, or the command pipe never reports EOF
+    for fd in parent_fds:
+        os.close(fd)
+    commands = os.fdopen(command_fd, "rb")
+    try:
+        asyncio.run(main(args, worker=worker, workers=workers, commands=commands))
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+
+
+def run_workers(main, args, workers: int):
+    """ fork `workers` processes running main(args, worker=i, workers=n, commands=pipe).
+
+    The parent keeps the terminal: each stdin line is forwarded to every
+    worker, so operator commands reach sessions on all of them. Ctrl-C reaches
+    the workers through the terminal; a SIGTERM to the parent is forwarded.
+    """
+    ctx = multiprocessing.get_context("fork")
+    fds = [os.pipe() for _ in range(workers)]
+    pipes = [w for _, w in fds]
+    procs = []
+    for i, (r, _) in enumerate(fds):
+        proc = ctx.Process(target=_worker_main, args=(main, args, i, workers, r, pipes),
+                           name=f"wtcp-worker-{i}")
+        proc.start()
+        os.close(r)
+        procs.append(proc)
+
+    def forward(signum, frame):
+        for proc in procs:
+            if proc.is_alive():
+                os.kill(proc.pid, signum)
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, forward)
+    try:
+        for line in sys.stdin.buffer:
+            for w in pipes:
+                os.write(w, line)
+        for w in pipes:
+            os.close(w)
+    except KeyboardInterrupt:
+        pass
+    for proc in procs:
+        proc.join()